@@ -0,0 +1,138 @@
+# doc: HTML解析的微基准，对比原来的实现（未预编译正则、每个关键词一份小写副本）和现在的实现
+# 默认使用 bench/fixtures 里的页面，覆盖 MissAV/Jable 详情页、HohoJ 搜索页和embed页、KanAV 搜索页和播放页。
+# 文件名前缀决定跑哪些解析器（missav_、jable_、hohoj_search、hohoj_embed、kanav_search、kanav_play）；
+# 也可以用 --html-dir 指定保存下来的真实页面（Downloader.downloadInfo 会把页面保存为 {avid}.html），
+# 文件名没有这些前缀时对每个详情页解析器都跑一遍
+# 用法（在项目根目录）：
+#   python -m bench.bench_parsers
+#   python -m bench.bench_parsers --html-dir /vol1/1000/Video/Nav/ABC-123 --number 200
+import argparse
+import base64
+import glob
+import os
+import re
+import tempfile
+import timeit
+from urllib.parse import unquote
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def legacy_is_valid_content(content: str, avid: str) -> bool:
+    error_indicators = ["404", "Not Found", "Page Not Found", "找不到页面"]
+    for indicator in error_indicators:
+        if indicator.lower() in content.lower():
+            return False
+    video_indicators = ["m3u8", "video", "play", "watch", "播放", "download", "下载", "player"]
+    for indicator in video_indicators:
+        if indicator.lower() in content.lower():
+            return True
+    if avid.lower() in content.lower():
+        return True
+    return True
+
+
+def legacy_missav_parse(html: str):
+    match = re.search(r"m3u8\|([a-f0-9\|]+)\|com\|surrit\|https\|video", html)
+    if not match:
+        return None
+    uuid = "-".join(match.group(1).split("|")[::-1])
+    og_title = re.search(r'<meta property="og:title" content="(.*?)"', html)
+    title = og_title.group(1) if og_title else ""
+    re.search(r'^([A-Z]+(?:-[A-Z]+)*-\d+)', title)
+    return uuid
+
+
+def legacy_jable_parse(html: str):
+    match = re.search(r"var hlsUrl = '(https?://[^']+)'", html)
+    og_title = re.search(r'<meta property="og:title" content="([^"]+)"', html)
+    if og_title:
+        re.search(r'([A-Z]+(?:-[A-Z]+)*-\d+)', og_title.group(1))
+    return match.group(1) if match else None
+
+
+def legacy_hohoj_search(content: str):
+    match = re.search(r'[?&]id=(\d+)', content)
+    return match.group(1) if match else None
+
+
+def legacy_hohoj_parse(html: str):
+    match = re.search(r'var videoSrc\s*=\s*"([^"]+)"', html)
+    return match.group(1) if match else None
+
+
+def legacy_kanav_search(content: str):
+    match = re.search(r'href="(/index\.php/vod/play[^"]*\.html)"', content)
+    return match.group(1) if match else None
+
+
+def legacy_kanav_parse(html: str):
+    match = re.search(r'"url":"([A-Za-z0-9]*)"', html)
+    if not match:
+        return None
+    return unquote(base64.b64decode(match.group(1)).decode('utf-8'))
+
+
+def load_pages(html_dir: str):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(html_dir or FIXTURES_DIR, "*.html"))):
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            pages.append((os.path.basename(path), f.read()))
+    return pages
+
+
+def bench(name: str, legacy, current, number: int):
+    legacy_s = timeit.timeit(legacy, number=number) / number
+    current_s = timeit.timeit(current, number=number) / number
+    speedup = legacy_s / current_s if current_s else float("inf")
+    print(f"{name:<40} legacy {legacy_s * 1e6:10.1f}us   current {current_s * 1e6:10.1f}us   x{speedup:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTML解析微基准")
+    parser.add_argument("--html-dir", default="", help="保存的页面目录（*.html），默认使用 bench/fixtures")
+    parser.add_argument("--number", type=int, default=100)
+    args = parser.parse_args()
+
+    from src.downloader import KanAVDownloader as kanav_module, hohoJDownloader as hohoj_module
+    from src.downloader.KanAVDownloader import KanAVDownloader
+    from src.downloader.hohoJDownloader import HohoJDownloader
+    from src.downloader.jableDownloader import JableDownloader
+    from src.downloader.missAVDownloader import MissAVDownloader
+    missav = MissAVDownloader(tempfile.gettempdir())
+    jable = JableDownloader(tempfile.gettempdir())
+    hohoj = HohoJDownloader(tempfile.gettempdir())
+    kanav = KanAVDownloader(tempfile.gettempdir())
+
+    # 解析失败时会打错误日志，基准测试时不需要
+    from loguru import logger
+    logger.remove()
+
+    # (文件名前缀, 名称, 原来的实现, 现在的实现)；搜索页只比较取结果链接这一步，indexLinks会写搜索索引
+    cases = [
+        ("missav_", "MissAV._is_valid_content", lambda html: legacy_is_valid_content(html, "BENCH-001"),
+         lambda html: missav._is_valid_content(html, "BENCH-001")),
+        ("missav_", "MissAV.parseHTML", legacy_missav_parse, missav.parseHTML),
+        ("jable_", "Jable.parseHTML", legacy_jable_parse, jable.parseHTML),
+        ("hohoj_search", "HohoJ 搜索页取视频id", legacy_hohoj_search,
+         lambda html: hohoj_module._VIDEO_ID_PATTERN.search(html)),
+        ("hohoj_embed", "HohoJ.parseHTML", legacy_hohoj_parse, hohoj.parseHTML),
+        ("kanav_search", "KanAV 搜索页取播放地址", legacy_kanav_search,
+         lambda html: kanav_module._PLAY_URL_PATTERN.search(html)),
+        ("kanav_play", "KanAV.parseHTML", legacy_kanav_parse, kanav.parseHTML),
+    ]
+    detail_pages = ("missav_", "jable_", "hohoj_embed", "kanav_play")
+
+    for name, html in load_pages(args.html_dir):
+        print(f"== {name} ({len(html) / 1024:.0f}KB)")
+        matched = [case for case in cases if name.startswith(case[0])]
+        for _, case_name, legacy, current in matched or [case for case in cases if case[0] in detail_pages]:
+            if not current(html):
+                # 解析不出结果时耗时没有意义，多半是页面结构变了
+                print(f"{case_name:<40} 没有解析出结果，跳过")
+                continue
+            bench(case_name, lambda: legacy(html), lambda: current(html), args.number)
+
+
+if __name__ == "__main__":
+    main()
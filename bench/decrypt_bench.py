@@ -0,0 +1,100 @@
+# doc: AES-128分片解密的基准，对比在下载线程里直接解密（inline）和放到进程池里解密（offload）
+# 多个线程同时解密，模拟下载线程池；另起一个线程每毫秒醒一次，统计它的延迟，反映解密对其他线程（收数据、合并）的影响
+# 用法（在项目根目录，需要cryptography）：
+#   python -m bench.decrypt_bench
+#   python -m bench.decrypt_bench --segments 200 --segment-size 2097152 --threads 8 --workers 4
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+
+def encrypt(data: bytes, key: bytes, iv: bytes) -> bytes:
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+class Ticker(threading.Thread):
+    """每毫秒醒一次，记录实际醒来比预期晚了多少"""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.lags = []
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            start = time.perf_counter()
+            time.sleep(0.001)
+            self.lags.append(time.perf_counter() - start - 0.001)
+
+    def stop(self) -> dict:
+        self._done.set()
+        self.join()
+        lags = sorted(self.lags) or [0.0]
+        return {"p99_ms": lags[int(len(lags) * 0.99)] * 1000, "max_ms": lags[-1] * 1000}
+
+
+def run(mode: str, segments: int, plain: bytes, cipher: bytes, key: bytes, iv: bytes, threads: int) -> dict:
+    from src.util.decrypt import decryptor
+
+    def one(check: bool):
+        buffer = decryptor.acquire()
+        try:
+            buffer.write(cipher)
+            length = decryptor.decrypt(buffer, key, iv)
+            if check:
+                assert bytes(buffer.buf[:length]) == plain
+        finally:
+            decryptor.release(buffer)
+
+    # 预热：创建进程池和缓冲区，顺便检查解密结果
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, [True] * threads))
+
+    ticker = Ticker()
+    ticker.start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, [False] * segments))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    lag = ticker.stop()
+    mb = len(cipher) * segments / 1024 / 1024
+    return {"mode": mode, "seconds": elapsed, "mb_s": mb / elapsed, "cpu_s": cpu, **lag}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AES-128分片解密基准")
+    parser.add_argument("--segments", type=int, default=200)
+    parser.add_argument("--segment-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--threads", type=int, default=8, help="同时解密的下载线程数")
+    parser.add_argument("--workers", type=int, default=2, help="offload时的进程数")
+    args = parser.parse_args()
+
+    from src.config_service import config_service
+    key, iv = os.urandom(16), os.urandom(16)
+    plain = os.urandom(args.segment_size)
+    cipher = encrypt(plain, key, iv)
+
+    results = []
+    for mode in ("inline", "offload"):
+        cfg = config_service.latest().model_dump()
+        cfg["Decryption"] = {**cfg.get("Decryption", {}), "offload": mode == "offload", "workers": args.workers}
+        config_service.update(cfg, persist=False)
+        results.append(run(mode, args.segments, plain, cipher, key, iv, args.threads))
+
+    print(f"{args.segments} 个分片 x {args.segment_size / 1024 / 1024:.1f}MB，{args.threads} 个线程，"
+          f"offload {args.workers} 个进程（主进程CPU不含子进程）")
+    for r in results:
+        print(f"{r['mode']:<8} {r['seconds']:7.3f}s {r['mb_s']:9.1f}MB/s  主进程CPU {r['cpu_s']:6.3f}s  "
+              f"其他线程延迟 p99 {r['p99_ms']:6.2f}ms max {r['max_ms']:6.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
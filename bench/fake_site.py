@@ -0,0 +1,342 @@
+# doc: 本地模拟站点，用于离线基准测试
+# 提供 MissAV/Jable/HohoJ/KanAV 的页面（格式与各下载器 parseHTML 的匹配规则一致），
+# 一个可配置分片数量、大小、延迟和失败率的HLS源（可选AES-128加密），以及可选的Cloudflare验证页。
+# 线上url通过 FakeSite.rewrite 改写为 http://127.0.0.1:{port}/{原域名}/{原路径}
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+ORIGIN_HOST = "origin.bench"  # Jable/HohoJ/KanAV 的视频流地址
+SURRIT_HOST = "surrit.com"    # MissAV 的视频流地址，写死在 MissAVDownloader 里
+COVER_HOST = "fourhoi.com"    # MissAV 的封面地址
+
+# 分片内容的基础块，固定种子，模拟站点进程和被测进程生成的内容一致
+_SEGMENT_BLOCK = random.Random(31).randbytes(64 * 1024)
+
+CF_INTERSTITIAL = (
+    "<!DOCTYPE html><html><head><title>Just a moment...</title></head>"
+    "<body><div id=\"challenge-stage\">Checking your browser before accessing the site.</div></body></html>"
+)
+
+
+@dataclass
+class SiteOptions:
+    segments: int = 100
+    segment_size: int = 512 * 1024
+    segment_duration: float = 4.0
+    latency: float = 0.0        # 每个请求的额外延迟（秒）
+    failure_rate: float = 0.0   # 分片请求返回500的概率
+    cloudflare: bool = False    # 每个页面第一次请求返回Cloudflare验证页
+    page_padding: int = 200 * 1024  # 页面里填充的无关内容，模拟较重的页面
+    encrypt: bool = False       # 分片用AES-128加密（#EXT-X-KEY），需要cryptography
+    # 备用源切换：broken_stream 站点（missav/jable/hohoj/kanav）的视频流从第 broken_after 个分片起只发一半就断开；
+    # resized_stream 站点的每个分片多 resize_delta 字节，模拟重新封装过、分片大小不同的备用源
+    broken_stream: str = ""
+    broken_after: int = 0
+    resized_stream: str = ""
+    resize_delta: int = 0
+
+
+def make_uuid(avid: str) -> str:
+    # MissAVDownloader._is_valid_content 把包含"404"的页面当成404页，避开这种uuid
+    salt = 0
+    while "404" in (h := hashlib.md5(f"{avid}{salt}".encode()).hexdigest()):
+        salt += 1
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+
+
+def segment_bytes(index: int, size: int) -> bytes:
+    """
+    第index个分片的明文：分片序号开头，后面是按序号错开的基础块。
+    每个分片的内容都不同，分片写错位置、顺序或者被截断，和期望的内容比对就能发现
+    """
+    shift = index * 4099 % len(_SEGMENT_BLOCK)
+    block = _SEGMENT_BLOCK[shift:] + _SEGMENT_BLOCK[:shift]
+    return (f"#SEGMENT{index:08d}#".encode() + block * (size // len(block) + 1))[:size]
+
+
+def segment_index(path: str) -> int:
+    """分片路径 .../video{index}.jpeg 中的序号"""
+    return int(path.rsplit("/video", 1)[-1].split(".", 1)[0])
+
+
+def rewrite_url(url: str, base_url: str) -> str:
+    """https://{host}/{path} -> {base_url}/{host}/{path}"""
+    parsed = urlparse(url)
+    if parsed.hostname in ("127.0.0.1", "localhost"):
+        return url
+    rewritten = f"{base_url}/{parsed.hostname}{parsed.path}"
+    return rewritten + (f"?{parsed.query}" if parsed.query else "")
+
+
+def _filler(size: int) -> str:
+    block = "<div class=\"thumbnail\"><a href=\"/related\"><img src=\"/img/cover.jpg\" alt=\"related video\"></a></div>\n"
+    return block * max(size // len(block), 0)
+
+
+def render_missav_page(avid: str, padding: int = 200 * 1024) -> str:
+    """MissAV详情页：og:title + eval打包脚本里的 m3u8|uuid倒序|com|surrit|https|video"""
+    token = "|".join(make_uuid(avid).split("-")[::-1])
+    return (
+        "<!DOCTYPE html><html><head>"
+        f"<meta property=\"og:title\" content=\"{avid} 模拟标题\">"
+        f"<meta property=\"og:image\" content=\"https://{COVER_HOST}/{avid.lower()}/cover-n.jpg\">"
+        "<meta property=\"og:description\" content=\"模拟简介\">"
+        "<meta property=\"og:video:release_date\" content=\"2024-01-02\">"
+        "<meta property=\"og:video:actor\" content=\"演员A\">"
+        f"</head><body><h1>{avid}</h1>\n"
+        + _filler(padding // 2)
+        + "<script>eval(function(p,a,c,k,e,d){return p}('f=\"8://7.6/5-4-3-2-1/0.m3u8\"',"
+        f"16,16,'m3u8|{token}|com|surrit|https|video|playlist|source'.split('|'),0,{{}}))</script>\n"
+        + _filler(padding // 2)
+        + "<div class=\"player\">video play download</div></body></html>"
+    )
+
+
+def render_jable_page(avid: str, padding: int = 200 * 1024) -> str:
+    return (
+        "<!DOCTYPE html><html><head>"
+        f"<meta property=\"og:title\" content=\"{avid} 模拟标题\">"
+        "</head><body>\n"
+        + _filler(padding // 2)
+        + f"<script>var hlsUrl = 'https://{ORIGIN_HOST}/jable/{avid}/index.m3u8';</script>\n"
+        + _filler(padding // 2)
+        + "</body></html>"
+    )
+
+
+def render_hohoj_search(avid: str, video_id: int) -> str:
+    return (
+        "<html><body><div class=\"video-list\">"
+        f"<a href=\"/video?id={video_id}\"><div class=\"title\">{avid} 模拟标题</div></a>"
+        f"<a href=\"/video?id={video_id + 1}\"><div class=\"title\">OTHER-001 其他视频</div></a>"
+        "</div></body></html>"
+    )
+
+
+def render_hohoj_embed(avid: str) -> str:
+    return f"<html><body><script>var videoSrc = \"https://{ORIGIN_HOST}/hohoj/{avid}/index.m3u8\";</script></body></html>"
+
+
+def render_kanav_search(avid: str, video_id: int) -> str:
+    return (
+        "<html><body><ul class=\"video-list\">"
+        f"<li><a href=\"/index.php/vod/play/id/{video_id}/sid/1/nid/1.html\" title=\"{avid}\">{avid}</a></li>"
+        "</ul></body></html>"
+    )
+
+
+def render_kanav_play(avid: str) -> str:
+    # 解析规则是 "url":"([A-Za-z0-9]*)"，编码结果里不能有 +/=，调整填充参数直到满足
+    for pad in range(64):
+        url = f"https://{ORIGIN_HOST}/kanav/{avid}/index.m3u8?p={'x' * pad}"
+        encoded = base64.b64encode(quote(url, safe="").encode()).decode()
+        if not any(c in encoded for c in "+/="):
+            break
+    return f"<html><body><script>var player_aaaa={{\"url\":\"{encoded}\",\"encrypt\":2}}</script></body></html>"
+
+
+class FakeSite:
+    """
+    使用方式：
+    site = FakeSite(SiteOptions(segments=200)); site.start()
+    request_handler.url_rewriter = site.rewrite
+    ...
+    site.stats()  # 服务端统计：分片字节数、首个播放列表请求时间等
+    site.stop()
+    """
+    def __init__(self, options: SiteOptions, port: int = 0):
+        self.options = options
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._key, self._iv = random.randbytes(16), random.randbytes(16)
+        self._lock = threading.Lock()
+        self._seen_pages = set()
+        self._stats = {
+            "requests": 0, "pages": 0, "cf_challenges": 0, "playlists": 0,
+            "segments": 0, "segment_failures": 0, "segment_bytes": 0,
+            "first_playlist_at": None, "first_segment_at": None, "last_segment_at": None,
+        }
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def rewrite(self, url: str) -> str:
+        return rewrite_url(url, self.base_url)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = None if key.endswith("_at") else 0
+            self._seen_pages.clear()
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _mark(self, key: str):
+        with self._lock:
+            now = time.time()
+            if key == "last_segment_at" or self._stats[key] is None:
+                self._stats[key] = now
+
+    def segment(self, index: int, stream: str = "") -> bytes:
+        """第index个分片的响应内容；加密时所有分片用同一个显式IV"""
+        size = self.options.segment_size
+        if stream and stream == self.options.resized_stream:
+            size += self.options.resize_delta
+        plain = segment_bytes(index, size)
+        if not self.options.encrypt:
+            return plain
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(self._key), modes.CBC(self._iv)).encryptor()
+        return encryptor.update(padder.update(plain) + padder.finalize()) + encryptor.finalize()
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                site._count("requests")
+                if site.options.latency:
+                    time.sleep(site.options.latency)
+                parsed = urlparse(self.path)
+                host, _, path = parsed.path.lstrip("/").partition("/")
+                path = "/" + path
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+                if host == "__stats":
+                    return self._send(200, json.dumps(site.stats()).encode(), "application/json")
+                if host == "__reset":
+                    site.reset_stats()
+                    return self._send(200, b"{}", "application/json")
+                if host in (SURRIT_HOST, ORIGIN_HOST):
+                    return self._stream(path, "missav" if host == SURRIT_HOST else path.split("/")[1])
+                if host == COVER_HOST:
+                    # 只有JPEG文件头，足够通过封面的格式检查
+                    return self._send(200, b"\xff\xd8\xff\xe0" + bytes(1024), "image/jpeg")
+                return self._page(host, path, query)
+
+            def _page(self, host: str, path: str, query: Dict[str, str]):
+                site._count("pages")
+                key = (host, path, tuple(sorted(query.items())))
+                if site.options.cloudflare:
+                    with site._lock:
+                        first = key not in site._seen_pages
+                        site._seen_pages.add(key)
+                    if first:
+                        site._count("cf_challenges")
+                        return self._send(403, CF_INTERSTITIAL.encode())
+
+                html = self._render(host, path, query)
+                if html is None:
+                    return self._send(404, b"<html><title>404 Not Found</title></html>")
+                return self._send(200, html.encode("utf-8"))
+
+            @staticmethod
+            def _render(host: str, path: str, query: Dict[str, str]) -> Optional[str]:
+                padding = site.options.page_padding
+                parts = [p for p in path.split("/") if p]
+                if host.startswith("missav") and parts:
+                    avid = parts[-1].upper().replace("-UNCENSORED-LEAK", "").replace("-CHINESE-SUBTITLE", "")
+                    return render_missav_page(avid, padding)
+                if host.startswith("jable") and len(parts) >= 2 and parts[0] == "videos":
+                    return render_jable_page(parts[1].upper(), padding)
+                if host.startswith("hohoj"):
+                    if path == "/search":
+                        return render_hohoj_search(query.get("text", "").upper(), 1000)
+                    if path == "/embed":
+                        return render_hohoj_embed(f"ID{query.get('id', '')}")
+                if host.startswith("kanav"):
+                    if path.endswith("/vod/search.html"):
+                        return render_kanav_search(query.get("wd", "").upper(), 2000)
+                    if "/vod/play/" in path:
+                        return render_kanav_play(f"ID{parts[4]}" if len(parts) > 4 else "UNKNOWN")
+                return None
+
+            def _stream(self, path: str, stream: str):
+                opts = site.options
+                if path.endswith("playlist.m3u8"):
+                    site._count("playlists")
+                    body = (
+                        "#EXTM3U\n"
+                        "#EXT-X-STREAM-INF:BANDWIDTH=8000000,RESOLUTION=1920x1080\n1080p/video.m3u8\n"
+                        "#EXT-X-STREAM-INF:RESOLUTION=1280x720,BANDWIDTH=4000000\n720p/video.m3u8\n"
+                        "#EXT-X-STREAM-INF:BANDWIDTH=1500000,RESOLUTION=854x480\n480p/video.m3u8\n"
+                    )
+                    return self._send(200, body.encode(), "application/vnd.apple.mpegurl")
+                if path.endswith(".m3u8"):
+                    site._count("playlists")
+                    site._mark("first_playlist_at")
+                    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(opts.segment_duration) + 1}"]
+                    if opts.encrypt:
+                        lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x{site._iv.hex()}')
+                    for i in range(opts.segments):
+                        lines.append(f"#EXTINF:{opts.segment_duration:.3f},")
+                        lines.append(f"video{i}.jpeg")
+                    lines.append("#EXT-X-ENDLIST")
+                    return self._send(200, ("\n".join(lines) + "\n").encode(), "application/vnd.apple.mpegurl")
+
+                if path.endswith("key.bin"):
+                    return self._send(200, site._key, "application/octet-stream")
+
+                site._mark("first_segment_at")
+                if opts.failure_rate and random.random() < opts.failure_rate:
+                    site._count("segment_failures")
+                    return self._send(500, b"")
+                index = segment_index(path)
+                body = site.segment(index, stream)
+                size = len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "video/mp2t")
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                if stream == opts.broken_stream and index >= opts.broken_after:
+                    # 响应头声明完整大小，只发一半内容就断开连接
+                    site._count("segment_failures")
+                    self.wfile.write(body[:size // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+                site._count("segments")
+                site._count("segment_bytes", size)
+                site._mark("last_segment_at")
+
+            def _send(self, status: int, body: bytes, content_type: str = "text/html; charset=utf-8"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
@@ -0,0 +1,214 @@
+# doc: 离线端到端基准测试
+# 在子进程里启动本地模拟站点，把所有请求改写到模拟站点，调用 downloader_service.download_video 完整跑一遍，
+# 输出解析耗时、下载吞吐、CPU时间和峰值内存。转码前把ts和模拟站点发出的分片逐个比对，内容不一致时 ok=False。
+# 用法（在项目根目录）：
+#   python -m bench.run_bench --site MissAV --segments 200 --segment-size 1048576 --latency 0.02 --failure-rate 0.01
+#   python -m bench.run_bench --site Jable --runs 3 --json bench_output.json
+#   python -m bench.run_bench --encrypt --segments 200 --segment-size 2097152 [--decrypt-inline]
+#   python -m bench.run_bench --site Jable --mirror HohoJ --mirror-size-delta 10   # 主源中途断开，切换到分片大小不同的备用源
+# --cloudflare 需要本机能启动 patchright chromium；--encrypt 需要cryptography
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from urllib.request import urlopen
+
+from bench.fake_site import FakeSite, SiteOptions, rewrite_url, segment_bytes
+
+SITES = {
+    "MissAV": "missav.ws",
+    "Jable": "jable.tv",
+    "HohoJ": "hohoj.tv",
+    "KanAV": "kanav.info",
+}
+
+
+def _serve(options: SiteOptions, port_queue):
+    site = FakeSite(options)
+    port_queue.put(site.port)
+    site.serve_forever()
+
+
+def start_site(options: SiteOptions):
+    """模拟站点跑在单独的进程里，CPU和内存不计入被测进程"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(options, port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=10)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def site_stats(base_url: str, reset: bool = False) -> dict:
+    with urlopen(f"{base_url}/{'__reset' if reset else '__stats'}", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def build_config(site: str, work_dir: str) -> dict:
+    from src.config_service import config_service
+    cfg = config_service.latest().model_dump()
+    cfg.update({
+        "SavePath": os.path.join(work_dir, "videos"),
+        "DBPath": os.path.join(work_dir, "downloaded.db"),
+        "ProxyPool": {"proxies": [], "includeDirect": True, "probeUrl": ""},
+        "Downloader": [{"downloaderName": site, "domain": SITES[site], "weight": 1}],
+    })
+    cfg["SegmentDownloader"] = {**cfg.get("SegmentDownloader", {}), "enable": True}
+    # 转码在当前线程完成，total包含转码耗时；模拟的分片不是真实视频，不做校验
+    cfg["PostProcess"] = {**cfg.get("PostProcess", {}), "async": False}
+    cfg["Verification"] = {**cfg.get("Verification", {}), "enable": False}
+    return cfg
+
+
+def check_output(ts_path: str, options: SiteOptions) -> str:
+    """
+    ts应该是所有分片按顺序拼接的结果，返回第一处不一致，一致时返回空字符串
+    切换备用源时每个分片可能来自主源或备用源，两种大小都接受，按下一个分片的开头确定是哪一种
+    """
+    sizes = sorted({options.segment_size, options.segment_size + options.resize_delta})
+    with open(ts_path, "rb") as f:
+        total = os.fstat(f.fileno()).st_size
+        offset = 0
+        for i in range(options.segments):
+            following = segment_bytes(i + 1, 32) if i + 1 < options.segments else b""
+            for size in sizes:
+                f.seek(offset)
+                if f.read(size) == segment_bytes(i, size) and (f.read(len(following)) == following
+                                                             if following else offset + size == total):
+                    offset += size
+                    break
+            else:
+                return f"ts中第 {i} 个分片与模拟站点发出的内容不一致"
+    return ""
+
+
+def hook_remux(options: SiteOptions, mismatches: list):
+    """转码前比对ts；转码后ts会被删除，只能在这里检查"""
+    from src import postprocess_service
+    remux = postprocess_service.remux
+
+    def checked_remux(ffmpeg_tool: str, ts_path: str, *args, **kwargs) -> bool:
+        mismatch = check_output(ts_path, options)
+        if mismatch:
+            mismatches.append(mismatch)
+        return remux(ffmpeg_tool, ts_path, *args, **kwargs)
+
+    postprocess_service.remux = checked_remux
+
+
+def run_once(avid: str, base_url: str, mismatches: list) -> dict:
+    from src import downloader_service
+
+    site_stats(base_url, reset=True)
+    mismatches.clear()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    error = ""
+    try:
+        downloader_service.download_video(avid, force=True)
+        ok = True
+    except Exception as e:
+        ok = False
+        error = str(e)
+    end = time.time()
+    if ok and mismatches:
+        ok, error = False, mismatches[0]
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = site_stats(base_url)
+
+    transfer = 0.0
+    if stats["first_segment_at"] and stats["last_segment_at"]:
+        transfer = stats["last_segment_at"] - stats["first_segment_at"]
+    return {
+        "ok": ok,
+        "error": error,
+        "total_s": round(end - start, 3),
+        # 从开始到请求media playlist，即 getHTML/parseHTML/清晰度选择 的耗时
+        "resolve_s": round(stats["first_playlist_at"] - start, 3) if stats["first_playlist_at"] else None,
+        "transfer_s": round(transfer, 3),
+        "throughput_mb_s": round(stats["segment_bytes"] / 1024 / 1024 / transfer, 2) if transfer > 0 else None,
+        "cpu_s": round((after_self.ru_utime - usage_self.ru_utime) + (after_self.ru_stime - usage_self.ru_stime), 3),
+        "cpu_children_s": round((after_children.ru_utime - usage_children.ru_utime)
+                                + (after_children.ru_stime - usage_children.ru_stime), 3),
+        # Linux下ru_maxrss单位是KB，是进程启动以来的峰值
+        "peak_rss_mb": round(after_self.ru_maxrss / 1024, 1),
+        "server": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NASSAVx 离线基准测试")
+    parser.add_argument("--site", choices=list(SITES), default="MissAV")
+    parser.add_argument("--avid", default="BENCH-001")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--segments", type=int, default=100)
+    parser.add_argument("--segment-size", type=int, default=512 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的额外延迟（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="分片请求失败的概率")
+    parser.add_argument("--cloudflare", action="store_true", help="页面第一次请求返回Cloudflare验证页")
+    parser.add_argument("--encrypt", action="store_true", help="分片用AES-128加密")
+    parser.add_argument("--decrypt-inline", action="store_true", help="在下载线程里解密（默认在进程池里解密）")
+    parser.add_argument("--mirror", choices=list(SITES), help="备用源站点；主源从一半分片起只发一半内容就断开")
+    parser.add_argument("--mirror-size-delta", type=int, default=0, help="备用源每个分片比主源多的字节数")
+    parser.add_argument("--json", help="结果写入json文件")
+    args = parser.parse_args()
+
+    options = SiteOptions(
+        segments=args.segments,
+        segment_size=args.segment_size,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        cloudflare=args.cloudflare,
+        encrypt=args.encrypt,
+    )
+    if args.mirror:
+        options.broken_stream, options.broken_after = args.site.lower(), args.segments // 2
+        options.resized_stream, options.resize_delta = args.mirror.lower(), args.mirror_size_delta
+    process, base_url = start_site(options)
+    work_dir = tempfile.mkdtemp(prefix="nassavx-bench-")
+
+    from src.config_service import config_service
+    from src.util import request_handler
+    request_handler.url_rewriter = lambda url: rewrite_url(url, base_url)
+    cfg = build_config(args.site, work_dir)
+    if args.mirror:
+        cfg["Downloader"] = [{**cfg["Downloader"][0], "weight": 2},
+                             {"downloaderName": args.mirror, "domain": SITES[args.mirror], "weight": 1}]
+        # 主源的分片少重试几次，尽快切换
+        cfg["SegmentDownloader"] = {**cfg["SegmentDownloader"], "retries": 2, "backoff": 0.1}
+    if args.decrypt_inline:
+        cfg["Decryption"] = {**cfg.get("Decryption", {}), "offload": False}
+    config_service.update(cfg, persist=False)
+    mismatches = []
+    hook_remux(options, mismatches)
+
+    results = []
+    try:
+        for i in range(args.runs):
+            shutil.rmtree(os.path.join(work_dir, "videos"), ignore_errors=True)
+            os.makedirs(os.path.join(work_dir, "videos"), exist_ok=True)
+            result = run_once(args.avid, base_url, mismatches)
+            results.append(result)
+            print(
+                f"[{i + 1}/{args.runs}] ok={result['ok']} total={result['total_s']}s resolve={result['resolve_s']}s "
+                f"transfer={result['transfer_s']}s throughput={result['throughput_mb_s']}MB/s "
+                f"segments={result['server']['segments']}/{args.segments} "
+                f"cpu={result['cpu_s']}s cpu(children)={result['cpu_children_s']}s peak_rss={result['peak_rss_mb']}MB "
+                f"{result['error']}"
+            )
+    finally:
+        process.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,100 @@
 import random
-import subprocess
 import threading
 import time
-from typing import Dict, List
-
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from dataclasses import asdict
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Deque, List, Optional
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 from src import downloader_service
 from src.comm import *
-
-app = FastAPI(title="流媒体下载器", description="管理视频下载任务")
+from src.config_service import config_service
+from src.lease_service import COORDINATOR, check_token, get_task_source, lease_manager
+from src.lookahead_service import lookahead_service
+from src.postprocess_service import postprocess_service
+from src.subscription_service import subscription_service
+from src.task_store import (
+    COMPLETED, DOWNLOADING, FAILED, PENDING, adopt_partial_files, discard_partial_files, fail_and_requeue, task_store
+)
+from src.task_queue import add_tasks, load_queue_from_file, remove_task_from_queue
+from src.verify_service import verify_service
+from src.util import profiler
+from src.util.cancel import CancelToken
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """后台线程在服务启动时才启动，导入本模块（进程池的spawn子进程、命令行工具）没有副作用"""
+    start_background_services()
+    yield
+
+app = FastAPI(title="流媒体下载器", description="管理视频下载任务", lifespan=lifespan)
 
 # 挂载静态文件和模板
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """开启Profiling时统计每个接口的耗时"""
+    if not profiler.is_enabled():
+        return await call_next(request)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route is not None else request.url.path
+    profiler.record(f"http {request.method} {path}", time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+    return response
+
 # 数据模型
 class DownloadTask(BaseModel):
     avid: str
 
-class DownloadStatus(BaseModel):
-    avid:  str
-    status: str # pending, downloading, completed, failed
-    message: str = ""
+class CrawlTask(BaseModel):
+    downloader: str
+    urls: List[str]
 
-# 全局状态
-current_task = None
-download_status: Dict[str, DownloadStatus] = {}
-completed_tasks: List[str] = []
-failed_tasks: List[str] = []
-console_logs: List[str] = []
-stop_requested = False
-current_processes = []
-
-# 确保队列目录存在
-os.makedirs(os.path.dirname(queue_path), exist_ok=True)
-
-def load_queue_from_file() -> List[str]:
-    """从文件加载下载队列"""
-    try:
-        if os.path.exists(queue_path):
-            with open(queue_path, "r", encoding="utf-8") as f:
-                tasks = [line.strip() for line in f if line.strip()]
-            return tasks
-        return []
-    except Exception as e:
-        logger.error(f"加载队列文件失败: {e}")
-        return []
+class LeaseRequest(BaseModel):
+    worker: str
 
-def save_queue_to_file(tasks: List[str]):
-    """保存队列到文件"""
-    try:
-        with open(queue_path, "w", encoding="utf-8") as f:
-            for task in tasks:
-                f.write(task + "\n")
-    except Exception as e:
-        logger.error(f"保存队列文件失败: {e}")
+class LeaseHeartbeat(BaseModel):
+    progress: str = ""
+
+class LeaseResult(BaseModel):
+    ok: bool
+    message: str = ""
+    # 工作节点传false，转码、校验结束后再通过 /cluster/results 上报
+    record: bool = True
 
-def remove_task_from_queue(avid: str):
-    """从队列文件中移除任务"""
-    tasks = load_queue_from_file()
-    tasks = [task for task in tasks if task != avid]
-    save_queue_to_file(tasks)
+class PostProcessResult(BaseModel):
+    avid: str
+    ok: bool
+    worker: str
+    message: str = ""
+
+# 全局状态；任务状态保存在数据库里（src/task_store.py），重启后仍然可以看到
+current_task = None
+# 只保留最近200条日志
+console_logs: Deque[str] = deque(maxlen=200)
+console_logs_lock = threading.Lock()
+current_cancel: Optional[CancelToken] = None
 
 def add_console_log(message: str):
     timestamp = time.strftime("%H:%M:%S")
-    console_logs.append(f"{timestamp} {message}")
-    # 只保留最近200条日志
-    if len(console_logs) > 200:
-        console_logs.pop(0)
+    with console_logs_lock:
+        console_logs.append(f"{timestamp} {message}")
+
+def recent_console_logs(count: int) -> List[str]:
+    with console_logs_lock:
+        return list(console_logs)[-count:]
 
 # 自定义日志处理器，将日志重定向到我们的函数
 class WebLogHandler:
@@ -86,120 +108,105 @@ class WebLogHandler:
 # 重定向标准输出和标准错误
 # sys.stdout = WebLogHandler()
 # sys.stderr = WebLogHandler()
-logger.add(WebLogHandler(), format="{time:HH:mm:ss} | {level} | {message}", level="DEBUG")
+logger.add(WebLogHandler(), format="{time:HH:mm:ss} | {level} | {message}", level="DEBUG", enqueue=True)
 
 def stop_current_task():
-    global stop_requested, current_processes
+    """结束当前任务的下载进程组、断开分片连接；下载线程收到TaskCancelled后按配置保留或删除临时文件"""
     logger.info("正在停止当前任务……")
-    stop_requested = True
-
-    # 停止所有相关进程
-    for process in current_processes:
-        try:
-            if process and process.poll() is None:
-                logger.info(f"停止进程：{process.pid}")
-                if os.name == 'nt':
-                    process.terminate()
-                else:
-                    process.terminate()
-
-                # 等待进程结束
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    logger.warning("进程为正常终止，强制杀死")
-                    process.kill()
-        except Exception as e:
-            logger.error(f"停止进程时出错：{e}")
-
-    # 清空进程列表
-    current_processes.clear()
+    if current_cancel is not None:
+        current_cancel.cancel()
     # 更新当前任务状态
     if current_task:
-        download_status[current_task] = DownloadStatus(
-            avid=current_task,
-            status="failed",
-            message="任务已停止"
-        )
-        failed_tasks.append(current_task)
+        task_store.set(current_task, FAILED, "任务已停止")
 
     logger.info("当前任务已停止")
 
+def _cleanup_stopped(avid: str):
+    """keepPartial为true时保留可以续传的分片，下次继续；否则删除这个任务的全部临时文件"""
+    cfg = config_service.current()
+    if cfg.Cancellation.get("keepPartial", True):
+        logger.info(f"{avid} {adopt_partial_files(avid, cfg.SavePath)}")
+    else:
+        discard_partial_files(avid, cfg.SavePath)
+
 def download_worker():
-    """后台下载工作线程"""
-    global current_task, stop_requested, current_processes
+    """后台下载工作线程。任务按租约领取：单机和协调节点从本机队列领取，工作节点从协调节点领取"""
+    global current_task, current_cancel
 
     while True:
         try:
-            stop_requested = False
-            current_processes.clear()
-
-            tasks = load_queue_from_file()
+            source = get_task_source()
+            lease = source.acquire()
 
-            if not tasks:
+            if lease is None:
                 current_task = None
                 time.sleep(10)
                 continue
 
-            current_task = tasks[0]
+            current_task = lease.avid
+            cancel = current_cancel = CancelToken(float(config_service.latest().Cancellation.get("killTimeout", 5)))
             logger.info(f"开始下载任务: {current_task}")
+            # 当前任务下载时，后台提前解析接下来的任务
+            lookahead_service.schedule(keep=[current_task])
 
-            download_status[current_task] = DownloadStatus(
-                avid = current_task,
-                status = "downloading",
-                message = "开始下载"
-            )
+            task_store.set(current_task, DOWNLOADING, "开始下载")
 
+            progress = lambda: next(iter(recent_console_logs(1)), "")
+            on_beat = lambda message, avid=current_task: task_store.heartbeat(avid, message)
             try:
-                downloader_service.download_video(current_task, current_processes)
+                with source.keep_alive(lease, progress, on_lost=stop_current_task, on_beat=on_beat), \
+                        profiler.stage("download_worker.task"):
+                    downloader_service.download_video(current_task, cancel=cancel)
 
-                if stop_requested:
+                if cancel.cancelled:
                     logger.info(f"任务{current_task}被停止")
+                    _cleanup_stopped(current_task)
+                    source.release(lease)
                     continue
 
-                download_status[current_task] = DownloadStatus(
-                    avid = current_task,
-                    status = "completed",
-                    message = "下载完成"
-                )
-                completed_tasks.append(current_task)
                 logger.info(f"任务完成: {current_task}")
+                ok, message = True, "下载完成"
             except Exception as e:
-                if stop_requested:
+                if cancel.cancelled:
                     logger.info(f"任务 {current_task} 被停止")
+                    _cleanup_stopped(current_task)
+                    source.release(lease)
                     continue
 
                 error_msg = str(e)
-                download_status[current_task] = DownloadStatus(
-                    avid = current_task,
-                    status = "failed",
-                    message = f"下载失败: {error_msg}"
-                )
-                failed_tasks.append(current_task)
+                task_store.set(current_task, FAILED, f"下载失败: {error_msg}")
                 logger.error(f"任务失败{current_task}: {error_msg}")
-
-            # remove_task_from_queue(current_task)
-            # current_task = None
-            #
-            # wait_time = random.randint(300, 900)
-            # logger.info(f"等待{wait_time}秒后继续下一个任务")
-            # time.sleep(wait_time)
-
-            if not stop_requested:
-                remove_task_from_queue(current_task)
+                ok, message = False, f"下载失败: {error_msg}"
+
+            # 上报结果并移出队列（协调节点上成功的任务写入downloaded.db）
+            source.complete(lease, ok, message)
+            # 移出队列之后再改为completed：异步转码或校验已经失败（状态已是failed）时，
+            # 它重新加入队列的操作可能被上面的移出覆盖，这里再加回去
+            if ok and not task_store.set(current_task, COMPLETED, message, expect=DOWNLOADING):
+                logger.warning(f"{current_task} 转码或校验已失败，保留在队列里")
+                record = task_store.get(current_task) or {}
+                fail_and_requeue(current_task, record.get("message") or "转码或校验失败")
             current_task = None
 
-            if not stop_requested:
-                wait_time = random.randint(300, 900)
-                logger.info(f"等待{wait_time}秒后继续下一个任务")
-                time.sleep(wait_time)
+            wait_time = random.randint(300, 900)
+            logger.info(f"等待{wait_time}秒后继续下一个任务")
+            # 等待期间预解析的地址可能过期，开始前重新解析
+            lookahead_service.schedule(start_at=time.time() + wait_time)
+            time.sleep(wait_time)
 
         except Exception as e:
             logger.error(f"下载工作线程错误: {e}")
             time.sleep(60)
 
-download_thread = threading.Thread(target=download_worker, daemon=True)
-download_thread.start()
+def start_background_services():
+    # 上次退出时没做完的任务：整理临时文件，留在队列里等下载线程继续
+    task_store.recover()
+    download_thread = threading.Thread(target=download_worker, daemon=True)
+    download_thread.start()
+    # 监听配置文件变化，修改域名、权重、代理不需要重启
+    config_service.start_watcher()
+    # 订阅轮询，未开启时线程只是定期检查配置
+    subscription_service.start()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -209,19 +216,10 @@ async def read_root(request: Request):
 @app.post("/tasks/")
 async def add_task(task: DownloadTask):
     try:
-        tasks = load_queue_from_file()
-
-        if task.avid.upper() in tasks:
+        if not add_tasks([task.avid]):
             raise HTTPException(status_code=400, detail="任务已存在")
 
-        tasks.append(task.avid.upper())
-        save_queue_to_file(tasks)
-
-        download_status[task.avid.upper()] = DownloadStatus(
-            avid=task.avid.upper(),
-            status="pending",
-            message="等待下载"
-        )
+        task_store.set(task.avid.upper(), PENDING, "等待下载")
         logger.info(f"已添加任务: {task.avid}")
 
         return {"message": "任务添加成功", "avid": task.avid}
@@ -232,48 +230,49 @@ async def add_task(task: DownloadTask):
 @app.get("/tasks/")
 async def get_tasks():
     queue_tasks = load_queue_from_file()
+    # 文件读取和数据库查询放到线程池，不阻塞事件循环
+    statuses = await run_in_threadpool(task_store.get_many, queue_tasks)
 
-    queue_with_status = []
-    for avid in queue_tasks:
-        status = download_status.get(avid, DownloadStatus(avid=avid, status="pending"))
-        queue_with_status.append(status.model_dump())
-
-    completed_with_status = []
-    for avid in completed_tasks[-20:]:
-        status = download_status.get(avid, DownloadStatus(avid=avid, status="completed"))
-        completed_with_status.append(status.model_dump())
-
-    failed_with_status = []
-    for avid in failed_tasks[-20:]:
-        status = download_status.get(avid, DownloadStatus(avid=avid, status="failed"))
-        failed_with_status.append(status.model_dump())
+    queue_with_status = [_task_view(statuses.get(avid, {"avid": avid, "status": PENDING})) for avid in queue_tasks]
+    completed_with_status = [_task_view(status) for status in await run_in_threadpool(task_store.recent, COMPLETED, 20)]
+    failed_with_status = [_task_view(status) for status in await run_in_threadpool(task_store.recent, FAILED, 20)]
 
     return {
         "current_task": current_task,
         "queue": queue_with_status,
         "completed": completed_with_status,
         "failed": failed_with_status,
-        "logs": console_logs[-100:] # 只返回最近100条日志
+        "logs": recent_console_logs(100) # 只返回最近100条日志
     }
 
+def _task_view(status: dict) -> dict:
+    """网页用到的字段：avid, status(pending/downloading/completed/failed/interrupted), message"""
+    return {"avid": status["avid"], "status": status["status"], "message": status.get("message") or ""}
+
+@app.get("/history")
+async def get_history(status: Optional[str] = None, downloader: Optional[str] = None,
+                      since: Optional[datetime] = None, cursor: Optional[str] = None, limit: int = 50):
+    """
+    任务历史，按更新时间倒序。since可以是时间戳或ISO时间；
+    返回的next_cursor作为下一页的cursor参数，为null时没有更多
+    """
+    limit = min(max(limit, 1), 200)
+    try:
+        return await run_in_threadpool(task_store.history, status, downloader,
+                                       since.timestamp() if since else None, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/clear-failed-tasks/")
 async def clear_failed_tasks():
     """清空所有失败任务"""
     try:
-        global failed_tasks, download_status
+        count = await run_in_threadpool(task_store.clear, FAILED)
 
-        # 获取当前失败任务的avid列表
-        failed_avids = failed_tasks.copy()
-        failed_tasks.clear()
-
-        for avid in failed_avids:
-            if avid in download_status and download_status[avid].status == "failed":
-                del download_status[avid]
-
-        logger.info(f"已清空 {len(failed_avids)} 个失败任务")
+        logger.info(f"已清空 {count} 个失败任务")
         return {
-            "message": f"已清空 {len(failed_avids)} 个失败任务",
-            "cleared_count": len(failed_avids)
+            "message": f"已清空 {count} 个失败任务",
+            "cleared_count": count
         }
     except Exception as e:
         logger.error(f"清空失败任务时出错: {e}")
@@ -298,6 +297,131 @@ async def stop_current_download():
     stop_current_task()
     return {"message": "停止请求已发送"}
 
+@app.get("/postprocess")
+async def get_postprocess():
+    """转码队列的状态：queued/remuxing/done/failed"""
+    return postprocess_service.status()
+
+@app.get("/verifications")
+async def get_verifications():
+    """下载后校验的状态：verifying/repairing/verified/failed"""
+    return verify_service.status()
+
+@app.get("/lookahead")
+async def get_lookahead():
+    """预解析的状态：scheduled/resolving/resolved/failed，以及地址多久后过期"""
+    return lookahead_service.status()
+
+@app.get("/subscriptions")
+async def get_subscriptions():
+    return subscription_service.status()
+
+@app.post("/subscriptions/poll")
+async def poll_subscriptions():
+    """立即轮询所有订阅，返回每个订阅新加入队列的数量"""
+    return await run_in_threadpool(subscription_service.poll_all)
+
+@app.post("/search-index/crawl")
+async def crawl_search_index(task: CrawlTask):
+    """抓取片商、分类等列表页，把页面上的番号和地址记入搜索索引"""
+    try:
+        count = await run_in_threadpool(downloader_service.crawl_listing, task.downloader, task.urls)
+        return {"message": f"已记录 {count} 条", "count": count}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def require_coordinator(token: Optional[str]):
+    if config_service.latest().Cluster.get("mode") != COORDINATOR:
+        raise HTTPException(status_code=403, detail="本机不是协调节点")
+    if not check_token(token):
+        raise HTTPException(status_code=401, detail="X-Cluster-Token 不正确")
+
+@app.get("/cluster/leases")
+async def get_leases(x_cluster_token: Optional[str] = Header(None)):
+    """所有节点正在执行的任务"""
+    require_coordinator(x_cluster_token)
+    return await run_in_threadpool(lease_manager.leases)
+
+@app.post("/cluster/leases")
+async def acquire_lease(request: LeaseRequest, x_cluster_token: Optional[str] = Header(None)):
+    """工作节点领取下一个任务，队列为空时lease为null"""
+    require_coordinator(x_cluster_token)
+    lease = await run_in_threadpool(lease_manager.acquire, request.worker)
+    return {"lease": asdict(lease) if lease else None}
+
+@app.post("/cluster/leases/{token}/heartbeat")
+async def renew_lease(token: str, request: LeaseHeartbeat, x_cluster_token: Optional[str] = Header(None)):
+    require_coordinator(x_cluster_token)
+    if not await run_in_threadpool(lease_manager.heartbeat, token, request.progress):
+        raise HTTPException(status_code=410, detail="租约已失效")
+    return {"message": "已续期"}
+
+@app.post("/cluster/leases/{token}/complete")
+async def complete_lease(token: str, result: LeaseResult, x_cluster_token: Optional[str] = Header(None)):
+    """上报结果：任务移出队列，成功且record为true时写入downloaded.db"""
+    require_coordinator(x_cluster_token)
+    if not await run_in_threadpool(lease_manager.complete, token, result.ok, result.message, result.record):
+        raise HTTPException(status_code=410, detail="租约已失效")
+    return {"message": "已记录"}
+
+@app.post("/cluster/results")
+async def record_result(result: PostProcessResult, x_cluster_token: Optional[str] = Header(None)):
+    """工作节点转码、校验的最终结果：成功时写入downloaded.db，失败时重新加入队列"""
+    require_coordinator(x_cluster_token)
+    await run_in_threadpool(lease_manager.record, result.avid.upper(), result.ok, result.worker, result.message)
+    return {"message": "已记录"}
+
+@app.delete("/cluster/leases/{token}")
+async def release_lease(token: str, x_cluster_token: Optional[str] = Header(None)):
+    """放弃租约，任务留在队列里等待重新分配"""
+    require_coordinator(x_cluster_token)
+    await run_in_threadpool(lease_manager.release, token)
+    return {"message": "已释放"}
+
+@app.get("/config")
+async def get_config():
+    """Cluster.token 和代理密码用占位符代替"""
+    return config_service.redacted()
+
+@app.put("/config")
+async def update_config(data: dict, x_cluster_token: Optional[str] = Header(None)):
+    """
+    校验并替换配置，正在运行的任务继续使用旧配置；仍是占位符的密钥保留原值。
+    配置了Cluster.token时需要带上 X-Cluster-Token，否则任何人都能替换保护 /cluster/* 的token
+    """
+    if not check_token(x_cluster_token):
+        raise HTTPException(status_code=401, detail="X-Cluster-Token 不正确")
+    try:
+        config = config_service.update(config_service.unredact(data))
+        logger.info("配置已通过接口更新")
+        return {"message": "配置更新成功", "config": config_service.redacted(config)}
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=e.errors(include_url=False))
+    except Exception as e:
+        logger.error(f"更新配置失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/debug/stages")
+async def get_stage_stats(reset: bool = False):
+    """各阶段的耗时统计"""
+    if not profiler.is_enabled():
+        raise HTTPException(status_code=403, detail="未开启Profiling")
+    stats = profiler.get_stage_stats()
+    if reset:
+        profiler.reset_stage_stats()
+    return stats
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def sample_profile(seconds: float = 10, interval: float = 0.005, thread: str = ""):
+    """限时采样分析，返回火焰图用的折叠栈（flamegraph.pl / speedscope 可直接打开）"""
+    if not profiler.is_enabled():
+        raise HTTPException(status_code=403, detail="未开启Profiling")
+    seconds = min(max(seconds, 0.1), 60)
+    try:
+        return await run_in_threadpool(profiler.sample, seconds, max(interval, 0.001), thread or None)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8020)
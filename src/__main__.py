@@ -0,0 +1,252 @@
+# doc: 命令行批量下载，不启动网页服务、下载队列和订阅线程，适合在其他机器上用脚本批量跑：
+#   python -m src ABC-123 DEF-456
+#   python -m src -f avids.txt -j 2 --summary summary.json
+# 每个番号调用 downloader_service.download_video，终端里实时显示每个任务的状态、已下载大小和速度，
+# 结束后输出json汇总。转码在下载线程里同步完成；开启校验时等校验结束再退出。Ctrl-C 停止所有任务
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from . import downloader_service
+from .comm import *
+from .config_service import config_service
+from .postprocess_service import FAILED as REMUX_FAILED, postprocess_service
+from .task_store import COMPLETED, DOWNLOADING, FAILED, PENDING, task_store
+from .util.cancel import CancelToken, TaskCancelled
+from .util.segment_downloader import download_progress
+from .verify_service import FAILED as VERIFY_FAILED, REPAIRING, VERIFYING, verify_service
+
+CANCELLED = "cancelled"
+
+
+@dataclass
+class TaskProgress:
+    avid: str
+    status: str = PENDING
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    bytes: int = 0
+    speed: float = 0.0
+    segments: str = ""
+    downloader: str = ""
+    verified: Optional[str] = None
+    error: str = ""
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+def update_progress(task: TaskProgress, save_path: str, interval: float):
+    """进程内分片下载时查询下载器的进度；使用下载工具时按ts文件的大小估计"""
+    ts_path = os.path.join(save_path, task.avid, f"{task.avid}.ts")
+    progress = download_progress(ts_path)
+    if progress is not None:
+        done, total, size = progress
+        task.segments = f"{done}/{total}"
+    else:
+        size = os.path.getsize(ts_path) if os.path.exists(ts_path) else 0
+    task.speed = max(size - task.bytes, 0) / interval
+    task.bytes = size
+
+
+def final_size(save_path: str, avid: str) -> int:
+    """转码完成后ts会被删除，用mp4的大小"""
+    for name in (f"{avid}.mp4", f"{avid}.ts"):
+        path = os.path.join(save_path, avid, name)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+    return 0
+
+
+class ProgressView:
+    """终端是tty时原地刷新每个任务一行；否则（重定向到文件）只在状态变化时输出一行"""
+    def __init__(self, tasks: List[TaskProgress], save_path: str, interval: float = 1.0):
+        self.tasks = tasks
+        self.save_path = save_path
+        self.interval = interval
+        self.tty = sys.stdout.isatty()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="cli-progress")
+        self._drawn = 0
+        self._printed: Dict[str, str] = {}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._refresh()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._refresh()
+
+    def _refresh(self):
+        for task in self.tasks:
+            if task.status == DOWNLOADING:
+                update_progress(task, self.save_path, self.interval)
+        if self.tty:
+            lines = [self._line(task) for task in self.tasks]
+            done = sum(1 for task in self.tasks if task.finished is not None)
+            lines.append(f"完成 {done}/{len(self.tasks)}")
+            # 回到上次输出的第一行，逐行覆盖
+            out = f"\x1b[{self._drawn}F" if self._drawn else ""
+            out += "".join(f"\x1b[2K{line}\n" for line in lines)
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            self._drawn = len(lines)
+            return
+        for task in self.tasks:
+            if self._printed.get(task.avid) != task.status:
+                self._printed[task.avid] = task.status
+                print(self._line(task), flush=True)
+
+    @staticmethod
+    def _line(task: TaskProgress) -> str:
+        line = f"{task.avid:<16} {task.status:<12} {task.bytes / 1024 / 1024:9.1f}MB"
+        if task.status == DOWNLOADING:
+            line += f" {task.speed / 1024 / 1024:7.2f}MB/s {task.segments:>11}"
+        if task.started is not None:
+            line += f" {task.seconds:7.0f}s"
+        if task.downloader:
+            line += f"  {task.downloader}"
+        if task.error:
+            line += f"  {task.error[:60]}"
+        return line
+
+
+def run_task(task: TaskProgress, cancel: CancelToken, force: bool, save_path: str):
+    if cancel.cancelled:
+        task.status = CANCELLED
+        return
+    task.status, task.started = DOWNLOADING, time.time()
+    task_store.set(task.avid, DOWNLOADING, "命令行下载")
+    try:
+        downloader_service.download_video(task.avid, force=force, cancel=cancel)
+        task.status = COMPLETED
+        # 转码失败时状态已经是failed，不覆盖
+        task_store.set(task.avid, COMPLETED, "下载完成", expect=DOWNLOADING)
+    except TaskCancelled:
+        task.status = CANCELLED
+        task_store.set(task.avid, FAILED, "任务已停止")
+    except Exception as e:
+        task.status, task.error = FAILED, str(e)
+        task_store.set(task.avid, FAILED, f"下载失败: {e}")
+    finally:
+        task.finished = time.time()
+        task.bytes = final_size(save_path, task.avid)
+        record = task_store.get(task.avid) or {}
+        task.downloader = record.get("downloader") or ""
+
+
+def wait_verification(tasks: List[TaskProgress]):
+    """校验在后台进程池里进行，等本次完成的任务都有结果；转码或校验失败的任务改为failed"""
+    completed = [task for task in tasks if task.status == COMPLETED]
+    while True:
+        status = verify_service.status()
+        if not any(status.get(task.avid) in (VERIFYING, REPAIRING) for task in completed):
+            break
+        time.sleep(1)
+    remuxed = postprocess_service.status()
+    for task in completed:
+        task.verified = status.get(task.avid)
+        if remuxed.get(task.avid) == REMUX_FAILED:
+            task.status, task.error = FAILED, "转码失败"
+        elif task.verified == VERIFY_FAILED:
+            task.status, task.error = FAILED, "校验未通过"
+
+
+def read_avids(args) -> List[str]:
+    avids = list(args.avids)
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            avids += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    # 去重，保持顺序
+    return list(dict.fromkeys(avid.upper() for avid in avids))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m src", description="命令行批量下载")
+    parser.add_argument("avids", nargs="*", help="番号")
+    parser.add_argument("-f", "--file", help="番号列表文件，每行一个，#开头的行忽略")
+    parser.add_argument("-j", "--parallel", type=int, default=1, help="同时下载的任务数")
+    parser.add_argument("--summary", help="结果汇总写入json文件，默认输出到标准输出")
+    parser.add_argument("--force", action="store_true", help="已经在数据库里的番号也重新下载")
+    parser.add_argument("--verbose", action="store_true", help="日志同时输出到终端（默认只写日志文件）")
+    args = parser.parse_args()
+
+    avids = read_avids(args)
+    if not avids:
+        parser.error("没有要下载的番号")
+
+    if not args.verbose:
+        # 默认的终端输出会打乱进度显示，日志仍然写入LogPath
+        try:
+            logger.remove(0)
+        except ValueError:
+            pass
+
+    # 转码在下载线程里完成，汇总里的结果包含转码
+    cfg = config_service.latest().model_dump()
+    cfg["PostProcess"] = {**cfg.get("PostProcess", {}), "async": False}
+    config_service.update(cfg, persist=False)
+    save_path = config_service.latest().SavePath
+
+    tasks = [TaskProgress(avid) for avid in avids]
+    cancel = CancelToken(float(config_service.latest().Cancellation.get("killTimeout", 5)))
+    view = ProgressView(tasks, save_path)
+    started = time.time()
+    view.start()
+    executor = ThreadPoolExecutor(max_workers=max(args.parallel, 1), thread_name_prefix="cli")
+    futures = {executor.submit(run_task, task, cancel, args.force, save_path) for task in tasks}
+    interrupted = False
+    try:
+        while futures:
+            _, futures = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+    except KeyboardInterrupt:
+        interrupted = True
+        cancel.cancel()
+        for task in tasks:
+            if task.status == PENDING:
+                task.status = CANCELLED
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if not interrupted:
+        wait_verification(tasks)
+    view.stop()
+
+    counts: Dict[str, int] = {}
+    for task in tasks:
+        counts[task.status] = counts.get(task.status, 0) + 1
+    summary = {
+        "started": started,
+        "finished": time.time(),
+        "seconds": round(time.time() - started, 3),
+        "parallel": args.parallel,
+        "counts": counts,
+        "tasks": [{**asdict(task), "seconds": round(task.seconds, 3)} for task in tasks],
+    }
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if interrupted:
+        return 130
+    # 下载完成但转码或校验失败的任务在wait_verification里已经改为failed
+    return 0 if counts.get(COMPLETED, 0) == len(tasks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,30 +20,16 @@ logger.add(
     rotation='00:00',
     retention='7 days',
     level='DEBUG',
-    enqueue=False,
+    # 写文件在loguru的后台线程里进行，读取子进程输出的循环不会被文件I/O拖慢
+    enqueue=True,
     format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}"
 )
 
 # 存储到变量中
+# 下载器、域名、代理等可热更新的配置不在这里固定，通过 src/config_service.py 获取
 save_path = configs["SavePath"]
 downloaded_path = configs["DBPath"]
 queue_path = configs["QueuePath"]
-myproxy = configs["Proxy"]
-isNeedVideoProxy = configs["IsNeedVideoProxy"]
-if myproxy == "":
-    myproxy = None
-sorted_downloaders = sorted(
-    [downloader for downloader in configs["Downloader"] if downloader["weight"] != 0],
-    key = lambda x : x["weight"],
-    reverse = True # 降序排序
-)
-print(sorted_downloaders)
-missAVDomain = ""
-for downloader in configs["Downloader"]:
-    if downloader["downloaderName"] == "MissAV":
-        missAVDomain = downloader["domain"]
-        break
-logger.info(f"missav domain: {missAVDomain}")
 # 确保目录存在
 os.makedirs(os.path.dirname(downloaded_path), exist_ok=True)
 os.makedirs(os.path.dirname(queue_path), exist_ok=True)
@@ -52,7 +38,9 @@ os.makedirs(save_path, exist_ok=True)
 # 初始化下载器
 download_tool = f"'{project_root}/tools/m3u8-Downloader-Go'"
 ffmpeg_tool = f"'ffmpeg'"
+ffprobe_tool = f"'ffprobe'"
 if platform.system() == 'Windows':
     print("platform: Windows")
     download_tool = rf"{project_root}/tools/m3u8-Downloader-Go.exe"
-    ffmpeg_tool = rf"{project_root}/tools/ffmpeg.exe"
\ No newline at end of file
+    ffmpeg_tool = rf"{project_root}/tools/ffmpeg.exe"
+    ffprobe_tool = rf"{project_root}/tools/ffprobe.exe"
\ No newline at end of file
@@ -1,5 +1,6 @@
 import sqlite3
-from typing import List
+import time
+from typing import List, Optional
 from .comm import *
 
 def initialize_db(db_path: str, table_name: str):
@@ -52,4 +53,68 @@ def find_in_db(bvid: str, db_path: str, table_name: str) -> bool:
         return False
     except Exception as e:
         print(f"发生错误: {e}")
-        return False
\ No newline at end of file
+        return False
+
+def initialize_metadata_db(db_path: str):
+    """元数据缓存表，按番号保存刮削结果(json)"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS Metadata (avid TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)''')
+    conn.commit()
+    conn.close()
+
+def save_metadata(avid: str, data: dict, db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('INSERT OR REPLACE INTO Metadata (avid, data, updated) VALUES (?, ?, ?)',
+                     (avid, json.dumps(data, ensure_ascii=False), time.time()))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"保存元数据时出错: {e}")
+    finally:
+        conn.close()
+
+def load_metadata(avid: str, db_path: str) -> Optional[dict]:
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('SELECT data FROM Metadata WHERE avid = ? LIMIT 1', (avid,)).fetchone()
+        return json.loads(row[0]) if row else None
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"读取元数据时出错: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def initialize_subscription_db(db_path: str):
+    """订阅的轮询状态：ETag/Last-Modified 和上次看到的最新番号（高水位）"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS Subscriptions (
+        name TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, high_water TEXT, last_poll REAL, last_added INTEGER)''')
+    conn.commit()
+    conn.close()
+
+def load_subscription_state(name: str, db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('SELECT etag, last_modified, high_water, last_poll, last_added FROM Subscriptions WHERE name = ?',
+                           (name,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return {"etag": "", "last_modified": "", "high_water": [], "last_poll": 0, "last_added": 0}
+    return {"etag": row[0] or "", "last_modified": row[1] or "", "high_water": json.loads(row[2] or "[]"),
+            "last_poll": row[3] or 0, "last_added": row[4] or 0}
+
+def save_subscription_state(name: str, state: dict, db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('INSERT OR REPLACE INTO Subscriptions (name, etag, last_modified, high_water, last_poll, last_added) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     (name, state["etag"], state["last_modified"], json.dumps(state["high_water"]),
+                      state["last_poll"], state["last_added"]))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"保存订阅状态时出错: {e}")
+    finally:
+        conn.close()
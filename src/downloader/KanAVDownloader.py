@@ -6,6 +6,13 @@ from loguru import logger
 import re
 
 from src.downloader.downloaderBase import Downloader, AVDownloadInfo
+from src.util.fetch_cache import cache_ttl
+
+# 预编译的正则，解析每个页面时复用
+_PLAY_URL_PATTERN = re.compile(r'href="(/index\.php/vod/play[^"]*\.html)"')
+_ENCODED_URL_PATTERN = re.compile(r'"url":"([A-Za-z0-9]*)"')
+# 搜索页/列表页中的播放链接，group(2)里有title属性和标题（含番号）
+_PLAY_LINK_PATTERN = re.compile(r'<a[^>]*href="(/index\.php/vod/play[^"]*\.html)"(.*?)</a>', re.DOTALL)
 
 
 class KanAVDownloader(Downloader):
@@ -16,33 +23,46 @@ class KanAVDownloader(Downloader):
         return "KanAV"
 
     def getHTML(self, avid: str) -> Optional[str]:
-        """需要先搜索，获取到详情页url"""
+        """需要先搜索，获取到详情页url；搜索索引里有这个番号时跳过搜索"""
+        if playPath := self.lookupIndex(avid):
+            content = self._fetch_html(f"https://{self.domain}{playPath}")
+            if content and _ENCODED_URL_PATTERN.search(content):
+                return content
+            logger.info(f"搜索索引中的地址已失效: {avid} -> {playPath}")
+            self.removeIndex(avid)
+
         searchUrl = f"https://kanav.info/index.php/vod/search.html?wd={avid}&by=time_add"
         logger.debug(searchUrl)
-        content = self._fetch_html(searchUrl)
+        # 同一番号的搜索结果短期缓存，重试和并发任务不重复搜索
+        content = self._fetch_html(searchUrl, cache_ttl=cache_ttl("searchTTL", 300))
         if not content: return None
 
-        pageUrl = None  # 初始化为默认值
-        match = re.search(r'href="(/index\.php/vod/play[^"]*\.html)"', content)
-        if match:
-            pageUrl = f"https://{self.domain}{match.group(1)}"
-            logger.info(pageUrl)
-        if not pageUrl:
+        # 精确匹配番号的结果优先，没有时沿用第一个结果
+        playPath = self.indexLinks(content).get(avid.upper())
+        match = _PLAY_URL_PATTERN.search(content)
+        if not playPath and match:
+            playPath = match.group(1)
+        if not playPath:
             return None
+        pageUrl = f"https://{self.domain}{playPath}"
+        logger.info(pageUrl)
 
         content = self._fetch_html(pageUrl)
         if content: return content
         return None
 
+    def getLinkPattern(self) -> Optional["re.Pattern[str]"]:
+        return _PLAY_LINK_PATTERN
+
     def parseHTML(self, html: str) -> Optional[AVDownloadInfo]:
         downloadInfo = AVDownloadInfo()
 
-        match = re.search(r'"url":"([A-Za-z0-9]*)"', html)
+        match = _ENCODED_URL_PATTERN.search(html)
         if match:
             encoded_url = match.group(1)
-            logger.debug("URL before decode:", encoded_url)
+            logger.debug(f"URL before decode: {encoded_url}")
             final_url = unquote(base64.b64decode(encoded_url).decode('utf-8'))
-            logger.debug("URL after decode:", final_url)
+            logger.debug(f"URL after decode: {final_url}")
             downloadInfo.m3u8 = final_url
         else:
             logger.error("未找到URL")
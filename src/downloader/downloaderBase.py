@@ -1,14 +1,32 @@
 # doc: 定义下载类的基础操作
+import html as htmllib
+import re
+import shutil
 import subprocess
+import threading
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, List, Optional
 
 from curl_cffi import requests
 
 from src.comm import *
-from src.util.request_handler import RequestHandler, CFHandler
+from src.config_service import config_service
+from src.util.browser_func import CapturedStream
+from src.util.cancel import CancelToken, TaskCancelled
+from src.util.fetch_cache import ResponseCache
+from src.util.hls import (
+    MasterPlaylist, MediaPlaylist, VariantPolicy, estimate_size, is_master_playlist,
+    parse_master_playlist, parse_media_playlist, playlist_cache, select_variant
+)
+from src.util.log_throttle import ThrottledOutput, progress_interval
+from src.util.media import SegmentInfo, SegmentManifest, manifest_path
+from src.util.profiler import stage
+from src.util.proxy_pool import PLAYLIST, SEGMENT, get_proxy_pool
+from src.util.request_handler import RequestHandler, CFHandler, StreamMatcher
+from src.util.search_index import extract_links, get_search_index
+from src.util.segment_downloader import SegmentDownloader, SegmentSource
 
 
 # 下载信息，只保留最基础的信息。只需要填写avid，其他字段用于调试，选填
@@ -38,11 +56,53 @@ class AVDownloadInfo:
             logger.error(f"JSON序列化失败: {str(e)}")
             return False
 
+# 刮削出的元数据，用于生成NFO和封面
+@dataclass
+class AVMetadata:
+    avid: str = ""
+    title: str = ""
+    plot: str = ""
+    premiered: str = ""
+    cover: str = ""
+    url: str = ""
+    actors: List[str] = field(default_factory=list)
+    tags: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "AVMetadata":
+        return cls(**{k: v for k, v in data.items() if k in cls.__dataclass_fields__})
+
+# <meta property="og:xxx" content="..."> / <meta name="..." content="...">，属性顺序不固定
+_META_PATTERN = re.compile(r'<meta\s+(?:property|name)="([^"]+)"\s+content="([^"]*)"', re.IGNORECASE)
+_CANONICAL_PATTERN = re.compile(r'<link\s+rel="canonical"\s+href="([^"]+)"', re.IGNORECASE)
+
+# 浏览器捕获到的播放列表请求头（Referer、Cookie等），按media playlist地址保存，下载分片时带上
+_stream_headers = ResponseCache(maxsize=256)
+_STREAM_HEADERS_TTL = 6 * 3600
+
+# 浏览器捕获的播放列表里可能有广告、预览片段。页面标了时长时，正片时长和它的差距不超过这个比例（至少60秒）；
+# 页面没有时长时，短于_MIN_STREAM_DURATION秒的不当作正片
+_DURATION_TOLERANCE = 0.1
+_MIN_STREAM_DURATION = 120
+
+
+def _page_duration(html: str) -> float:
+    """详情页<head>里 og:video:duration / video:duration 标注的时长（秒），没有则返回0"""
+    head_end = html.find("</head>")
+    for key, value in _META_PATTERN.findall(html[:head_end] if head_end != -1 else html):
+        if key.lower() in ("og:video:duration", "video:duration"):
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 0.0
+
+
 class Downloader(ABC):
     """
     使用方式：
     1. downloadInfo生成元数据，并序列化到download_info.json
-    2. downloadM3u8下载视频并转成mp4格式
+    2. downloadM3u8下载视频流，转mp4由 postprocess_service 完成
     """
     def __init__(self, path: str, proxy = None, timeout = 15):
         """
@@ -59,6 +119,8 @@ class Downloader(ABC):
         # 初始化请求处理器
         self.request_handler = RequestHandler()
         self.cf_handler = CFHandler()
+        # 下载器在多个任务间复用，浏览器捕获的播放列表按线程记录，由resolveM3u8取用
+        self._captured = threading.local()
 
     def setDomain(self, domain: str) -> bool:
         if domain:
@@ -83,31 +145,164 @@ class Downloader(ABC):
         """
         pass
 
-    def downloadDirect(self, avid: str, current_processes=None) -> bool:
-        '''直接下载视频，不保存元数据'''
-        # 获取html
+    def parseMetadata(self, html: str) -> Optional[AVMetadata]:
+        """
+        可选实现：从详情页解析NFO用的元数据。默认读取<head>里的OG标签，
+        所以流式获取时提前结束的页面也能用
+        """
+        head_end = html.find("</head>")
+        head = html[:head_end] if head_end != -1 else html
+        metadata = AVMetadata()
+        for key, value in _META_PATTERN.findall(head):
+            key, value = key.lower(), htmllib.unescape(value).strip()
+            if not value:
+                continue
+            if key == "og:title":
+                metadata.title = value
+            elif key in ("og:description", "description") and not metadata.plot:
+                metadata.plot = value
+            elif key == "og:image" and not metadata.cover:
+                metadata.cover = value
+            elif key == "og:url":
+                metadata.url = value
+            elif key in ("og:video:release_date", "video:release_date"):
+                metadata.premiered = value[:10]
+            elif key in ("og:video:actor", "video:actor"):
+                metadata.actors.append(value)
+            elif key in ("og:video:tag", "video:tag"):
+                metadata.tags.append(value)
+        if not metadata.url and (canonical := _CANONICAL_PATTERN.search(head)):
+            metadata.url = canonical.group(1)
+        return metadata if metadata.title else None
+
+    def resolveM3u8(self, avid: str, on_html: Optional[Callable[[str], None]] = None,
+                    cancel: Optional[CancelToken] = None) -> Optional[str]:
+        """
+        获取html并解析出要下载的media playlist地址
+        :on_html: 拿到详情页后的回调，元数据刮削复用这份html，不再重复请求
+        :cancel: 每个阶段结束后检查，任务已停止时抛出TaskCancelled
+        """
+        cancel = cancel or CancelToken()
         avid = avid.upper()
-        os.makedirs(os.path.join(self.path, avid), exist_ok=True)
-
         logger.info("正在获取视频信息...")
 
-        html = self.getHTML(avid)
+        self._captured.streams = []
+        with stage(f"downloadDirect.getHTML.{self.getDownloaderName()}"):
+            html = self.getHTML(avid)
+        streams: List[CapturedStream] = self._captured.streams
+        self._captured.streams = None
+        cancel.check()
         if not html:
             logger.error("获取html失败")
-            return False
+            return None
+        if on_html is not None:
+            on_html(html)
+
+        # 走了浏览器模式时，播放器请求的播放列表就是要找的地址，不用再从html里解析。
+        # 请求播放列表和分片时带上浏览器当时发送的请求头；广告、预览这类时长对不上的播放列表跳过
+        expected = _page_duration(html) if streams else 0.0
+        for stream in streams:
+            if stream.headers:
+                _stream_headers.put(stream.url, stream.headers, _STREAM_HEADERS_TTL)
+            with stage("downloadDirect.resolveVariant"):
+                m3u8 = self.resolveVariant(stream.url)
+            cancel.check()
+            if m3u8 and self._is_main_stream(m3u8, expected):
+                logger.info(f"使用浏览器捕获的播放列表: {stream.url}")
+                return m3u8
 
         # 从html中解析m3u8链接
         logger.info("视频信息获取成功，正在解析m3u8链接...")
 
-        info = self.parseHTML(html)
+        with stage(f"downloadDirect.parseHTML.{self.getDownloaderName()}"):
+            info = self.parseHTML(html)
         if info is None or not info.m3u8:
             logger.error("解析m3u8链接失败")
+            return None
+
+        # master playlist按策略选择清晰度
+        with stage("downloadDirect.resolveVariant"):
+            m3u8 = self.resolveVariant(info.m3u8)
+        cancel.check()
+        if not m3u8:
+            logger.error("选择清晰度失败")
+            return None
+        return m3u8
+
+    def getStreamMatcher(self) -> Optional[StreamMatcher]:
+        """
+        可选实现：返回详情页的流式匹配器（每次返回新的实例）。
+        传给 _fetch_html 后，页面下载到匹配的位置就断开连接，不再下载剩余内容
+        """
+        return None
+
+    def getLinkPattern(self) -> Optional["re.Pattern[str]"]:
+        """
+        可选实现：需要先搜索的站点，返回搜索页/列表页中视频链接的正则，
+        group(1)是站内地址或视频id，group(2)是<a>标签剩余的属性和内容（从中查找番号）。
+        返回None表示不使用搜索索引
+        """
+        return None
+
+    def lookupIndex(self, avid: str) -> Optional[str]:
+        """从搜索索引查找番号对应的站内地址，找到就不用再搜索"""
+        index = get_search_index()
+        if index is None or self.getLinkPattern() is None:
+            return None
+        target = index.lookup(self.getDownloaderName(), avid)
+        if target:
+            logger.info(f"搜索索引命中: {avid} -> {target}")
+        return target
+
+    def removeIndex(self, avid: str):
+        """索引中的地址已失效"""
+        if (index := get_search_index()) is not None:
+            index.remove(self.getDownloaderName(), avid)
+
+    def indexLinks(self, html: str) -> Dict[str, str]:
+        """记录页面上所有结果（包括不是本次要找的番号），返回 {番号: 站内地址}"""
+        pattern = self.getLinkPattern()
+        if pattern is None:
+            return {}
+        links = extract_links(html, pattern)
+        if (index := get_search_index()) is not None and links:
+            index.add_many(self.getDownloaderName(), links)
+            logger.debug(f"搜索索引新增 {len(links)} 条 ({self.getDownloaderName()})")
+        return links
+
+    def crawlListing(self, url: str) -> int:
+        """抓取列表页（如片商、分类页）填充搜索索引，返回记录的条数"""
+        content = self._fetch_html(url)
+        return len(self.indexLinks(content)) if content else 0
+
+    def downloadDirect(self, avid: str, cancel: Optional[CancelToken] = None, mirrors=None,
+                       on_html: Optional[Callable[[str], None]] = None, m3u8: Optional[str] = None) -> bool:
+        '''
+        直接下载视频，元数据由 on_html 回调交给 metadata_service 并行处理
+        :cancel: 停止任务时结束下载进程、断开分片连接，抛出TaskCancelled
+        :mirrors: 其他下载器解析出的同一视频(SegmentSource)，分片下载失败时用于切换
+        :m3u8: 已经解析好的地址（预解析），传入时不再获取详情页
+        '''
+        cancel = cancel or CancelToken()
+        cancel.check()
+        avid = avid.upper()
+        os.makedirs(os.path.join(self.path, avid), exist_ok=True)
+
+        if not m3u8:
+            m3u8 = self.resolveM3u8(avid, on_html, cancel)
+        if not m3u8:
             return False
 
         # 直接下载m3u8
-        logger.info(f"找到m3u8链接，开始下载: {info.m3u8}")
+        logger.info(f"找到m3u8链接，开始下载: {m3u8}")
+
+        return self.downloadM3u8(m3u8, avid, cancel, mirrors)
 
-        return self.downloadM3u8(info.m3u8, avid, current_processes)
+    def getSegmentSource(self, url: str) -> SegmentSource:
+        headers = {"Referer": f"http://{self.domain}"}
+        # 浏览器捕获的地址带上浏览器实际发送的请求头
+        headers.update(_stream_headers.get(url) or {})
+        return SegmentSource(url=url, headers=headers, name=self.getDownloaderName())
 
     def downloadInfo(self, avid:str) -> Optional[AVDownloadInfo]:
         """将元数据download_info.json序列化到到对应位置，同时返回AVDownloadInfo"""
@@ -134,163 +329,210 @@ class Downloader(ABC):
 
         return info
 
-    def downloadM3u8(self, url: str, avid: str, current_processes=None) -> bool:
-        """m3u8视频下载"""
+    def downloadM3u8(self, url: str, avid: str, cancel: Optional[CancelToken] = None, mirrors=None) -> bool:
+        """
+        下载m3u8视频流到 {avid}.ts，同时生成分片清单 {avid}.ts.manifest.json
+        转码由 postprocess_service 完成，下载线程不用等待
+        """
+        cancel = cancel or CancelToken()
         os.makedirs(os.path.dirname(os.path.join(self.path, avid)), exist_ok=True)
+        ts_path = os.path.join(self.path, avid, avid + '.ts')
         try:
             logger.info("开始下载视频流……")
-            if isNeedVideoProxy and self.proxy:
-                logger.info("使用代理")
-                command = f"{download_tool} -u {url} -o {os.path.join(self.path, avid, avid+'.ts')} -p {self.proxy} -H Referer:http://{self.domain}"
+            with stage("downloadDirect.download"):
+                if config_service.current().SegmentDownloader.get("enable", False):
+                    ok = self._downloadSegments(url, avid, mirrors, cancel)
+                    if not ok:
+                        logger.error("下载失败")
+                else:
+                    ok = self._downloadWithTool(url, avid, cancel)
+            cancel.check()
+            if not ok:
+                return False
+            if not os.path.exists(manifest_path(ts_path)):
+                self._writeManifest(url, ts_path)
+            logger.info("视频流下载完成")
+            return True
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"下载过程异常：{e}")
+            return False
+
+    def _writeManifest(self, url: str, ts_path: str):
+        """下载工具合并的ts没有分片位置，只记录EXTINF时长用于校验"""
+        playlist = playlist_cache.get_or_load(url, self._load_playlist)
+        if not isinstance(playlist, MediaPlaylist):
+            return
+        SegmentManifest(
+            url=url,
+            headers=self.getSegmentSource(url).headers,
+            name=self.getDownloaderName(),
+            segments=[SegmentInfo(seg.duration) for seg in playlist.segments],
+        ).save(manifest_path(ts_path))
+
+    def _downloadWithTool(self, url: str, avid: str, cancel: CancelToken) -> bool:
+        """使用m3u8-Downloader-Go下载整个视频流，失败后换代理池里的下一条线路再试一次"""
+        # 难顶。。。使用代理下载失败，尝试不用代理；不用代理下载失败，尝试使用代理
+        for attempt, proxy in enumerate(get_proxy_pool().candidates(url, SEGMENT)[:2]):
+            if attempt > 0:
+                logger.info("第一次下载失败，尝试备用方案...")
+            if proxy:
+                logger.info(f"使用代理: {proxy}")
+                command = f"{download_tool} -u {url} -o {os.path.join(self.path, avid, avid+'.ts')} -p {proxy} -H Referer:http://{self.domain}"
             else:
                 logger.info("不使用代理")
                 command = f"{download_tool} -u {url} -o {os.path.join(self.path, avid, avid+'.ts')} -H Referer:http://{self.domain}"
             logger.debug(f"执行命令: {command}")
 
-            # 使用subprocess运行命令并捕获输出
-            process = subprocess.Popen(
+            # 使用subprocess运行命令并捕获输出，下载工具在独立的进程组里，停止任务时整组结束
+            with cancel.process(
                 command,
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
                 universal_newlines=True,
                 bufsize=1
-            )
-            # 保存进程引用以便可以停止它
-            if current_processes is not None:
-                current_processes.append(process)
-            # 实时读取输出
-            for line in iter(process.stdout.readline, ''):
-                if line.strip():
-                    logger.info(f"[下载工具] {line.strip()}")
-
-            process.stdout.close()
-            return_code = process.wait()
-
-            if current_processes is not None and process in current_processes:
-                current_processes.remove(process)
-
-            if return_code != 0:
-                # 难顶。。。使用代理下载失败，尝试不用代理；不用代理下载失败，尝试使用代理
-                # 下载失败，尝试备用方案
-                logger.info("第一次下载失败，尝试备用方案...")
-
-                if not isNeedVideoProxy and self.proxy:
-                    logger.info("尝试使用代理")
-                    command = f"{download_tool} -u {url} -o {os.path.join(self.path, avid, avid + '.ts')} -p {self.proxy} -H Referer:http://{self.domain}"
-                else:
-                    logger.info("尝试不使用代理")
-                    command = f"{download_tool} -u {url} -o {os.path.join(self.path, avid, avid+'.ts')} -H Referer:http://{self.domain}"
-                logger.debug(f"重试命令 {command}")
-
-                # 再次尝试
-                process = subprocess.Popen(
-                    command,
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    universal_newlines=True,
-                    bufsize=1
-                )
-                # 保存进程引用以便可以停止它
-                if current_processes is not None:
-                    current_processes.append(process)
-                # 实时读取输出
+            ) as process:
+                # 实时读取输出，进度行按间隔合并
+                output = ThrottledOutput(lambda text: logger.info(f"[下载工具] {text}"), progress_interval())
                 for line in iter(process.stdout.readline, ''):
-                    if line.strip():
-                        logger.info(f"[下载工具] {line.strip()}")
+                    output.feed(line)
+                output.close()
 
                 process.stdout.close()
                 return_code = process.wait()
 
-                # 从进程列表中移除
-                if current_processes is not None and process in current_processes:
-                    current_processes.remove(process)
+            # 被停止时不再换线路重试
+            cancel.check()
+            if return_code == 0:
+                get_proxy_pool().report(proxy, True)
+                return True
+            # 下载工具失败分不清是线路还是源站的问题，不计入线路状态，只换下一条线路
 
-                if return_code != 0:
-                    logger.error("下载失败")
-                    return False
+        logger.error("下载失败")
+        return False
 
-            logger.info("视频流下载完成，开始转码为MP4")
+    def _downloadSegments(self, url: str, avid: str, mirrors=None, cancel: Optional[CancelToken] = None) -> bool:
+        """进程内分片下载，分片失败时指数退避重试，仍失败则剩余分片切换到mirrors"""
+        downloader = SegmentDownloader.from_config(config_service.current().SegmentDownloader)
+        ts_path = os.path.join(self.path, avid, avid + '.ts')
+        return downloader.download(self.getSegmentSource(url), ts_path, mirrors, cancel)
 
-            # 转mp4
-            convert = f"{ffmpeg_tool} -i {os.path.join(self.path, avid, avid+'.ts')} -c copy -f mp4 {os.path.join(self.path, avid, avid+'.mp4')}"
-            logger.debug(f"转码命令: {convert}")
 
-            # 使用subprocess运行ffmpeg并捕获输出
-            process = subprocess.Popen(
-                convert,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
-            )
-            # 保存进程引用以便可以停止它
-            if current_processes is not None:
-                current_processes.append(process)
-            # 实时读取ffmpeg输出
-            for line in iter(process.stdout.readline, ''):
-                if line.strip():
-                    logger.info(f"[FFmpeg] {line.strip()}")
-
-            process.stdout.close()
-            return_code = process.wait()
-
-            # 从进程列表中移除
-            if current_processes is not None and process in current_processes:
-                current_processes.remove(process)
-
-            if return_code != 0:
-                logger.error("转码失败")
-                return False
+    def resolveVariant(self, url: str) -> Optional[str]:
+        """
+        如果url是master playlist，按配置的策略选择清晰度，返回media playlist地址；
+        已经是media playlist则原样返回。解析结果有缓存，重试时不会重复请求
+        """
+        playlist = playlist_cache.get_or_load(url, self._load_playlist)
+        if playlist is None:
+            logger.error(f"获取播放列表失败: {url}")
+            return None
+        if isinstance(playlist, MediaPlaylist):
+            return url
 
-            logger.info("转码完成，清理临时文件...")
-            ts_path = os.path.join(self.path, avid, avid+'.ts')
-            try:
-                if os.path.exists(ts_path):
-                    os.remove(ts_path)
-                    logger.info("临时文件清理完成")
-            except Exception as e:
-                logger.warning(f"清理临时文件失败：{e}")
-
-            # 检查最终mp4文件是否存在
-            mp4_path = os.path.join(self.path, avid, avid+'.mp4')
-            if os.path.exists(mp4_path):
-                logger.info("下载完成")
-                return True
-            else:
-                logger.error("MP4文件未生成")
+        if not playlist.variants:
+            logger.error("master playlist中没有可用的清晰度")
+            return None
+        # 浏览器捕获的master playlist，各清晰度的请求沿用它的请求头
+        if headers := _stream_headers.get(url):
+            for v in playlist.variants:
+                _stream_headers.put(v.url, headers, _STREAM_HEADERS_TTL)
+        logger.debug([(v.bandwidth, v.resolution, v.url) for v in playlist.variants])
+
+        policy = VariantPolicy.from_config(config_service.current().VariantPolicy)
+        duration = 0.0
+        if policy.mode == "size_budget":
+            # 各清晰度片长一致，取任意一个media playlist计算总时长
+            media = playlist_cache.get_or_load(playlist.variants[0].url, self._load_playlist)
+            duration = media.total_duration if isinstance(media, MediaPlaylist) else 0.0
+
+        variant = select_variant(playlist.variants, policy, duration)
+        logger.info(f"清晰度策略: {policy.mode}, 选择: {variant.resolution} {variant.bandwidth}bps")
+
+        # 预估体积，磁盘空间不够就不要开始下载了
+        media = playlist_cache.get_or_load(variant.url, self._load_playlist)
+        if isinstance(media, MediaPlaylist) and variant.bandwidth:
+            estimated = estimate_size(variant, media.total_duration)
+            free = shutil.disk_usage(self.path).free
+            logger.info(f"片长: {media.total_duration:.0f}s, 预估大小: {estimated / 1024 / 1024:.0f}MB")
+            # 下载的ts和转出的mp4会同时存在
+            if estimated * 2 > free:
+                logger.error(f"磁盘空间不足，需要约 {estimated * 2 / 1024 / 1024:.0f}MB，剩余 {free / 1024 / 1024:.0f}MB")
+                return None
+
+        return variant.url
+
+    def _is_main_stream(self, url: str, expected: float) -> bool:
+        """
+        检查media playlist是不是正片：要有分片，总时长和页面标注的时长expected相符；
+        页面没有标注时长（expected为0）时不能太短
+        """
+        media = playlist_cache.get_or_load(url, self._load_playlist)
+        if not isinstance(media, MediaPlaylist) or not media.segments:
+            logger.warning(f"跳过没有分片的播放列表: {url}")
+            return False
+        duration = media.total_duration
+        if expected > 0:
+            if abs(duration - expected) > max(60.0, expected * _DURATION_TOLERANCE):
+                logger.warning(f"跳过时长不符的播放列表({duration:.0f}s，页面标注{expected:.0f}s): {url}")
                 return False
-        except Exception as e:
-            logger.error(f"下载过程异常：{e}")
+        elif duration < _MIN_STREAM_DURATION:
+            logger.warning(f"跳过时长过短的播放列表({duration:.0f}s): {url}")
             return False
+        return True
+
+    def _load_playlist(self, url: str) -> Optional[object]:
+        """请求并解析播放列表，返回 MasterPlaylist 或 MediaPlaylist。和分片一样带上站点的Referer等请求头"""
+        content_bytes = self.request_handler.get(url, kind=PLAYLIST, headers=self.getSegmentSource(url).headers)
+        if not content_bytes:
+            return None
+        text = content_bytes.decode('utf-8', errors='ignore')
+        if "#EXTM3U" not in text:
+            logger.error(f"不是有效的m3u8: {url}")
+            return None
+        if is_master_playlist(text):
+            return parse_master_playlist(text, url)
+        return parse_media_playlist(text, url)
 
-    def _fetch_html(self, url: str, referer: str = "") -> Optional[str]:
-        """使用新的请求处理器获取HTML内容"""
+    def _fetch_html(self, url: str, referer: str = "", matcher: Optional[StreamMatcher] = None,
+                    cache_ttl: float = 0) -> Optional[str]:
+        """
+        使用新的请求处理器获取HTML内容
+        :matcher: 传入时使用流式请求，匹配到后提前结束，返回的是页面开头到匹配位置的内容
+        :cache_ttl: 大于0时短期缓存页面（秒），用于搜索页
+        """
         logger.debug(f"fetch url: {url}")
 
         # 首先尝试使用普通请求处理器
-        content_bytes = self.request_handler.get(url)
+        if matcher is not None:
+            content_bytes = self.request_handler.get_until(url, matcher)
+        else:
+            content_bytes = self.request_handler.get(url, cache_ttl=cache_ttl)
         if content_bytes:
             content = content_bytes.decode('utf-8', errors='ignore')
             # 检查是否触发了Cloudflare验证
             if "Just a moment" in content or "Checking your browser" in content:
                 logger.info("检测到Cloudflare验证，切换到浏览器模式...")
                 # 使用浏览器模式绕过Cloudflare
-                content_bytes = self.cf_handler.get(url)
-                if content_bytes:
-                    return content_bytes.decode('utf-8', errors='ignore')
-                else:
+                content = self._fetch_browser(url, cache_ttl)
+                if content is None:
                     logger.error("浏览器模式获取内容失败")
-                    return None
             return content
         else:
             logger.info("普通请求失败，尝试使用浏览器模式...")
             # 普通请求失败，尝试浏览器模式
-            content_bytes = self.cf_handler.get(url)
-            if content_bytes:
-                return content_bytes.decode('utf-8', errors='ignore')
-            else:
+            content = self._fetch_browser(url, cache_ttl)
+            if content is None:
                 logger.error("所有请求方式都失败")
-                return None
\ No newline at end of file
+            return content
+
+    def _fetch_browser(self, url: str, cache_ttl: float = 0) -> Optional[str]:
+        """浏览器获取页面，捕获到的播放列表请求记录到当前线程，由resolveM3u8优先使用"""
+        page = self.cf_handler.get_page(url, cache_ttl)
+        if page is None:
+            return None
+        if page.streams and getattr(self._captured, "streams", None) is not None:
+            self._captured.streams.extend(page.streams)
+        return page.content
\ No newline at end of file
@@ -3,8 +3,15 @@ from typing import Optional
 from loguru import logger
 
 from src.downloader.downloaderBase import Downloader, AVDownloadInfo
+from src.util.fetch_cache import cache_ttl
 import re
 
+# 预编译的正则，解析每个页面时复用
+_VIDEO_ID_PATTERN = re.compile(r'[?&]id=(\d+)')
+_VIDEO_SRC_PATTERN = re.compile(r'var videoSrc\s*=\s*"([^"]+)"')
+# 搜索页/列表页中的视频链接，group(2)里有标题（含番号）
+_VIDEO_LINK_PATTERN = re.compile(r'<a[^>]*href="[^"]*[?&]id=(\d+)"(.*?)</a>', re.DOTALL)
+
 
 class HohoJDownloader(Downloader):
     def __init__(self, path: str, proxy = None, timeout = 15):
@@ -14,22 +21,37 @@ class HohoJDownloader(Downloader):
         return "HohoJ"
 
     def getHTML(self, avid: str) -> Optional[str]:
-        """需要先搜索，获取到详情页url"""
+        """需要先搜索，获取到详情页url；搜索索引里有这个番号时跳过搜索"""
+        if first_id := self.lookupIndex(avid):
+            content = self._fetch_embed(first_id)
+            if content and _VIDEO_SRC_PATTERN.search(content):
+                return content
+            logger.info(f"搜索索引中的地址已失效: {avid} -> {first_id}")
+            self.removeIndex(avid)
+
         searchUrl = f"https://hohoj.tv/search?text={avid}"
         logger.debug(f"searchUrl: {searchUrl}")
-        content = self._fetch_html(searchUrl)
+        # 同一番号的搜索结果短期缓存，重试和并发任务不重复搜索
+        content = self._fetch_html(searchUrl, cache_ttl=cache_ttl("searchTTL", 300))
         if not content: return None
 
-        first_id = None # 初始化为默认值
-        match = re.search(r'[?&]id=(\d+)', content)
-        if match:
+        # 精确匹配番号的结果优先，没有时沿用第一个结果
+        first_id = self.indexLinks(content).get(avid.upper())
+        match = _VIDEO_ID_PATTERN.search(content)
+        if not first_id and match:
             first_id = match.group(1)
-            logger.info(f"first_id: {first_id}")
         if not first_id:
             return None
-        videoUrl = f"https://hohoj.tv/embed?id={first_id}"
+        logger.info(f"first_id: {first_id}")
+        return self._fetch_embed(first_id)
+
+    def getLinkPattern(self) -> Optional["re.Pattern[str]"]:
+        return _VIDEO_LINK_PATTERN
+
+    def _fetch_embed(self, video_id: str) -> Optional[str]:
+        videoUrl = f"https://hohoj.tv/embed?id={video_id}"
         logger.debug(f"videoUrl: {videoUrl}")
-        content = self._fetch_html(videoUrl, referer=f"https://hohoj.tv/video?id={first_id}")
+        content = self._fetch_html(videoUrl, referer=f"https://hohoj.tv/video?id={video_id}")
         if not content: return None
         return content
 
@@ -37,7 +59,7 @@ class HohoJDownloader(Downloader):
         downlondInfo = AVDownloadInfo()
 
         # 提取m3u8
-        match = re.search(r'var videoSrc\s*=\s*"([^"]+)"', html)
+        match = _VIDEO_SRC_PATTERN.search(html)
         if match:
             downlondInfo.m3u8 = match.group(1)
             logger.info(downlondInfo.m3u8)
@@ -1,6 +1,12 @@
 from .downloaderBase import *
 import re
 
+# 预编译的正则，解析每个页面时复用
+_HLS_URL_PATTERN = re.compile(r"var hlsUrl = '(https?://[^']+)'")
+_HLS_URL_PATTERN_BYTES = re.compile(_HLS_URL_PATTERN.pattern.encode())
+_OG_TITLE_PATTERN = re.compile(r'<meta property="og:title" content="([^"]+)"')
+_CODE_PATTERN = re.compile(r'([A-Z]+(?:-[A-Z]+)*-\d+)')
+
 class JableDownloader(Downloader):
     def getDownloaderName(self) -> str:
         return "Jable"
@@ -9,17 +15,19 @@ class JableDownloader(Downloader):
         '''需要实现的方法：根据avid，构造url并请求，获取html, 返回字符串'''
         url = f'https://{self.domain}/videos/{avid}/'.lower()
         logger.debug(url)
-        content = self._fetch_html(url)
+        content = self._fetch_html(url, matcher=self.getStreamMatcher())
         if content: return content
         return None
 
+    def getStreamMatcher(self) -> Optional[StreamMatcher]:
+        return StreamMatcher(_HLS_URL_PATTERN_BYTES)
+
     def parseHTML(self, html: str) -> Optional[AVDownloadInfo]:
         '''需要实现的方法：根据html，解析出元数据，返回AVMetadata'''
         missavMetadata = AVDownloadInfo()
 
         # 1. 提取m3u8
-        pattern = r"var hlsUrl = '(https?://[^']+)'"
-        match = re.search(pattern, html)
+        match = _HLS_URL_PATTERN.search(html)
         if match:
             missavMetadata.m3u8 = match.group(1)
             logger.info(missavMetadata.m3u8)
@@ -36,12 +44,13 @@ class JableDownloader(Downloader):
     @staticmethod
     def _extract_metadata(html: str, metadata: AVDownloadInfo) -> bool:
         try:
-            # 提取OG标签
-            og_title = re.search(r'<meta property="og:title" content="([^"]+)"', html)
+            # 提取OG标签，OG标签都在<head>里，不用扫描整个页面
+            head_end = html.find("</head>")
+            og_title = _OG_TITLE_PATTERN.search(html, 0, head_end if head_end != -1 else len(html))
 
             if og_title: # 处理标题和番号
                 title_content = og_title.group(1)
-                if code_match := re.search(r'([A-Z]+(?:-[A-Z]+)*-\d+)', title_content):
+                if code_match := _CODE_PATTERN.search(title_content):
                     metadata.avid = code_match.group(1)
                     metadata.title = title_content.replace(metadata.avid, '').strip()
                 else:
@@ -2,6 +2,8 @@ from .downloaderBase import *
 import re
 from urllib.parse import unquote
 
+_URL_PATTERN = re.compile(r'"url":"(https?%3A%2F%2F[^"]+)"')
+
 def decode_url(encoded_url):
     try:
         return unquote(encoded_url)
@@ -25,8 +27,7 @@ class MemoDownloader(Downloader):
         '''需要实现的方法：根据html，解析出元数据，返回AVMetadata'''
         logger.debug(html)
         missavMetadata = AVDownloadInfo()
-        pattern = r'"url":"(https?%3A%2F%2F[^"]+)"'
-        match = re.search(pattern, html)
+        match = _URL_PATTERN.search(html)
         if match:
             encoded_url = match.group(1)
             url = decode_url(encoded_url)
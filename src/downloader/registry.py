@@ -0,0 +1,89 @@
+# doc: 下载器注册表。扫描 src.downloader 包内的模块和 entry point 发现下载器，用到时才创建，之后一直复用；
+# 实例按(下载器名, 域名)缓存，域名在创建时绑定，不会被其他任务修改
+import importlib
+import inspect
+import pkgutil
+import threading
+from importlib import metadata
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+# 第三方下载器通过这个entry point组注册，名字就是下载器名，如：
+# [project.entry-points."nassavx.downloaders"]
+# MyAV = "my_package.my_downloader:MyAVDownloader"
+ENTRY_POINT_GROUP = "nassavx.downloaders"
+
+
+class DownloaderRegistry:
+    def __init__(self, path: str, proxy=None):
+        self.path = path
+        self.proxy = proxy
+        self._lock = threading.Lock()
+        self._factories: Optional[Dict[str, object]] = None  # 下载器名 -> 类 或 EntryPoint
+        self._instances: Dict = {}
+
+    def get(self, name: str, domain: str = ""):
+        """
+        获取绑定了domain的下载器，同一个下载器名和域名第一次获取时才创建。
+        预解析、备用源和命令行并行下载的任务可能使用不同的配置快照，各自拿到对应域名的实例，
+        正在运行的任务使用的域名和Referer不会被其他任务改掉
+        """
+        key = (name, domain)
+        if key in self._instances:
+            return self._instances[key]
+        with self._lock:
+            if key in self._instances:
+                return self._instances[key]
+            factory = self._discover().get(name)
+            if factory is None:
+                logger.error(f"未找到下载器: {name}")
+                return None
+            if isinstance(factory, metadata.EntryPoint):
+                factory = factory.load()
+            instance = factory(self.path, self.proxy)
+            instance.setDomain(domain)
+            self._instances[key] = instance
+            logger.debug(f"已创建下载器: {name} ({domain})")
+            return instance
+
+    def reset(self, path: str, proxy=None):
+        """保存路径或代理变化时丢弃已创建的下载器，之后按新配置重新创建"""
+        with self._lock:
+            self.path = path
+            self.proxy = proxy
+            self._instances = {}
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._discover())
+
+    def _discover(self) -> Dict[str, object]:
+        """只扫描一次，调用方需持有锁"""
+        if self._factories is not None:
+            return self._factories
+
+        from src import downloader as package
+        from src.downloader.downloaderBase import Downloader
+
+        factories = {}
+        for module_info in pkgutil.iter_modules(package.__path__):
+            if module_info.name in ("registry", "downloaderBase"):
+                continue
+            try:
+                module = importlib.import_module(f"{package.__name__}.{module_info.name}")
+            except Exception as e:
+                logger.error(f"加载下载器模块 {module_info.name} 失败: {e}")
+                continue
+            for _, cls in inspect.getmembers(module, inspect.isclass):
+                if issubclass(cls, Downloader) and not inspect.isabstract(cls) and cls.__module__ == module.__name__:
+                    # getDownloaderName只返回常量，不需要初始化实例就能拿到名字
+                    factories[cls.__new__(cls).getDownloaderName()] = cls
+
+        # entry point 只记录，不加载，用到时才导入
+        for entry_point in metadata.entry_points(group=ENTRY_POINT_GROUP):
+            factories.setdefault(entry_point.name, entry_point)
+
+        logger.debug(f"发现下载器: {list(factories)}")
+        self._factories = factories
+        return factories
@@ -1,33 +1,26 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 from src.comm import *
-from src.downloader.KanAVDownloader import KanAVDownloader
-from src.downloader.downloaderBase import Downloader
-from src.downloader.hohoJDownloader import HohoJDownloader
-from src.downloader.jableDownloader import JableDownloader
-from src.downloader.memoDownloader import MemoDownloader
-from src.downloader.missAVDownloader import MissAVDownloader
+from src.config_service import config_service
+from src.downloader.registry import DownloaderRegistry
 
+if TYPE_CHECKING:
+    from src.downloader.downloaderBase import Downloader
 
-class DownloaderMgr:
-    downloaders: dict = {}
+# 全局注册表，下载器按需创建并复用，不再每个任务都重新构造
+registry = DownloaderRegistry(config_service.latest().SavePath, config_service.latest().proxy)
 
-    def __init__(self):
-        """注册handler"""
-        downloader = MissAVDownloader(save_path, myproxy)
-        self.downloaders[downloader.getDownloaderName()] = downloader
 
-        downloader = JableDownloader(save_path, myproxy)
-        self.downloaders[downloader.getDownloaderName()] = downloader
+def _on_config_change(old, new):
+    if old.SavePath != new.SavePath or old.Proxy != new.Proxy:
+        os.makedirs(new.SavePath, exist_ok=True)
+        registry.reset(new.SavePath, new.proxy)
 
-        downloader = HohoJDownloader(save_path, myproxy)
-        self.downloaders[downloader.getDownloaderName()] = downloader
 
-        downloader = MemoDownloader(save_path, myproxy)
-        self.downloaders[downloader.getDownloaderName()] = downloader
+config_service.on_change(_on_config_change)
 
-        downloader = KanAVDownloader(save_path, myproxy)
-        self.downloaders[downloader.getDownloaderName()] = downloader
 
-    def GetDownloader(self, downloaderName: str) -> Optional[Downloader]:
-        return self.downloaders[downloaderName]
+class DownloaderMgr:
+    def GetDownloader(self, downloaderName: str, domain: str = "") -> Optional["Downloader"]:
+        """domain在创建时绑定，不要对返回的下载器调用setDomain，它可能正被其他任务使用"""
+        return registry.get(downloaderName, domain)
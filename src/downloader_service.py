@@ -1,49 +1,135 @@
 from . import data
 from . import downloaderMgr
 from .comm import *
+from .config_service import config_service
+from .lookahead_service import lookahead_service
+from .metadata_service import metadata_service
+from .postprocess_service import finish, postprocess_service
+from .task_store import record_downloaded, task_store
+from .util.cancel import CancelToken, TaskCancelled
+from .util.media import manifest_path
 
 
-def download_video(avid, force=False, current_processes=None):
-    """下载视频的主要函数"""
+def download_video(avid, force=False, cancel=None):
+    """
+    下载视频的主要函数
+    :cancel: CancelToken，停止任务时结束下载进程和分片连接，抛出TaskCancelled，不再尝试其他下载器
+    """
+    cancel = cancel or CancelToken()
+    # 整个任务使用开始时的配置快照，运行中修改配置只影响之后的任务
+    with config_service.snapshot() as cfg:
+        return _download_video(avid, cfg, force, cancel)
+
+
+def _download_video(avid, cfg, force=False, cancel=None):
     logger.info(f"开始下载: {avid}")
-    data.initialize_db(downloaded_path, "MissAV")
+    data.initialize_db(cfg.DBPath, "MissAV")
 
     # 检查是否已下载
-    if not force and data.find_in_db(avid, downloaded_path, "MissAV"):
+    if not force and data.find_in_db(avid, cfg.DBPath, "MissAV"):
         logger.info(f"{avid} 已存在于数据库中")
+        # 工作节点本机已经下载过，协调节点上还没有记录
+        record_downloaded(avid, cfg)
         return True
 
     mgr = downloaderMgr.DownloaderMgr()
     try:
+        sorted_downloaders = cfg.sorted_downloaders
         if not sorted_downloaders:
             raise ValueError(f"没有配置下载器: {sorted_downloaders}")
 
         # 检查是否已经存在MP4文件
-        mp4_path = os.path.join(save_path, avid, f"{avid}.mp4")
+        mp4_path = os.path.join(cfg.SavePath, avid, f"{avid}.mp4")
         if os.path.exists(mp4_path):
             logger.info(f"MP4文件已存在：{mp4_path}")
-            data.batch_insert_bvids([avid], downloaded_path, "MissAV")
+            finish(avid, cfg)
             return True
 
+        # 上次已经下载完（有分片清单），只是没有转码完成
+        ts_path = os.path.join(cfg.SavePath, avid, f"{avid}.ts")
+        if os.path.exists(ts_path) and os.path.exists(manifest_path(ts_path)):
+            logger.info(f"ts文件已下载完成，直接转码：{ts_path}")
+            if _postprocess(avid, cfg, cancel):
+                return True
+
         for i, it in enumerate(sorted_downloaders):
-            downloader = mgr.GetDownloader(it["downloaderName"])
-            if not downloader.setDomain(it["domain"]):
-                logger.error(f"下载器 {downloader.getDownloaderName()} 没有配置域名")
+            cancel.check()
+            if not it["domain"]:
+                logger.error(f"下载器 {it['downloaderName']} 没有配置域名")
+                continue
+            downloader = mgr.GetDownloader(it["downloaderName"], it["domain"])
+            if downloader is None:
                 continue
 
             logger.info(f"尝试使用下载器: {downloader.getDownloaderName()}")
 
-            if downloader.downloadDirect(avid, current_processes):
+            mirrors = _mirror_sources(mgr, avid, sorted_downloaders[i + 1:], cfg, cancel)
+            # 详情页拿到后立即开始刮削元数据，与视频下载并行
+            on_html = lambda html, d=downloader: metadata_service.submit(avid, d, html)
+            if _download_direct(downloader, avid, cancel, mirrors, on_html) \
+                    and _postprocess(avid, cfg, cancel):
                 logger.info(f"下载完成: {avid}")
-                data.batch_insert_bvids([avid], downloaded_path, "MissAV")
+                task_store.set_downloader(avid, downloader.getDownloaderName())
                 # 下载成功，立即跳出循环，不再尝试其他下载器
                 return True
             else:
                 logger.error(f"下载器 {downloader.getDownloaderName()} 下载失败")
                 # 继续尝试下一个下载器
 
+        cancel.check()
         raise ValueError(f"所有下载器都无法下载 {avid} 的视频")
 
+    except TaskCancelled:
+        logger.info(f"{avid} 已停止")
+        raise
     except Exception as e:
         logger.error(f"下载 {avid} 时发生错误: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def _download_direct(downloader, avid, cancel, mirrors, on_html):
+    """有预解析的地址时直接下载分片；预解析的地址下载失败（可能提前失效）时重新解析一次"""
+    resolution = lookahead_service.take(avid, downloader.getDownloaderName())
+    if resolution is None:
+        return downloader.downloadDirect(avid, cancel, mirrors, on_html)
+    if resolution.html:
+        on_html(resolution.html)
+    if downloader.downloadDirect(avid, cancel, mirrors, m3u8=resolution.m3u8):
+        return True
+    cancel.check()
+    logger.warning(f"{avid} 预解析的地址下载失败，重新解析")
+    return downloader.downloadDirect(avid, cancel, mirrors, on_html)
+
+def _postprocess(avid, cfg, cancel=None):
+    """异步时交给转码线程池后立即返回；同步时转码失败会继续尝试下一个下载器"""
+    if cfg.PostProcess.get("async", True):
+        postprocess_service.submit(avid)
+        return True
+    return postprocess_service.run(avid, cancel)
+
+def _mirror_sources(mgr, avid, candidates, cfg, cancel):
+    """按权重依次解析其他下载器的同一视频，分片下载失败时才会用到，所以是惰性的"""
+    for it in candidates:
+        if cancel.cancelled:
+            return
+        downloader = mgr.GetDownloader(it["downloaderName"], it["domain"]) if it["domain"] else None
+        if downloader is None:
+            continue
+        logger.info(f"解析备用源: {downloader.getDownloaderName()}")
+        # 在分片下载线程里执行，需要重新绑定任务的配置快照
+        with config_service.snapshot(cfg):
+            m3u8 = downloader.resolveM3u8(avid, cancel=cancel)
+        if m3u8:
+            yield downloader.getSegmentSource(m3u8)
+
+def crawl_listing(downloader_name, urls):
+    """抓取列表页填充搜索索引，之后这些番号不用再搜索"""
+    with config_service.snapshot() as cfg:
+        downloader = downloaderMgr.DownloaderMgr().GetDownloader(downloader_name, cfg.domain(downloader_name))
+        if downloader is None or downloader.getLinkPattern() is None:
+            raise ValueError(f"下载器 {downloader_name} 不支持搜索索引")
+        total = 0
+        for url in urls:
+            count = downloader.crawlListing(url)
+            logger.info(f"列表页 {url} 记录了 {count} 条")
+            total += count
+        return total
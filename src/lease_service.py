@@ -0,0 +1,402 @@
+# doc: 多机协作。协调节点持有下载队列和downloaded.db，把队列里的任务以带期限的租约分给各个节点；
+# 工作节点通过HTTP领取租约、定期心跳、上报结果，租约过期没有续期的任务会重新分配给下一个来领取的节点
+import hmac
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from curl_cffi import requests
+
+from . import data
+from .comm import *
+from .config_service import config_service
+from .task_queue import add_tasks, load_queue_from_file, remove_task_from_queue
+
+STANDALONE = "standalone"
+COORDINATOR = "coordinator"
+WORKER = "worker"
+
+TOKEN_HEADER = "X-Cluster-Token"
+
+
+@dataclass
+class Lease:
+    avid: str
+    token: str
+    worker: str
+    expires: float
+    progress: str = ""
+
+
+class LeaseManager:
+    """
+    协调节点上的租约表，保存在DBPath的Leases表里，重启后未过期的租约仍然有效
+    使用方式：
+    lease = lease_manager.acquire(worker)                 # 队列里没有可分配的任务时返回None
+    lease_manager.heartbeat(lease.token, progress)        # 续期；租约已被重新分配时返回False
+    lease_manager.complete(lease.token, ok, message)      # 移出队列，成功时写入downloaded.db
+    lease_manager.record(avid, ok, worker, message)       # 工作节点转码、校验结束后上报最终结果
+    lease_manager.release(lease.token)                    # 放弃租约，任务留在队列里
+    每个节点同一时间只处理一个任务，节点再次领取时它之前的租约作废（节点重启后继续原来的任务）
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._initialized = set()
+
+    def _connect(self, db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path)
+        if db_path not in self._initialized:
+            conn.execute('''CREATE TABLE IF NOT EXISTS Leases (
+                avid TEXT PRIMARY KEY, token TEXT UNIQUE NOT NULL, worker TEXT NOT NULL,
+                acquired REAL NOT NULL, expires REAL NOT NULL, progress TEXT)''')
+            conn.commit()
+            self._initialized.add(db_path)
+        return conn
+
+    def acquire(self, worker: str) -> Optional[Lease]:
+        cfg = config_service.current()
+        ttl = float(cfg.Cluster.get("leaseTTL", 600))
+        data.initialize_db(cfg.DBPath, "MissAV")
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                now = time.time()
+                # 节点上次没做完的任务（重启或停止后）优先分给它自己，已下载的分片可以续用
+                previous = [row[0] for row in conn.execute('SELECT avid FROM Leases WHERE worker = ?', (worker,))]
+                conn.execute('DELETE FROM Leases WHERE worker = ?', (worker,))
+                leased = dict(conn.execute('SELECT avid, expires FROM Leases').fetchall())
+                queue = load_queue_from_file()
+                queued = set(queue)
+                # 已经不在队列里的过期租约（任务被删除）直接清掉
+                stale = [avid for avid, expires in leased.items() if expires <= now and avid not in queued]
+                conn.executemany('DELETE FROM Leases WHERE avid = ?', [(avid,) for avid in stale])
+
+                for avid in [avid for avid in previous if avid in queued] + queue:
+                    expires = leased.get(avid)
+                    if expires is not None and expires > now:
+                        continue
+                    if data.find_in_db(avid, cfg.DBPath, "MissAV"):
+                        logger.info(f"{avid} 已存在于数据库中，移出队列")
+                        remove_task_from_queue(avid)
+                        continue
+                    if expires is not None:
+                        logger.warning(f"{avid} 的租约已过期，重新分配给 {worker}")
+                    lease = Lease(avid=avid, token=uuid.uuid4().hex, worker=worker, expires=now + ttl)
+                    conn.execute('INSERT OR REPLACE INTO Leases (avid, token, worker, acquired, expires, progress) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', (avid, lease.token, worker, now, lease.expires, ""))
+                    conn.commit()
+                    logger.info(f"{avid} 分配给 {worker}")
+                    return lease
+                conn.commit()
+                return None
+            finally:
+                conn.close()
+
+    def peek(self, count: int) -> List[str]:
+        """接下来会分配出去的count个番号（不在租约中、没有下载过），不领取"""
+        cfg = config_service.current()
+        data.initialize_db(cfg.DBPath, "MissAV")
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                leased = {row[0] for row in conn.execute('SELECT avid FROM Leases WHERE expires > ?', (time.time(),))}
+            finally:
+                conn.close()
+        upcoming = []
+        for avid in load_queue_from_file():
+            if len(upcoming) >= count:
+                break
+            if avid not in leased and not data.find_in_db(avid, cfg.DBPath, "MissAV"):
+                upcoming.append(avid)
+        return upcoming
+
+    def heartbeat(self, token: str, progress: str = "") -> bool:
+        cfg = config_service.current()
+        ttl = float(cfg.Cluster.get("leaseTTL", 600))
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                cursor = conn.execute('UPDATE Leases SET expires = ?, progress = ? WHERE token = ?',
+                                      (time.time() + ttl, progress[:500], token))
+                conn.commit()
+                return cursor.rowcount > 0
+            finally:
+                conn.close()
+
+    def complete(self, token: str, ok: bool, message: str = "", record: bool = True) -> bool:
+        """
+        :record: 成功时是否写入downloaded.db；本机的任务由下载流程自己写入（开启校验时校验通过后才写）
+        租约已被重新分配时返回False，结果不记录
+        """
+        cfg = config_service.current()
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                row = conn.execute('SELECT avid, worker FROM Leases WHERE token = ?', (token,)).fetchone()
+                if row is None:
+                    return False
+                conn.execute('DELETE FROM Leases WHERE token = ?', (token,))
+                conn.commit()
+            finally:
+                conn.close()
+        avid, worker = row
+        remove_task_from_queue(avid)
+        if ok and record:
+            data.initialize_db(cfg.DBPath, "MissAV")
+            data.batch_insert_bvids([avid], cfg.DBPath, "MissAV")
+        logger.info(f"{worker} 完成 {avid}: {'成功' if ok else '失败'} {message}")
+        return True
+
+    def record(self, avid: str, ok: bool, worker: str, message: str = ""):
+        """
+        工作节点的转码、校验在租约完成之后才结束，最终结果单独上报：
+        成功时写入downloaded.db，失败时重新加入队列
+        """
+        cfg = config_service.current()
+        if ok:
+            data.initialize_db(cfg.DBPath, "MissAV")
+            data.batch_insert_bvids([avid], cfg.DBPath, "MissAV")
+            remove_task_from_queue(avid)
+            logger.info(f"{worker} 的 {avid} 已完成转码和校验")
+        else:
+            add_tasks([avid])
+            logger.warning(f"{worker} 的 {avid} 转码或校验失败，重新加入队列: {message}")
+
+    def release(self, token: str) -> bool:
+        cfg = config_service.current()
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                cursor = conn.execute('DELETE FROM Leases WHERE token = ?', (token,))
+                conn.commit()
+                return cursor.rowcount > 0
+            finally:
+                conn.close()
+
+    def leases(self) -> List[dict]:
+        cfg = config_service.current()
+        with self._lock:
+            conn = self._connect(cfg.DBPath)
+            try:
+                rows = conn.execute('SELECT avid, worker, acquired, expires, progress FROM Leases ORDER BY acquired').fetchall()
+            finally:
+                conn.close()
+        now = time.time()
+        return [{"avid": avid, "worker": worker, "acquired": acquired, "expires_in": round(expires - now, 1),
+                 "expired": expires <= now, "progress": progress or ""}
+                for avid, worker, acquired, expires, progress in rows]
+
+
+class Heartbeat:
+    """
+    任务运行期间在后台线程里定期续租
+    使用方式：
+    with source.keep_alive(lease, progress=lambda: "...", on_lost=stop): download(...)
+    租约丢失（已过期并被重新分配）时调用on_lost，由调用方停止任务；on_beat(progress)在每次心跳时调用
+    """
+    def __init__(self, source: "TaskSource", lease: Lease, interval: float,
+                 progress: Callable[[], str], on_lost: Callable[[], None],
+                 on_beat: Optional[Callable[[str], None]] = None):
+        self.source = source
+        self.lease = lease
+        self.interval = max(interval, 1)
+        self.progress = progress
+        self.on_lost = on_lost
+        self.on_beat = on_beat
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"heartbeat-{lease.avid}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                progress = self.progress()
+                if self.on_beat is not None:
+                    self.on_beat(progress)
+                alive = self.source.heartbeat(self.lease, progress)
+            except Exception as e:
+                logger.error(f"{self.lease.avid} 心跳失败: {e}")
+                continue
+            if not alive:
+                logger.warning(f"{self.lease.avid} 的租约已失效，停止任务")
+                self.on_lost()
+                return
+
+
+class TaskSource(ABC):
+    """下载线程的任务来源：本机的租约表（单机/协调节点）或远程协调节点（工作节点）"""
+    def __init__(self, worker: str):
+        self.worker = worker
+
+    @abstractmethod
+    def acquire(self) -> Optional[Lease]:
+        """领取下一个任务，没有任务时返回None"""
+        pass
+
+    @abstractmethod
+    def heartbeat(self, lease: Lease, progress: str) -> bool:
+        """续期，租约已失效时返回False"""
+        pass
+
+    @abstractmethod
+    def complete(self, lease: Lease, ok: bool, message: str = ""):
+        """上报结果，任务移出队列"""
+        pass
+
+    @abstractmethod
+    def release(self, lease: Lease):
+        """放弃租约，任务留在队列里"""
+        pass
+
+    def report(self, avid: str, ok: bool, message: str = ""):
+        """转码、校验的最终结果；本机的结果已经写在本机，只有工作节点需要上报"""
+        pass
+
+    def keep_alive(self, lease: Lease, progress: Callable[[], str], on_lost: Callable[[], None],
+                   on_beat: Optional[Callable[[str], None]] = None) -> Heartbeat:
+        interval = float(config_service.latest().Cluster.get("heartbeatInterval", 60))
+        # 心跳间隔不超过租约剩余时间的1/3，协调节点的leaseTTL配得比较短时也不会过期
+        interval = min(interval, (lease.expires - time.time()) / 3)
+        return Heartbeat(self, lease, interval, progress, on_lost, on_beat)
+
+
+class LocalTaskSource(TaskSource):
+    def acquire(self) -> Optional[Lease]:
+        return lease_manager.acquire(self.worker)
+
+    def heartbeat(self, lease: Lease, progress: str) -> bool:
+        return lease_manager.heartbeat(lease.token, progress)
+
+    def complete(self, lease: Lease, ok: bool, message: str = ""):
+        lease_manager.complete(lease.token, ok, message, record=False)
+
+    def release(self, lease: Lease):
+        lease_manager.release(lease.token)
+
+
+class RemoteTaskSource(TaskSource):
+    """通过协调节点的 /cluster/leases 接口领取任务；协调节点暂时连不上时不停止正在运行的任务"""
+    def __init__(self, worker: str, coordinator: str, token: str = "", retries: int = 5):
+        super().__init__(worker)
+        self.coordinator = coordinator.rstrip("/")
+        self.headers = {TOKEN_HEADER: token} if token else {}
+        self.retries = retries
+
+    def _post(self, path: str, payload: dict) -> Tuple[int, Optional[dict]]:
+        response = requests.post(f"{self.coordinator}{path}", json=payload, headers=self.headers, timeout=10)
+        body = response.json() if response.status_code == 200 else None
+        return response.status_code, body
+
+    def acquire(self) -> Optional[Lease]:
+        try:
+            status, body = self._post("/cluster/leases", {"worker": self.worker})
+        except Exception as e:
+            logger.error(f"连接协调节点失败: {e}")
+            return None
+        if status != 200:
+            logger.error(f"领取任务失败，协调节点返回 {status}")
+            return None
+        return Lease(**body["lease"]) if body.get("lease") else None
+
+    def heartbeat(self, lease: Lease, progress: str) -> bool:
+        status, _ = self._post(f"/cluster/leases/{lease.token}/heartbeat", {"progress": progress})
+        if status == 410:
+            return False
+        if status != 200:
+            logger.warning(f"{lease.avid} 心跳失败，协调节点返回 {status}")
+        return True
+
+    def complete(self, lease: Lease, ok: bool, message: str = ""):
+        # 下载完成时转码、校验可能还没做完，协调节点先不写入downloaded.db，由report上报最终结果
+        # 结果没报上去租约会过期，任务会被重新下载一次，所以多试几次
+        status = self._post_with_retry(f"/cluster/leases/{lease.token}/complete",
+                                       {"ok": ok, "message": message, "record": False}, lease.avid)
+        if status == 410:
+            logger.warning(f"{lease.avid} 的租约已被重新分配，结果未被记录")
+        elif status is None:
+            logger.error(f"{lease.avid} 上报结果失败，租约过期后任务会重新分配")
+
+    def report(self, avid: str, ok: bool, message: str = ""):
+        status = self._post_with_retry("/cluster/results",
+                                       {"avid": avid, "ok": ok, "message": message, "worker": self.worker}, avid)
+        if status is None:
+            logger.error(f"{avid} 上报转码、校验结果失败，需要在协调节点上手动处理")
+
+    def _post_with_retry(self, path: str, payload: dict, avid: str) -> Optional[int]:
+        """200或410时返回状态码，多次失败返回None"""
+        for attempt in range(self.retries):
+            try:
+                status, _ = self._post(path, payload)
+                if status in (200, 410):
+                    return status
+                logger.warning(f"{avid} 上报结果失败，协调节点返回 {status}")
+            except Exception as e:
+                logger.warning(f"{avid} 上报结果失败: {e}")
+            time.sleep(min(2 ** attempt, 30))
+        return None
+
+    def release(self, lease: Lease):
+        try:
+            requests.delete(f"{self.coordinator}/cluster/leases/{lease.token}", headers=self.headers, timeout=10)
+        except Exception as e:
+            logger.warning(f"{lease.avid} 释放租约失败: {e}")
+
+
+def report_result(avid: str, ok: bool, message: str = ""):
+    """转码、校验结束后调用；工作节点把最终结果报给协调节点，由协调节点写入downloaded.db或重新排队"""
+    if config_service.current().Cluster.get("mode", STANDALONE) != WORKER:
+        return
+    try:
+        get_task_source().report(avid, ok, message)
+    except Exception as e:
+        logger.error(f"{avid} 上报转码、校验结果失败: {e}")
+
+
+def cluster_mode() -> str:
+    return config_service.latest().Cluster.get("mode", STANDALONE)
+
+
+def check_token(token: Optional[str]) -> bool:
+    """协调节点配置了token时，工作节点的请求需要带上相同的 X-Cluster-Token"""
+    expected = config_service.latest().Cluster.get("token", "")
+    return not expected or hmac.compare_digest(expected, token or "")
+
+
+def worker_id() -> str:
+    return config_service.latest().Cluster.get("workerId") or socket.gethostname()
+
+
+_sources: dict = {}
+
+
+def get_task_source() -> TaskSource:
+    """按当前配置返回任务来源，修改Cluster配置后下一个任务开始生效"""
+    cluster = config_service.latest().Cluster
+    key = (cluster.get("mode", STANDALONE), cluster.get("coordinator", ""), cluster.get("token", ""), worker_id())
+    source = _sources.get(key)
+    if source is None:
+        mode, coordinator, token, worker = key
+        if mode == WORKER:
+            if not coordinator:
+                raise ValueError("工作节点没有配置协调节点地址 Cluster.coordinator")
+            source = RemoteTaskSource(worker, coordinator, token)
+        else:
+            source = LocalTaskSource(worker)
+        _sources.clear()
+        _sources[key] = source
+    return source
+
+
+lease_manager = LeaseManager()
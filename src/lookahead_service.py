@@ -0,0 +1,224 @@
+# doc: 预解析。当前任务下载时，在后台提前解析队列里后面几个番号的详情页和m3u8（包括较慢的Cloudflare浏览器流程），
+# 轮到它们时直接开始下载分片。签名的m3u8地址会过期，过期前没用上就在开始前重新解析
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+from . import data
+from . import downloaderMgr
+from .comm import *
+from .config_service import AppConfig, config_service
+from .lease_service import WORKER, lease_manager
+from .util.media import manifest_path
+
+# 签名地址里常见的过期时间参数（unix时间戳）
+_EXPIRY_PARAMS = ("expires", "expire", "exp", "e", "validto", "valid_to", "deadline", "x-expires")
+
+
+def signed_url_expiry(url: str) -> Optional[float]:
+    """从签名地址的查询参数里读出过期时间，没有时返回None"""
+    for key, value in parse_qsl(urlparse(url).query):
+        if key.lower() in _EXPIRY_PARAMS and value.isdigit():
+            expiry = float(value)
+            # 毫秒时间戳
+            if expiry > 1e12:
+                expiry /= 1000
+            if 1e9 < expiry < 1e11:
+                return expiry
+    return None
+
+
+@dataclass
+class Resolution:
+    avid: str
+    downloader: str
+    m3u8: str
+    html: str
+    resolved_at: float
+    expires_at: float
+
+    def usable_until(self, margin: float) -> float:
+        return self.expires_at - margin
+
+
+class _Job:
+    __slots__ = ("avid", "due", "future", "fallback")
+
+    def __init__(self, avid: str, due: float, fallback: Optional[Resolution] = None):
+        self.avid = avid
+        self.due = due
+        self.future: Optional[Future] = None
+        # 等待重新解析时，上一次的结果在过期前仍然可以用
+        self.fallback = fallback
+
+
+class LookaheadService:
+    """
+    配置示例（configs.json）：
+    "Lookahead": {"enable": true, "depth": 2, "workers": 1, "perSite": 1, "maxAge": 900, "margin": 120, "lead": 60}
+    depth: 提前解析几个；maxAge: 地址没有签名过期时间时认为多久有效；margin: 过期前至少留多少秒给下载开始；
+    lead: 等待下一个任务时，提前多少秒重新解析快过期的地址
+    使用方式：
+    lookahead_service.schedule(keep=[avid])       # 开始一个任务后调用，解析队列里接下来的番号
+    lookahead_service.schedule(start_at)          # 任务间等待前调用，start_at前会过期的结果在开始前重新解析
+    lookahead_service.take(avid, downloaderName)  # 下载时取用，没有可用的结果返回None
+    解析在低并发的后台线程里进行，页面请求同样经过按域名的限速，每个站点同时最多perSite个预解析
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs: Dict[str, _Job] = {}
+        self._site_limits: Dict[str, threading.Semaphore] = {}
+        self._workers = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def schedule(self, start_at: Optional[float] = None, keep: Iterable[str] = ()):
+        """:keep: 刚领取、马上要取用结果的番号，不从预解析里移除"""
+        cfg = config_service.latest()
+        options = cfg.Lookahead
+        # 工作节点的下一个任务由协调节点决定，无法预知
+        if not options.get("enable", False) or cfg.Cluster.get("mode") == WORKER:
+            return
+        with config_service.snapshot(cfg):
+            upcoming = [avid for avid in lease_manager.peek(int(options.get("depth", 2)))
+                        if not self._already_downloaded(avid, cfg)]
+
+        now = time.time()
+        margin = float(options.get("margin", 120))
+        lead = float(options.get("lead", 60))
+        with self._cond:
+            # 不在接下来的几个里的结果不再需要（任务被删除或队列顺序变化）
+            keep = set(keep)
+            for avid in list(self._jobs):
+                if avid not in upcoming and avid not in keep:
+                    self._jobs.pop(avid)
+            for avid in upcoming:
+                job = self._jobs.get(avid)
+                if job is None:
+                    self._jobs[avid] = _Job(avid, now)
+                    continue
+                if start_at is None or job.future is None or not job.future.done():
+                    continue
+                result = job.future.result()
+                if result is None or result.usable_until(margin) < start_at:
+                    # 开始前会过期（或上次没解析成功），开始前重新解析
+                    self._jobs[avid] = _Job(avid, max(now, start_at - lead), result)
+            self._ensure_dispatcher()
+            self._cond.notify_all()
+
+    def take(self, avid: str, downloader_name: str) -> Optional[Resolution]:
+        """正在解析时等它完成；结果是其他下载器的，留给后面的下载器使用"""
+        with self._cond:
+            job = self._jobs.get(avid)
+        if job is None:
+            return None
+        # 还没开始的重新解析用不上了，用上一次的结果
+        result = job.future.result() if job.future is not None else job.fallback
+        margin = float(config_service.current().Lookahead.get("margin", 120))
+        fresh = result is not None and result.usable_until(margin) >= time.time()
+        if fresh and result.downloader != downloader_name:
+            return None
+        with self._cond:
+            if self._jobs.get(avid) is job:
+                self._jobs.pop(avid)
+        if not fresh:
+            return None
+        logger.info(f"{avid} 使用预解析的地址（{downloader_name}，{result.expires_at - time.time():.0f}秒后过期）")
+        return result
+
+    def status(self) -> List[dict]:
+        now = time.time()
+        with self._cond:
+            jobs = list(self._jobs.values())
+        states = []
+        for job in jobs:
+            state = {"avid": job.avid, "state": "scheduled", "due_in": round(max(job.due - now, 0), 1)}
+            if job.future is not None:
+                state["state"] = "resolving"
+                if job.future.done():
+                    result = job.future.result()
+                    state["state"] = "resolved" if result else "failed"
+                    if result:
+                        state.update(downloader=result.downloader, expires_in=round(result.expires_at - now, 1))
+            states.append(state)
+        return states
+
+    def _ensure_dispatcher(self):
+        """调用方需持有锁"""
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, daemon=True, name="lookahead")
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                pending = [job for job in self._jobs.values() if job.future is None]
+                if not pending:
+                    self._cond.wait()
+                    continue
+                job = min(pending, key=lambda j: j.due)
+                delay = job.due - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                cfg = config_service.latest()
+                executor = self._get_executor(int(cfg.Lookahead.get("workers", 1)))
+                with config_service.snapshot(cfg):
+                    job.future = config_service.submit(executor, self._resolve, job.avid, cfg)
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        """调用方需持有锁"""
+        workers = max(workers, 1)
+        if self._executor is None or workers != self._workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookahead")
+        return self._executor
+
+    def _site_limit(self, name: str, per_site: int) -> threading.Semaphore:
+        with self._cond:
+            limit = self._site_limits.get(name)
+            if limit is None:
+                limit = self._site_limits[name] = threading.Semaphore(max(per_site, 1))
+            return limit
+
+    @staticmethod
+    def _already_downloaded(avid: str, cfg: AppConfig) -> bool:
+        """已下载或本地文件已经下载完成的任务不需要解析"""
+        ts_path = os.path.join(cfg.SavePath, avid, f"{avid}.ts")
+        return data.find_in_db(avid, cfg.DBPath, "MissAV") \
+            or os.path.exists(os.path.join(cfg.SavePath, avid, f"{avid}.mp4")) \
+            or (os.path.exists(ts_path) and os.path.exists(manifest_path(ts_path)))
+
+    def _resolve(self, avid: str, cfg: AppConfig) -> Optional[Resolution]:
+        """与下载时相同的顺序尝试下载器，返回第一个解析成功的"""
+        options = cfg.Lookahead
+        mgr = downloaderMgr.DownloaderMgr()
+        for it in cfg.sorted_downloaders:
+            downloader = mgr.GetDownloader(it["downloaderName"], it["domain"]) if it["domain"] else None
+            if downloader is None:
+                continue
+            name = downloader.getDownloaderName()
+            pages = []
+            try:
+                with self._site_limit(name, int(options.get("perSite", 1))):
+                    logger.info(f"预解析 {avid}（{name}）")
+                    m3u8 = downloader.resolveM3u8(avid, on_html=pages.append)
+            except Exception as e:
+                logger.warning(f"预解析 {avid} 异常（{name}）: {e}")
+                continue
+            if not m3u8:
+                continue
+            now = time.time()
+            expires_at = signed_url_expiry(m3u8) or now + float(options.get("maxAge", 900))
+            return Resolution(avid=avid, downloader=name, m3u8=m3u8, html=pages[0] if pages else "",
+                              resolved_at=now, expires_at=expires_at)
+        logger.warning(f"预解析 {avid} 失败，轮到它时再解析")
+        return None
+
+
+lookahead_service = LookaheadService()
@@ -0,0 +1,153 @@
+# doc: 元数据刮削，与视频下载并行。复用下载时已经获取的详情页，生成 Jellyfin/Kodi 使用的NFO、poster和fanart，
+# 刮削结果按番号缓存在数据库里，重新下载时不再刮削
+import os
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Optional, Set
+
+from . import data
+from .comm import *
+from .config_service import AppConfig, config_service
+from .downloader.downloaderBase import AVMetadata, Downloader
+from .util.request_handler import RequestHandler
+
+# 常见图片格式的文件头，图片地址返回的是错误页时不保存
+_IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG", b"RIFF", b"GIF8")
+
+
+class MetadataService:
+    """
+    使用方式（在任务的配置快照内调用）：
+    metadata_service.submit(avid, downloader, html)  # html为None时用downloader重新获取详情页
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running: Set[str] = set()
+        self._workers = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.request_handler = RequestHandler()
+
+    def submit(self, avid: str, downloader: Downloader, html: Optional[str] = None):
+        cfg = config_service.current()
+        if not cfg.Metadata.get("enable", False):
+            return
+        with self._lock:
+            # 备用源解析时也会拿到详情页，同一番号只刮削一次
+            if avid in self._running:
+                return
+            self._running.add(avid)
+            executor = self._get_executor(int(cfg.Metadata.get("workers", 2)))
+        config_service.submit(executor, self._run, avid, downloader, html, cfg)
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        """调用方需持有锁"""
+        workers = max(workers, 1)
+        if self._executor is None or workers != self._workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metadata")
+        return self._executor
+
+    def _run(self, avid: str, downloader: Downloader, html: Optional[str], cfg: AppConfig):
+        try:
+            self._scrape(avid, downloader, html, cfg)
+        except Exception as e:
+            logger.error(f"{avid} 元数据刮削异常: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(avid)
+
+    def _scrape(self, avid: str, downloader: Downloader, html: Optional[str], cfg: AppConfig):
+        data.initialize_metadata_db(cfg.DBPath)
+        cached = data.load_metadata(avid, cfg.DBPath)
+        if cached is not None:
+            logger.info(f"{avid} 使用缓存的元数据")
+            metadata = AVMetadata.from_dict(cached)
+        else:
+            if html is None:
+                html = downloader.getHTML(avid)
+            metadata = downloader.parseMetadata(html) if html else None
+            if metadata is None:
+                logger.warning(f"{avid} 没有解析到元数据 ({downloader.getDownloaderName()})")
+                return
+            metadata.avid = avid
+            data.save_metadata(avid, asdict(metadata), cfg.DBPath)
+
+        folder = os.path.join(cfg.SavePath, avid)
+        os.makedirs(folder, exist_ok=True)
+        self._write_nfo(metadata, os.path.join(folder, f"{avid}.nfo"))
+        self._write_images(metadata, folder, cfg.Metadata)
+        logger.info(f"{avid} 元数据已保存")
+
+    @staticmethod
+    def _write_nfo(metadata: AVMetadata, path: str):
+        movie = ET.Element("movie")
+        ET.SubElement(movie, "title").text = metadata.title or metadata.avid
+        ET.SubElement(movie, "originaltitle").text = metadata.title or metadata.avid
+        ET.SubElement(movie, "sorttitle").text = metadata.avid
+        ET.SubElement(movie, "num").text = metadata.avid
+        ET.SubElement(movie, "uniqueid", type="num", default="true").text = metadata.avid
+        if metadata.plot:
+            ET.SubElement(movie, "plot").text = metadata.plot
+        if metadata.premiered:
+            ET.SubElement(movie, "premiered").text = metadata.premiered
+            ET.SubElement(movie, "year").text = metadata.premiered[:4]
+        for name in metadata.actors:
+            actor = ET.SubElement(movie, "actor")
+            ET.SubElement(actor, "name").text = name
+        for tag in metadata.tags:
+            ET.SubElement(movie, "tag").text = tag
+            ET.SubElement(movie, "genre").text = tag
+        ET.SubElement(movie, "thumb", aspect="poster").text = "poster.jpg"
+        fanart = ET.SubElement(movie, "fanart")
+        ET.SubElement(fanart, "thumb").text = "fanart.jpg"
+        if metadata.url:
+            ET.SubElement(movie, "website").text = metadata.url
+        ET.indent(movie)
+
+        tmp_path = path + ".tmp"
+        ET.ElementTree(movie).write(tmp_path, encoding="utf-8", xml_declaration=True)
+        os.replace(tmp_path, path)
+
+    def _write_images(self, metadata: AVMetadata, folder: str, options: dict):
+        fanart_path = os.path.join(folder, "fanart.jpg")
+        poster_path = os.path.join(folder, "poster.jpg")
+        if not metadata.cover or (os.path.exists(fanart_path) and os.path.exists(poster_path)):
+            return
+        content = self.request_handler.get(metadata.cover)
+        if not content or not content.startswith(_IMAGE_SIGNATURES):
+            logger.warning(f"{metadata.avid} 封面下载失败: {metadata.cover}")
+            return
+        if options.get("fanart", True):
+            with open(fanart_path, "wb") as f:
+                f.write(content)
+        if options.get("poster", True):
+            with open(poster_path, "wb") as f:
+                f.write(_crop_poster(content))
+
+
+def _crop_poster(content: bytes) -> bytes:
+    """封面是横版的，竖版海报取右侧约47%。需要Pillow，没有安装时直接使用整张封面"""
+    try:
+        from io import BytesIO
+        from PIL import Image
+    except ImportError:
+        return content
+    try:
+        image = Image.open(BytesIO(content))
+        width, height = image.size
+        if width <= height:
+            return content
+        poster = image.crop((int(width * 0.525), 0, width, height)).convert("RGB")
+        output = BytesIO()
+        poster.save(output, format="JPEG", quality=95)
+        return output.getvalue()
+    except Exception as e:
+        logger.warning(f"裁剪海报失败，使用整张封面: {e}")
+        return content
+
+
+metadata_service = MetadataService()
@@ -0,0 +1,119 @@
+# doc: 下载后的处理：ts转mp4，然后交给校验或直接写入downloaded.db
+# 转码是磁盘密集的，放到单独的有界线程池里（每个线程驱动一个ffmpeg进程），下载线程交出ts后就可以开始下一个任务
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from .comm import *
+from .config_service import AppConfig, config_service
+from .task_store import fail_and_requeue, record_downloaded
+from .util.cancel import CancelToken
+from .util.log_throttle import ThrottledOutput, progress_interval
+from .util.media import manifest_path, remux
+from .util.profiler import stage
+from .util.status_map import StatusMap
+from .verify_service import verify_service
+
+QUEUED = "queued"
+REMUXING = "remuxing"
+DONE = "done"
+FAILED = "failed"
+
+
+class PostProcessService:
+    """
+    使用方式（在任务的配置快照内调用）：
+    postprocess_service.submit(avid)               # 交给转码线程池，立即返回
+    postprocess_service.run(avid, cancel)          # 在当前线程转码，停止任务时结束ffmpeg
+    并发数由配置 PostProcess.workers 决定，与下载并发无关，避免NAS磁盘同时被多个ffmpeg占满
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = StatusMap(active=(QUEUED, REMUXING))
+        self._workers = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, avid: str) -> Optional[Future]:
+        """已经在队列里的任务不重复提交，返回None"""
+        cfg = config_service.current()
+        with self._lock:
+            if self._status.get(avid) in (QUEUED, REMUXING):
+                return None
+            self._status[avid] = QUEUED
+            executor = self._get_executor(int(cfg.PostProcess.get("workers", 1)))
+        logger.info(f"{avid} 已交给转码队列")
+        return config_service.submit(executor, self._run, avid, cfg)
+
+    def run(self, avid: str, cancel: Optional[CancelToken] = None) -> bool:
+        return self._process(avid, config_service.current(), cancel)
+
+    def status(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._status)
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        """调用方需持有锁。修改并发数后，已提交的任务在旧线程池里继续执行"""
+        workers = max(workers, 1)
+        if self._executor is None or workers != self._workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="postprocess")
+        return self._executor
+
+    def _set_status(self, avid: str, status: str):
+        with self._lock:
+            self._status[avid] = status
+
+    def _run(self, avid: str, cfg: AppConfig) -> bool:
+        """异步转码：下载线程已经把任务移出队列，失败时记为failed并重新加入队列"""
+        try:
+            ok = self._process(avid, cfg)
+            message = "转码失败"
+        except Exception as e:
+            logger.error(f"{avid} 转码异常: {e}")
+            self._set_status(avid, FAILED)
+            ok, message = False, f"转码异常: {e}"
+        if not ok:
+            fail_and_requeue(avid, message)
+        return ok
+
+    def _process(self, avid: str, cfg: AppConfig, cancel: Optional[CancelToken] = None) -> bool:
+        ts_path = os.path.join(cfg.SavePath, avid, f"{avid}.ts")
+        mp4_path = os.path.join(cfg.SavePath, avid, f"{avid}.mp4")
+        self._set_status(avid, REMUXING)
+        logger.info(f"{avid} 开始转码为MP4")
+
+        output = ThrottledOutput(lambda line: logger.info(f"[FFmpeg] {line}"), progress_interval())
+        with stage("postprocess.remux"):
+            ok = remux(ffmpeg_tool, ts_path, mp4_path, on_output=output.feed, cancel=cancel)
+        output.close()
+
+        if not ok:
+            logger.error(f"{avid} 转码失败")
+            self._set_status(avid, FAILED)
+            return False
+
+        logger.info(f"{avid} 转码完成")
+        self._set_status(avid, DONE)
+        finish(avid, cfg)
+        return True
+
+
+def finish(avid: str, cfg: AppConfig):
+    """开启校验时校验通过后才写入数据库，校验在后台进行；否则直接写入并清理ts"""
+    if cfg.Verification.get("enable", False):
+        verify_service.submit(avid)
+        return
+    record_downloaded(avid, cfg)
+    ts_path = os.path.join(cfg.SavePath, avid, f"{avid}.ts")
+    for path in (ts_path, manifest_path(ts_path)):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.warning(f"清理临时文件失败：{e}")
+
+
+postprocess_service = PostProcessService()
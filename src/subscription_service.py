@@ -0,0 +1,142 @@
+# doc: 订阅。定期轮询配置的列表页（演员、片商、系列），把新出现的番号批量加入下载队列
+# 列表页用 ETag/Last-Modified 条件请求，没变化时不下载；记录上次看到的最新番号（高水位），只翻到上次的位置为止
+import threading
+import time
+from typing import Dict, List, Optional
+
+from . import data
+from . import downloaderMgr
+from .comm import *
+from .config_service import config_service
+from .task_queue import add_tasks
+from .util.request_handler import RequestHandler
+from .util.search_index import extract_avids
+
+# 高水位保留第一页的前几个番号，最新的那部影片被下架时也能找到上次的位置
+HIGH_WATER_SIZE = 20
+
+
+class SubscriptionService:
+    """
+    配置示例（configs.json）：
+    "Subscriptions": {
+        "enable": true, "interval": 3600, "backfill": false,
+        "items": [{"name": "s1", "downloader": "MissAV", "url": "https://missav.ws/dm/makers/S1?page={page}",
+                   "prefix": "SSIS-", "maxPages": 3}]
+    }
+    url中的{page}会替换成页码，没有{page}时只看一页；第一次轮询只记录高水位，backfill为true时才把已有的番号加入队列
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.request_handler = RequestHandler()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="subscription")
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            subscriptions = config_service.latest().Subscriptions
+            if subscriptions.get("enable", False):
+                self.poll_all()
+            time.sleep(float(subscriptions.get("interval", 3600)))
+
+    def poll_all(self) -> Dict[str, int]:
+        """轮询所有订阅，返回 {订阅名: 新加入队列的数量}"""
+        results = {}
+        with self._lock, config_service.snapshot() as cfg:
+            data.initialize_db(cfg.DBPath, "MissAV")
+            data.initialize_subscription_db(cfg.DBPath)
+            for item in cfg.Subscriptions.get("items", []):
+                name = item.get("name") or item.get("url", "")
+                try:
+                    results[name] = self._poll(name, item, cfg)
+                except Exception as e:
+                    logger.error(f"订阅 {name} 轮询失败: {e}")
+                    results[name] = 0
+        return results
+
+    def status(self) -> List[dict]:
+        cfg = config_service.latest()
+        data.initialize_subscription_db(cfg.DBPath)
+        states = []
+        for item in cfg.Subscriptions.get("items", []):
+            name = item.get("name") or item.get("url", "")
+            state = data.load_subscription_state(name, cfg.DBPath)
+            states.append({"name": name, "url": item.get("url", ""), "last_poll": state["last_poll"],
+                           "last_added": state["last_added"], "high_water": state["high_water"][:1]})
+        return states
+
+    def _poll(self, name: str, item: dict, cfg) -> int:
+        downloader_name = item.get("downloader", "MissAV")
+        downloader = downloaderMgr.DownloaderMgr().GetDownloader(downloader_name, cfg.domain(downloader_name))
+        if downloader is None:
+            logger.error(f"订阅 {name} 的下载器不存在: {item.get('downloader')}")
+            return 0
+
+        state = data.load_subscription_state(name, cfg.DBPath)
+        state["last_poll"] = time.time()
+        url = item["url"]
+
+        first_page = self._fetch_first_page(url.replace("{page}", "1"), state, downloader)
+        if first_page is None:
+            data.save_subscription_state(name, state, cfg.DBPath)
+            return 0
+
+        high_water = set(state["high_water"])
+        backfill = bool(high_water) or cfg.Subscriptions.get("backfill", False)
+        first_avids = extract_avids(first_page)
+        found = []
+        reached = False
+        page, content = 1, first_page
+        while True:
+            downloader.indexLinks(content)
+            for avid in extract_avids(content) if page > 1 else first_avids:
+                if avid in high_water:
+                    reached = True
+                    break
+                found.append(avid)
+            page += 1
+            if reached or not backfill or "{page}" not in url or page > int(item.get("maxPages", 3)):
+                break
+            content = downloader._fetch_html(url.replace("{page}", str(page)))
+            if not content:
+                break
+
+        if first_avids:
+            state["high_water"] = first_avids[:HIGH_WATER_SIZE]
+        if not backfill:
+            logger.info(f"订阅 {name} 第一次轮询，只记录当前位置")
+            found = []
+
+        prefix = item.get("prefix", "").upper()
+        new = [avid for avid in found
+               if avid.startswith(prefix) and not data.find_in_db(avid, cfg.DBPath, "MissAV")]
+        # 列表页是新的在前，按发布顺序加入队列
+        added = add_tasks(reversed(new))
+        state["last_added"] = len(added)
+        data.save_subscription_state(name, state, cfg.DBPath)
+        if added:
+            logger.info(f"订阅 {name} 新增 {len(added)} 个任务: {added}")
+        return len(added)
+
+    def _fetch_first_page(self, url: str, state: dict, downloader) -> Optional[str]:
+        """第一页用条件请求；返回None表示没有变化或获取失败"""
+        response = self.request_handler.get_conditional(url, state["etag"], state["last_modified"])
+        if response is not None and response.status == 304:
+            logger.debug(f"列表页没有变化: {url}")
+            return None
+        if response is not None and response.status == 200:
+            content = response.content.decode("utf-8", errors="ignore")
+            if "Just a moment" not in content and "Checking your browser" not in content:
+                state["etag"], state["last_modified"] = response.etag, response.last_modified
+                return content
+        # 请求失败或遇到Cloudflare验证，走下载器的完整流程（包括浏览器模式），这种情况下没有条件请求
+        state["etag"], state["last_modified"] = "", ""
+        return downloader._fetch_html(url)
+
+
+subscription_service = SubscriptionService()
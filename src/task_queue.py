@@ -0,0 +1,55 @@
+# doc: 下载队列文件(QueuePath)的读写。网页接口、下载线程和订阅轮询都会修改队列，读改写在锁内完成
+import threading
+from typing import Iterable, List
+
+from src.comm import *
+
+_lock = threading.RLock()
+
+# 确保队列目录存在
+os.makedirs(os.path.dirname(queue_path), exist_ok=True)
+
+def load_queue_from_file() -> List[str]:
+    """从文件加载下载队列"""
+    try:
+        with _lock:
+            if os.path.exists(queue_path):
+                with open(queue_path, "r", encoding="utf-8") as f:
+                    tasks = [line.strip() for line in f if line.strip()]
+                return tasks
+        return []
+    except Exception as e:
+        logger.error(f"加载队列文件失败: {e}")
+        return []
+
+def save_queue_to_file(tasks: List[str]):
+    """保存队列到文件"""
+    try:
+        with _lock:
+            with open(queue_path, "w", encoding="utf-8") as f:
+                for task in tasks:
+                    f.write(task + "\n")
+    except Exception as e:
+        logger.error(f"保存队列文件失败: {e}")
+
+def remove_task_from_queue(avid: str):
+    """从队列文件中移除任务"""
+    with _lock:
+        tasks = load_queue_from_file()
+        tasks = [task for task in tasks if task != avid]
+        save_queue_to_file(tasks)
+
+def add_tasks(avids: Iterable[str]) -> List[str]:
+    """批量加入队列，已在队列中的跳过，返回实际加入的番号"""
+    with _lock:
+        tasks = load_queue_from_file()
+        existing = set(tasks)
+        added = []
+        for avid in avids:
+            avid = avid.upper()
+            if avid not in existing:
+                existing.add(avid)
+                added.append(avid)
+        if added:
+            save_queue_to_file(tasks + added)
+        return added
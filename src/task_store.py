@@ -0,0 +1,321 @@
+# doc: 任务状态持久化。任务的状态、消息和心跳保存在DBPath的Tasks表里，服务重启后网页上的记录还在；
+# 启动时把上次停在downloading的任务标记为interrupted，清理不能续用的临时文件，保留可以续用的分片、ts和mp4
+import base64
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import data
+from .comm import *
+from .config_service import AppConfig, config_service
+from .lease_service import WORKER, report_result
+from .task_queue import add_tasks, load_queue_from_file
+from .util.media import manifest_path
+
+PENDING = "pending"
+DOWNLOADING = "downloading"
+COMPLETED = "completed"
+FAILED = "failed"
+INTERRUPTED = "interrupted"
+
+NOTHING = "没有可续用的文件，重新下载"
+
+
+class TaskStore:
+    """
+    使用方式：
+    task_store.set(avid, DOWNLOADING, "开始下载")
+    task_store.heartbeat(avid, message)    # 下载过程中定期调用
+    task_store.get_many(avids)             # {番号: {"avid", "status", "message", "updated", "heartbeat"}}
+    task_store.recover()                   # 启动时调用一次，返回被中断的番号
+    task_store.history(status, downloader, since, cursor, limit)  # 分页查询历史
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._initialized = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        db_path = config_service.current().DBPath
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        if db_path not in self._initialized:
+            conn.execute('''CREATE TABLE IF NOT EXISTS Tasks (
+                avid TEXT PRIMARY KEY, status TEXT NOT NULL, message TEXT, created REAL NOT NULL,
+                updated REAL NOT NULL, heartbeat REAL, downloader TEXT)''')
+            columns = {row["name"] for row in conn.execute('PRAGMA table_info(Tasks)')}
+            if "downloader" not in columns:
+                conn.execute('ALTER TABLE Tasks ADD COLUMN downloader TEXT')
+            # 历史按更新时间倒序分页，(updated, avid) 作为游标
+            conn.execute('DROP INDEX IF EXISTS idx_tasks_status')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status_updated ON Tasks (status, updated, avid)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_downloader ON Tasks (downloader, updated, avid)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_updated ON Tasks (updated, avid)')
+            conn.commit()
+            self._initialized.add(db_path)
+        return conn
+
+    def set(self, avid: str, status: str, message: str = "", expect: Optional[str] = None) -> bool:
+        """
+        :expect: 只有当前状态是expect时才修改，返回是否修改了。
+        下载线程用它把downloading改为completed，异步转码已经失败（改为failed）时不会被覆盖
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                if expect is not None:
+                    cursor = conn.execute('UPDATE Tasks SET status = ?, message = ?, updated = ?, heartbeat = NULL '
+                                          'WHERE avid = ? AND status = ?', (status, message, now, avid, expect))
+                    conn.commit()
+                    return cursor.rowcount > 0
+                conn.execute('''INSERT INTO Tasks (avid, status, message, created, updated, heartbeat)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(avid) DO UPDATE SET status = excluded.status, message = excluded.message,
+                        updated = excluded.updated, heartbeat = excluded.heartbeat,
+                        downloader = CASE WHEN excluded.status = ? THEN NULL ELSE downloader END''',
+                             (avid, status, message, now, now, now if status == DOWNLOADING else None, DOWNLOADING))
+                conn.commit()
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"保存任务状态出错: {e}")
+                return False
+            finally:
+                conn.close()
+
+    def heartbeat(self, avid: str, message: str = ""):
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute('UPDATE Tasks SET heartbeat = ?, message = ? WHERE avid = ? AND status = ?',
+                             (time.time(), message[:500], avid, DOWNLOADING))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"更新任务心跳出错: {e}")
+            finally:
+                conn.close()
+
+    def set_downloader(self, avid: str, downloader: str):
+        """记录实际下载成功的下载器"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute('UPDATE Tasks SET downloader = ? WHERE avid = ?', (downloader, avid))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"保存任务状态出错: {e}")
+            finally:
+                conn.close()
+
+    def get(self, avid: str) -> Optional[dict]:
+        return self.get_many([avid]).get(avid)
+
+    def get_many(self, avids: Iterable[str]) -> Dict[str, dict]:
+        avids = list(avids)
+        result = {}
+        conn = self._connect()
+        try:
+            # SQLite单条语句的参数个数有限制，分批查询
+            for i in range(0, len(avids), 500):
+                batch = avids[i:i + 500]
+                rows = conn.execute(f'SELECT * FROM Tasks WHERE avid IN ({",".join("?" * len(batch))})', batch)
+                result.update({row["avid"]: dict(row) for row in rows})
+        finally:
+            conn.close()
+        return result
+
+    def recent(self, status: str, limit: int = 20) -> List[dict]:
+        """最近的limit条，按时间从旧到新"""
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT * FROM Tasks WHERE status = ? ORDER BY updated DESC LIMIT ?',
+                                (status, limit)).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in reversed(rows)]
+
+    def history(self, status: Optional[str] = None, downloader: Optional[str] = None, since: Optional[float] = None,
+                cursor: Optional[str] = None, limit: int = 50) -> dict:
+        """
+        按更新时间倒序分页。返回 {"items", "next_cursor", "counts"}，next_cursor为None表示没有更多；
+        counts是按状态、下载器的统计（只受downloader、since筛选影响，不受分页影响）
+        游标无效时抛出ValueError
+        """
+        # downloader、since同时用于列表和统计，status、游标只用于列表
+        base, base_params = [], []
+        if downloader:
+            base.append("downloader = ?")
+            base_params.append(downloader)
+        if since is not None:
+            base.append("updated >= ?")
+            base_params.append(since)
+
+        filters, params = list(base), list(base_params)
+        if status:
+            filters.append("status = ?")
+            params.append(status)
+        if cursor:
+            updated, avid = _decode_cursor(cursor)
+            filters.append("(updated < ? OR (updated = ? AND avid < ?))")
+            params += [updated, updated, avid]
+
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+        base_where = f"WHERE {' AND '.join(base)}" if base else ""
+        completed_where = f"WHERE {' AND '.join(base + ['status = ?'])}"
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(f'SELECT avid, status, message, downloader, created, updated FROM Tasks {where} '
+                                f'ORDER BY updated DESC, avid DESC LIMIT ?', params + [limit + 1]).fetchall()
+            by_status = conn.execute(f'SELECT status, COUNT(*) FROM Tasks {base_where} GROUP BY status',
+                                     base_params).fetchall()
+            by_downloader = conn.execute(f'SELECT downloader, COUNT(*) FROM Tasks {completed_where} GROUP BY downloader',
+                                         base_params + [COMPLETED]).fetchall()
+        finally:
+            conn.close()
+
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = _encode_cursor(items[-1]["updated"], items[-1]["avid"]) if len(rows) > limit else None
+        return {
+            "items": items,
+            "next_cursor": next_cursor,
+            "counts": {
+                "status": {row[0]: row[1] for row in by_status},
+                "completed_by_downloader": {row[0] or "unknown": row[1] for row in by_downloader},
+            },
+        }
+
+    def clear(self, status: str) -> int:
+        with self._lock:
+            conn = self._connect()
+            try:
+                cursor = conn.execute('DELETE FROM Tasks WHERE status = ?', (status,))
+                conn.commit()
+                return cursor.rowcount
+            finally:
+                conn.close()
+
+    def recover(self) -> List[str]:
+        """
+        上次退出时还在下载的任务标记为interrupted，整理它们的临时文件；
+        已经报告完成、但转码或校验没做完（还没写入downloaded.db）的任务重新加入队列
+        中断的任务仍在队列里，下载线程领取时会优先继续本节点上次的任务
+        """
+        cfg = config_service.current()
+        data.initialize_db(cfg.DBPath, "MissAV")
+        with self._lock:
+            conn = self._connect()
+            try:
+                interrupted = conn.execute('SELECT avid, heartbeat FROM Tasks WHERE status = ?', (DOWNLOADING,)).fetchall()
+                unfinished = [row["avid"] for row in conn.execute(
+                    'SELECT avid FROM Tasks WHERE status = ? AND avid NOT IN (SELECT bvid FROM MissAV)', (COMPLETED,))]
+            finally:
+                conn.close()
+
+        now = time.time()
+        queued = set(load_queue_from_file())
+        recovered = []
+        for row in interrupted:
+            avid = row["avid"]
+            state = adopt_partial_files(avid, cfg.SavePath)
+            since = f"{now - row['heartbeat']:.0f}秒前" if row["heartbeat"] else "未知时间"
+            logger.warning(f"{avid} 上次在下载中被中断（最后心跳 {since}），{state}")
+            self.set(avid, INTERRUPTED if avid in queued else FAILED, f"服务重启时被中断，{state}")
+            recovered.append(avid)
+
+        requeue = [avid for avid in unfinished if adopt_partial_files(avid, cfg.SavePath, clean=False) != NOTHING]
+        if requeue and cfg.Cluster.get("mode") == "worker":
+            # 工作节点的结果已经报给协调节点，本机队列不会被处理，只能提示手动处理
+            logger.warning(f"以下任务转码或校验没有完成，需要在本机重新添加: {requeue}")
+            return recovered
+        for avid in add_tasks(requeue):
+            logger.warning(f"{avid} 转码或校验没有完成，重新加入队列")
+            self.set(avid, INTERRUPTED, "转码或校验没有完成")
+            recovered.append(avid)
+        return recovered
+
+
+def record_downloaded(avid: str, cfg: AppConfig):
+    """转码（和校验）完成后写入downloaded.db；工作节点同时报给协调节点"""
+    data.batch_insert_bvids([avid], cfg.DBPath, "MissAV")
+    report_result(avid, True)
+
+
+def fail_and_requeue(avid: str, message: str):
+    """
+    转码或校验最终失败时调用：任务记为failed（/history可以查到原因）并重新加入队列，
+    下载线程之后重新下载，修复时保留的分片可以续用。工作节点的队列在协调节点上，由协调节点重新加入
+    """
+    task_store.set(avid, FAILED, message)
+    if config_service.current().Cluster.get("mode") == WORKER:
+        report_result(avid, False, message)
+    elif add_tasks([avid]):
+        logger.warning(f"{avid} {message}，重新加入队列")
+
+
+def _encode_cursor(updated: float, avid: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([updated, avid]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        updated, avid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(updated), str(avid)
+    except Exception:
+        raise ValueError(f"无效的游标: {cursor}")
+
+
+def adopt_partial_files(avid: str, save_path: str, clean: bool = True) -> str:
+    """
+    检查任务目录里的临时文件，返回说明。clean为True时删除不能续用的文件：
+    写了一半的mp4(.tmp)、没有分片清单也没有分片目录的ts（下载工具中断）；
+    有分片目录时ts是合并了一部分的，按分片目录里的合并进度继续
+    """
+    folder = os.path.join(save_path, avid)
+    mp4_path = os.path.join(folder, f"{avid}.mp4")
+    ts_path = os.path.join(folder, f"{avid}.ts")
+    parts_dir = ts_path + ".parts"
+
+    if clean:
+        leftovers = [mp4_path + ".tmp"] + glob.glob(os.path.join(glob.escape(parts_dir), "*.tmp"))
+        if os.path.exists(ts_path) and not os.path.exists(manifest_path(ts_path)) and not os.path.isdir(parts_dir):
+            leftovers.append(ts_path)
+        for path in leftovers:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                    logger.info(f"删除不完整的文件: {path}")
+            except OSError as e:
+                logger.warning(f"删除临时文件失败：{e}")
+
+    if os.path.exists(mp4_path):
+        return "mp4已转码完成，继续校验"
+    if os.path.exists(ts_path) and os.path.exists(manifest_path(ts_path)):
+        return "ts已下载完成，继续转码"
+    if os.path.isdir(parts_dir):
+        count = len(glob.glob(os.path.join(glob.escape(parts_dir), "[0-9]*.ts")))
+        return f"保留已下载的分片（{count} 个未合并），继续下载"
+    return NOTHING
+
+
+def discard_partial_files(avid: str, save_path: str):
+    """停止任务且不保留临时文件时调用：删除ts、分片目录、分片清单和写了一半的mp4，已经转码完成的mp4不删除"""
+    folder = os.path.join(save_path, avid)
+    ts_path = os.path.join(folder, f"{avid}.ts")
+    for path in (ts_path, manifest_path(ts_path), os.path.join(folder, f"{avid}.mp4.tmp")):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"删除临时文件: {path}")
+        except OSError as e:
+            logger.warning(f"删除临时文件失败：{e}")
+    if os.path.isdir(ts_path + ".parts"):
+        shutil.rmtree(ts_path + ".parts", ignore_errors=True)
+        logger.info(f"删除分片目录: {ts_path}.parts")
+
+
+task_store = TaskStore()
@@ -1,16 +1,79 @@
+import os
+import re
 import subprocess
+import threading
 import time
+from dataclasses import dataclass, field
+from importlib import metadata
+from typing import Dict, List, Optional
 from loguru import logger
-from patchright.sync_api import sync_playwright
+
+# 播放器请求的播放列表地址；浏览器里看到这样的请求就说明已经拿到视频流，不用再等页面加载和滚动
+STREAM_PATTERN = re.compile(r"\.m3u8(?:[?#]|$)|/playlist\b", re.IGNORECASE)
+# 下载分片时需要带上的请求头，其他（sec-*等）由curl_cffi自己生成
+_STREAM_HEADERS = {"referer": "Referer", "origin": "Origin", "user-agent": "User-Agent", "cookie": "Cookie"}
+
+
+@dataclass
+class CapturedStream:
+    """浏览器发出的播放列表请求"""
+    url: str
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class BrowserPage:
+    """浏览器获取的页面，streams是加载过程中捕获到的播放列表请求，按请求顺序"""
+    content: str
+    streams: List[CapturedStream] = field(default_factory=list)
+
+
+def capture_streams() -> bool:
+    """configs.json 中 Browser.captureStreams"""
+    from src.config_service import config_service
+    return bool(config_service.current().Browser.get("captureStreams", True))
+
+
+# 安装检查的结果缓存：进程内只检查一次，检查通过后写标记文件，之后启动不再执行 patchright install
+_install_checked = False
+_install_lock = threading.Lock()
+_install_stamp = os.path.join(os.path.expanduser("~"), ".cache", "nassavx", "patchright_chromium")
 
 def ensure_patchright_chromium_installed():
+    global _install_checked
+    if _install_checked:
+        return
+    with _install_lock:
+        if _install_checked:
+            return
+        try:
+            version = metadata.version("patchright")
+        except metadata.PackageNotFoundError:
+            version = ""
+        if version and os.path.exists(_install_stamp):
+            with open(_install_stamp, "r", encoding="utf-8") as f:
+                if f.read().strip() == version:
+                    _install_checked = True
+                    return
+        if _install_chromium() and version:
+            os.makedirs(os.path.dirname(_install_stamp), exist_ok=True)
+            with open(_install_stamp, "w", encoding="utf-8") as f:
+                f.write(version)
+        _install_checked = True
+
+def _install_chromium() -> bool:
     try:
+        logger.info("检查 Patchright Chromium 是否安装...")
         install_process = subprocess.run(
             ["patchright", "install", "chromium"],
             capture_output=True,
             text=True,
             check=False,
         )
+        if install_process.returncode != 0:
+            logger.error(f"Patchright Chromium 安装失败: {install_process.stderr}")
+            return False
+        return True
     except FileNotFoundError:
         logger.error("Patchright 命令未找到. 请确定是否安装")
         raise
@@ -18,7 +81,29 @@ def ensure_patchright_chromium_installed():
         logger.error(f"Error ensuring Chromium installation: {e}")
         raise
 
-def scrape_website_sync(url: str):
+def _wait(page, seconds: float, streams: List[CapturedStream]) -> bool:
+    """
+    代替time.sleep：同步API只有在调用page的方法时才会分发事件，sleep期间捕获不到请求。
+    捕获到播放列表时提前返回True
+    """
+    deadline = time.monotonic() + seconds
+    while not streams:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        page.wait_for_timeout(min(remaining, 0.25) * 1000)
+    return True
+
+
+def scrape_website_sync(url: str, capture: bool = True) -> Optional[BrowserPage]:
+    """
+    :capture: 监听页面发出的请求，记录匹配STREAM_PATTERN的地址和请求头；
+    捕获到之后不再等待内容元素和模拟滚动，直接返回当前页面
+    """
+    # patchright导入较慢，只在真正需要浏览器时才导入
+    from patchright.sync_api import sync_playwright
+
+    ensure_patchright_chromium_installed()
     logger.info("Scraping website...")
     with sync_playwright() as p:
         browser_args = [
@@ -51,6 +136,14 @@ def scrape_website_sync(url: str):
         )
 
         page = context.new_page()
+        streams: List[CapturedStream] = []
+        if capture:
+            def on_request(request):
+                if STREAM_PATTERN.search(request.url) and all(c.url != request.url for c in streams):
+                    headers = {_STREAM_HEADERS[k]: v for k, v in request.headers.items() if k in _STREAM_HEADERS}
+                    logger.info(f"捕获到播放列表请求: {request.url}")
+                    streams.append(CapturedStream(request.url, headers))
+            page.on("request", on_request)
         try:
             logger.info(f"Visiting {url}...")
             response = page.goto(url, wait_until="domcontentloaded")
@@ -82,17 +175,21 @@ def scrape_website_sync(url: str):
                             if page.is_visible(selector):
                                 logger.info(f"Found possible verification button: {selector}")
                                 page.click(selector)
-                                time.sleep(5)
+                                _wait(page, 5, streams)
                                 break
                     except Exception as click_error:
                         logger.error(f"Failed to click verification button: {click_error}")
 
                 logger.info("Extra wait of 10s to ensure challenge completion...")
-                time.sleep(10)
+                _wait(page, 10, streams)
 
             current_title = page.title()
             logger.info(f"Current page title: {current_title}")
 
+            if streams:
+                logger.info("已捕获到播放列表，跳过等待和滚动")
+                return BrowserPage(page.content(), list(streams))
+
             logger.info("Waiting for page content to load...")
 
             content_loaded = False
@@ -104,6 +201,8 @@ def scrape_website_sync(url: str):
                 "article",
                 "main",
             ]:
+                if streams:
+                    break
                 try:
                     page.wait_for_selector(selector, timeout=10000)
                     logger.info(f"Found content element: {selector}")
@@ -112,23 +211,26 @@ def scrape_website_sync(url: str):
                 except Exception:
                     continue
 
-            if not content_loaded:
+            if not content_loaded and not streams:
                 logger.info("No specific content element found, using fixed delay...")
-                time.sleep(10)
+                _wait(page, 10, streams)
 
-            logger.info("Simulating page scroll...")
-            for _ in range(3):
-                page.evaluate("window.scrollBy(0, window.innerHeight / 2)")
-                time.sleep(1)
+            if not streams:
+                logger.info("Simulating page scroll...")
+                for _ in range(3):
+                    page.evaluate("window.scrollBy(0, window.innerHeight / 2)")
+                    if _wait(page, 1, streams):
+                        break
 
-                page.evaluate("window.scrollBy(0, window.innerHeight / 4)")
-                time.sleep(1)
+                    page.evaluate("window.scrollBy(0, window.innerHeight / 4)")
+                    if _wait(page, 1, streams):
+                        break
 
             logger.info("Getting page content...")
             content = page.content()
             logger.info("Page content retrieved successfully.")
 
-            return content
+            return BrowserPage(content, list(streams))
         except Exception as e:
             logger.error(f"Failed to scraping: {e}")
             return None
@@ -0,0 +1,93 @@
+# doc: 任务取消。下载工具和ffmpeg用shell启动，只结束shell的话真正的下载进程还会继续占用带宽和磁盘，
+# 所以每个外部进程放在独立的进程组里，取消时结束整个进程组；进程内的分片下载、解析各阶段通过CancelToken协作式检查
+import os
+import signal
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from loguru import logger
+
+
+class TaskCancelled(Exception):
+    """任务被停止，不再尝试其他下载器"""
+
+
+class CancelToken:
+    """
+    使用方式：
+    cancel = CancelToken()
+    with cancel.process(command, shell=True, ...) as process:   # 取消时结束整个进程组
+        ...
+    cancel.check()           # 已取消时抛出TaskCancelled
+    cancel.wait(delay)       # 代替time.sleep，取消时立即返回True
+    cancel.cancel()          # 可以在任何线程调用
+    """
+    def __init__(self, kill_timeout: float = 5):
+        self.kill_timeout = kill_timeout
+        self.reason = ""
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes: List[subprocess.Popen] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "任务已停止"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            processes = list(self._processes)
+        for process in processes:
+            kill_process_group(process, self.kill_timeout)
+
+    def check(self):
+        if self._event.is_set():
+            raise TaskCancelled(self.reason)
+
+    def wait(self, timeout: float) -> bool:
+        return self._event.wait(timeout)
+
+    @contextmanager
+    def process(self, command, **kwargs) -> Iterator[subprocess.Popen]:
+        """启动外部进程；退出with时进程还在运行（读取输出时出错）也会结束整个进程组"""
+        if os.name == "nt":
+            kwargs.setdefault("creationflags", subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            kwargs.setdefault("start_new_session", True)
+        with self._lock:
+            self.check()
+            process = subprocess.Popen(command, **kwargs)
+            self._processes.append(process)
+        try:
+            yield process
+        finally:
+            with self._lock:
+                self._processes.remove(process)
+            if process.poll() is None:
+                kill_process_group(process, self.kill_timeout)
+
+
+def kill_process_group(process: subprocess.Popen, timeout: float = 5):
+    """先SIGTERM整个进程组，timeout秒后还没退出的SIGKILL"""
+    logger.info(f"停止进程：{process.pid}")
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)], capture_output=True)
+            return
+        # start_new_session 启动的进程，进程组id就是它的pid
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("进程没有正常退出，强制结束")
+        # shell已经退出，组里的子进程可能还在
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    except Exception as e:
+        logger.error(f"停止进程时出错：{e}")
@@ -0,0 +1,225 @@
+# doc: HLS分片解密（#EXT-X-KEY METHOD=AES-128，整个分片AES-128-CBC + PKCS7填充）
+# 解密是CPU密集的，默认放在进程池里执行，不和下载线程争抢GIL；分片数据放在共享内存里交给子进程，不经过pickle复制
+# 依赖cryptography，没有安装时加密的分片下载失败，不影响不加密的视频
+import atexit
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Callable, List, Optional
+
+from loguru import logger
+
+from src.util.fetch_cache import ResponseCache, SingleFlight
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+BLOCK_SIZE = 16
+
+
+def available() -> bool:
+    return Cipher is not None
+
+
+def decrypt_into(buffer, length: int, key: bytes, iv: bytes) -> int:
+    """解密buffer[:length]，明文写回buffer开头，返回明文长度"""
+    if length % BLOCK_SIZE:
+        raise ValueError(f"密文长度不是{BLOCK_SIZE}的整数倍: {length}")
+    view = memoryview(buffer)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    # CBC解密的输出最多比输入多一个块，直接写回同一块内存
+    written = decryptor.update_into(view[:length], view) if length else 0
+    written += len(decryptor.finalize())
+    pad = view[written - 1] if written else 0
+    if not 0 < pad <= BLOCK_SIZE or view[written - pad:written] != bytes([pad]) * pad:
+        raise ValueError("PKCS7填充错误，密钥或IV不对")
+    return written - pad
+
+
+# 子进程里已经打开的共享内存，缓冲区会被反复使用，不用每个分片重新映射
+_attached: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+
+
+def _decrypt_shared(name: str, length: int, key: bytes, iv: bytes) -> int:
+    """在进程池的子进程里执行"""
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+        # 主进程扩容或回收缓冲区后旧的名字不会再用到
+        while len(_attached) > 64:
+            _attached.popitem(last=False)[1].close()
+    _attached.move_to_end(name)
+    return decrypt_into(shm.buf, length, key, iv)
+
+
+class SegmentBuffer:
+    """一个分片的密文缓冲区，不够时自动扩容。shared为True时使用共享内存"""
+    def __init__(self, capacity: int, shared: bool):
+        self.shared = shared
+        self.length = 0
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._data: Optional[bytearray] = None
+        self._allocate(capacity)
+
+    @property
+    def capacity(self) -> int:
+        return self._shm.size if self._shm is not None else len(self._data)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def buf(self) -> memoryview:
+        return self._shm.buf if self._shm is not None else memoryview(self._data)
+
+    def write(self, chunk: bytes):
+        end = self.length + len(chunk)
+        # CBC解密写回时需要多一个块的空间
+        if end + BLOCK_SIZE > self.capacity:
+            self._grow(max(end + BLOCK_SIZE, self.capacity * 2))
+        self.buf[self.length:end] = chunk
+        self.length = end
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        self._data = None
+
+    def _allocate(self, capacity: int):
+        if self.shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=capacity)
+        else:
+            self._data = bytearray(capacity)
+
+    def _grow(self, capacity: int):
+        old_shm, old_data, length = self._shm, self._data, self.length
+        self._allocate(capacity)
+        if old_shm is not None:
+            self._shm.buf[:length] = old_shm.buf[:length]
+            old_shm.close()
+            old_shm.unlink()
+        else:
+            self._data[:length] = old_data[:length]
+
+
+class KeyCache:
+    """
+    解密密钥缓存，同一个视频的分片通常共用一个密钥地址，只请求一次；多个线程同时请求时只发一次
+    使用方式：
+    key = key_cache.get_or_load(uri, loader)   # loader(uri) 返回密钥bytes，失败返回None
+    """
+    def __init__(self, ttl: float = 3600, maxsize: int = 64):
+        self.ttl = ttl
+        self._cache = ResponseCache(maxsize=maxsize)
+        self._singleflight = SingleFlight()
+
+    def get_or_load(self, uri: str, loader: Callable[[str], Optional[bytes]]) -> Optional[bytes]:
+        key = self._cache.get(uri)
+        if key is not None:
+            return key
+
+        def load():
+            cached = self._cache.get(uri)
+            if cached is not None:
+                return cached
+            loaded = loader(uri)
+            if loaded is None:
+                return None
+            if len(loaded) != BLOCK_SIZE:
+                logger.error(f"密钥长度不对（{len(loaded)}字节）: {uri}")
+                return None
+            self._cache.put(uri, loaded, self.ttl)
+            return loaded
+
+        return self._singleflight.do(uri, load)
+
+
+class Decryptor:
+    """
+    配置示例（configs.json）：
+    "Decryption": {"offload": true, "workers": 2, "bufferMB": 4}
+    offload为false时在下载线程里直接解密；bufferMB是每个缓冲区的初始大小，分片更大时自动扩容
+    使用方式：
+    buffer = decryptor.acquire()
+    buffer.write(chunk)                              # 下载时写入密文
+    length = decryptor.decrypt(buffer, key, iv)      # 明文在 buffer.buf[:length]
+    decryptor.release(buffer)
+    """
+    def __init__(self, keep: int = 16):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._free: List[SegmentBuffer] = []
+        self._workers = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def acquire(self) -> SegmentBuffer:
+        options = self._options()
+        shared = bool(options.get("offload", True))
+        with self._lock:
+            while self._free:
+                buffer = self._free.pop()
+                if buffer.shared == shared:
+                    buffer.length = 0
+                    return buffer
+                buffer.close()
+        return SegmentBuffer(int(float(options.get("bufferMB", 4)) * 1024 * 1024), shared)
+
+    def release(self, buffer: SegmentBuffer):
+        with self._lock:
+            if len(self._free) < self.keep:
+                self._free.append(buffer)
+                return
+        buffer.close()
+
+    def decrypt(self, buffer: SegmentBuffer, key: bytes, iv: bytes) -> int:
+        if not buffer.shared:
+            return decrypt_into(buffer.buf, buffer.length, key, iv)
+        pool = self._get_pool(int(self._options().get("workers", 2)))
+        try:
+            return pool.submit(_decrypt_shared, buffer.name, buffer.length, key, iv).result()
+        except BrokenProcessPool:
+            # 子进程异常退出，重建进程池，这个分片在当前线程解密
+            logger.warning("解密进程池异常，重新创建")
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return decrypt_into(buffer.buf, buffer.length, key, iv)
+
+    def close(self):
+        """退出时释放缓冲区，共享内存不会随进程退出自动删除"""
+        with self._lock:
+            free, self._free = self._free, []
+            pool, self._pool = self._pool, None
+        for buffer in free:
+            buffer.close()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _get_pool(self, workers: int) -> ProcessPoolExecutor:
+        workers = max(workers, 1)
+        with self._lock:
+            if self._pool is None or workers != self._workers:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                self._workers = workers
+                # 主进程里有多个线程，fork出来的子进程可能卡在别的线程持有的锁上，使用spawn
+                self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    @staticmethod
+    def _options() -> dict:
+        from src.config_service import config_service
+        return config_service.current().Decryption
+
+
+key_cache = KeyCache()
+decryptor = Decryptor()
+atexit.register(decryptor.close)
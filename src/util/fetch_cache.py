@@ -0,0 +1,113 @@
+# doc: 请求去重和短期缓存
+# 并发任务、备用源解析会同时请求同一个搜索页、master playlist，相同的请求只发一次，其他线程等待并共享结果
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    """
+    使用方式：
+    result = singleflight.do(key, lambda: fetch(url))
+    同一个key正在执行时，后来的调用不再执行fn，等第一个调用结束后返回同一个结果（异常也一样抛出）
+    """
+    class _Call:
+        __slots__ = ("done", "result", "error", "waiters")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, "SingleFlight._Call"] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class ResponseCache:
+    """
+    带过期时间的LRU缓存，按条目数和总字节数限制大小，超出时淘汰最久没有用到的条目
+    :sizeof: 计算条目大小，默认bytes/str按长度计算，其他对象不计大小
+    """
+    def __init__(self, maxsize: int = 256, max_bytes: int = 64 * 1024 * 1024,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda v: len(v) if isinstance(v, (bytes, str)) else 0)
+        self._items: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, size, value = item
+            if time.monotonic() >= expires:
+                del self._items[key]
+                self._bytes -= size
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, ttl: float):
+        size = self.sizeof(value)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+            while self._items and (len(self._items) > self.maxsize or self._bytes > self.max_bytes):
+                _, (_, evicted, _) = self._items.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes}
+
+
+def cache_ttl(name: str, default: float = 0) -> float:
+    """configs.json 中 FetchCache 的过期时间（秒），如 cache_ttl("searchTTL")"""
+    from src.config_service import config_service
+    return float(config_service.current().FetchCache.get(name, default))
+
+
+singleflight = SingleFlight()
+response_cache = ResponseCache()
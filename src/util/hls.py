@@ -0,0 +1,242 @@
+# doc: HLS播放列表解析，以及按策略选择清晰度
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urljoin
+
+from loguru import logger
+
+from src.util.fetch_cache import ResponseCache, SingleFlight
+
+# 属性列表：KEY=VALUE，VALUE可能带引号，且引号内可能有逗号（如CODECS）
+_ATTR_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+@dataclass
+class Variant:
+    """master playlist中的一个清晰度"""
+    url: str
+    bandwidth: int = 0
+    width: int = 0
+    height: int = 0
+    codecs: str = ""
+
+    @property
+    def resolution(self) -> str:
+        return f"{self.width}x{self.height}" if self.height else "未知"
+
+
+@dataclass
+class MasterPlaylist:
+    url: str
+    variants: List[Variant] = field(default_factory=list)
+
+
+@dataclass
+class SegmentKey:
+    """#EXT-X-KEY，目前只支持 METHOD=AES-128（整个分片AES-128-CBC加密）"""
+    method: str
+    uri: str
+    iv: Optional[bytes] = None
+
+
+@dataclass
+class MediaSegment:
+    url: str
+    duration: float = 0.0
+    key: Optional[SegmentKey] = None
+    sequence: int = 0
+
+    @property
+    def iv(self) -> bytes:
+        """没有指定IV时使用分片序号（大端128位）"""
+        if self.key is not None and self.key.iv is not None:
+            return self.key.iv
+        return self.sequence.to_bytes(16, "big")
+
+
+@dataclass
+class MediaPlaylist:
+    url: str
+    segments: List[MediaSegment] = field(default_factory=list)
+    target_duration: float = 0.0
+
+    @property
+    def total_duration(self) -> float:
+        return sum(seg.duration for seg in self.segments)
+
+
+def parse_attributes(line: str) -> Dict[str, str]:
+    """解析 #EXT-X-XXX: 后面的属性列表，不依赖属性顺序"""
+    attrs = {}
+    _, _, attr_str = line.partition(":")
+    for key, value in _ATTR_PATTERN.findall(attr_str):
+        attrs[key] = value.strip('"')
+    return attrs
+
+
+def is_master_playlist(text: str) -> bool:
+    return "#EXT-X-STREAM-INF" in text
+
+
+def parse_master_playlist(text: str, base_url: str) -> MasterPlaylist:
+    master = MasterPlaylist(url=base_url)
+    attrs = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF"):
+            attrs = parse_attributes(line)
+        elif not line.startswith("#") and attrs is not None:
+            variant = Variant(url=urljoin(base_url, line))
+            try:
+                variant.bandwidth = int(attrs.get("BANDWIDTH") or attrs.get("AVERAGE-BANDWIDTH") or 0)
+            except ValueError:
+                pass
+            if resolution := re.match(r"(\d+)x(\d+)", attrs.get("RESOLUTION", "")):
+                variant.width, variant.height = int(resolution.group(1)), int(resolution.group(2))
+            variant.codecs = attrs.get("CODECS", "")
+            master.variants.append(variant)
+            attrs = None
+    return master
+
+
+def parse_key(line: str, base_url: str) -> Optional[SegmentKey]:
+    attrs = parse_attributes(line)
+    method = attrs.get("METHOD", "NONE").upper()
+    if method == "NONE":
+        return None
+    iv = None
+    if value := attrs.get("IV"):
+        try:
+            iv = bytes.fromhex(value[2:] if value.lower().startswith("0x") else value).rjust(16, b"\0")
+        except ValueError:
+            logger.warning(f"无效的IV: {value}")
+    if method != "AES-128":
+        logger.warning(f"不支持的加密方式: {method}")
+    return SegmentKey(method=method, uri=urljoin(base_url, attrs.get("URI", "")), iv=iv)
+
+
+def parse_media_playlist(text: str, base_url: str) -> MediaPlaylist:
+    playlist = MediaPlaylist(url=base_url)
+    duration = None
+    key = None
+    sequence = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXTINF"):
+            try:
+                duration = float(line.partition(":")[2].split(",")[0])
+            except ValueError:
+                duration = 0.0
+        elif line.startswith("#EXT-X-TARGETDURATION"):
+            try:
+                playlist.target_duration = float(line.partition(":")[2])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE"):
+            try:
+                sequence = int(line.partition(":")[2])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-KEY"):
+            # 对之后的分片生效，直到下一个 #EXT-X-KEY
+            key = parse_key(line, base_url)
+        elif not line.startswith("#") and duration is not None:
+            playlist.segments.append(MediaSegment(url=urljoin(base_url, line), duration=duration, key=key, sequence=sequence))
+            duration = None
+            sequence += 1
+    return playlist
+
+
+@dataclass
+class VariantPolicy:
+    """
+    清晰度选择策略：
+    max_resolution: 不超过maxHeight的最高清晰度（0表示不限制）
+    max_bitrate: 不超过maxBandwidth的最高码率（0表示不限制）
+    size_budget: 预估体积不超过sizeBudgetMB的最高码率，需要知道片长
+    """
+    mode: str = "max_resolution"
+    max_height: int = 720
+    max_bandwidth: int = 0
+    size_budget_mb: int = 0
+
+    @classmethod
+    def from_config(cls, cfg: Optional[dict]) -> "VariantPolicy":
+        cfg = cfg or {}
+        return cls(
+            mode=cfg.get("mode", "max_resolution"),
+            max_height=int(cfg.get("maxHeight", 720)),
+            max_bandwidth=int(cfg.get("maxBandwidth", 0)),
+            size_budget_mb=int(cfg.get("sizeBudgetMB", 0)),
+        )
+
+
+def estimate_size(variant: Variant, duration: float) -> int:
+    """根据码率和片长预估文件大小（字节）"""
+    return int(variant.bandwidth / 8 * duration)
+
+
+def select_variant(variants: List[Variant], policy: VariantPolicy, duration: float = 0.0) -> Optional[Variant]:
+    if not variants:
+        return None
+
+    # 按(高度, 码率)降序，优先清晰度，同清晰度选码率高的
+    by_quality = sorted(variants, key=lambda v: (v.height, v.bandwidth), reverse=True)
+    by_bandwidth = sorted(variants, key=lambda v: v.bandwidth, reverse=True)
+
+    if policy.mode == "size_budget" and policy.size_budget_mb > 0:
+        if duration <= 0:
+            logger.warning("未知片长，体积预算策略退化为清晰度策略")
+        else:
+            budget = policy.size_budget_mb * 1024 * 1024
+            for variant in by_bandwidth:
+                if estimate_size(variant, duration) <= budget:
+                    return variant
+            return by_bandwidth[-1]
+
+    if policy.mode == "max_bitrate":
+        for variant in by_bandwidth:
+            if not policy.max_bandwidth or variant.bandwidth <= policy.max_bandwidth:
+                return variant
+        return by_bandwidth[-1]
+
+    for variant in by_quality:
+        if not policy.max_height or variant.height <= policy.max_height:
+            return variant
+    return by_quality[-1]
+
+
+class PlaylistCache:
+    """
+    播放列表缓存，避免重试时重复请求和解析；多个线程同时加载同一个地址时只请求一次。
+    签名的m3u8地址会过期，所以只缓存较短时间
+    """
+    def __init__(self, ttl: float = 600, maxsize: int = 64):
+        self.ttl = ttl
+        self._cache = ResponseCache(maxsize=maxsize)
+        self._singleflight = SingleFlight()
+
+    def get_or_load(self, url: str, loader: Callable[[str], Optional[object]]) -> Optional[object]:
+        value = self._cache.get(url)
+        if value is not None:
+            return value
+
+        def load():
+            # 等待期间其他线程可能已经加载完成
+            cached = self._cache.get(url)
+            if cached is not None:
+                return cached
+            loaded = loader(url)
+            if loaded is not None:
+                self._cache.put(url, loaded, self.ttl)
+            return loaded
+
+        return self._singleflight.do(url, load)
+
+
+playlist_cache = PlaylistCache()
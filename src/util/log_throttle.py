@@ -0,0 +1,57 @@
+# doc: 外部工具（下载工具、ffmpeg）输出的限流。进度行每秒可能有几十行，每隔一段时间只输出最新的一行，
+# 中间的合并成计数；其他行原样输出。读取子进程输出的循环里只做很少的工作，尽快把管道读空
+import re
+import time
+from typing import Callable, Optional
+
+# 百分比、n/m 计数、ffmpeg的 frame=/size=/time= 状态行
+PROGRESS_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*%|\b\d+\s*/\s*\d+\b|^(?:frame|size)=|\btime=\d")
+
+
+class ThrottledOutput:
+    """
+    使用方式：
+    output = ThrottledOutput(lambda line: logger.info(f"[FFmpeg] {line}"), interval=2)
+    for line in ...:
+        output.feed(line)
+    output.close()   # 输出最后一条被合并的进度行
+    interval为0时不限流
+    """
+    def __init__(self, emit: Callable[[str], None], interval: float = 2.0):
+        self.emit = emit
+        self.interval = interval
+        self._last = 0.0
+        self._pending: Optional[str] = None
+        self._skipped = 0
+
+    def feed(self, line: str):
+        line = line.strip()
+        if not line:
+            return
+        if not self.interval or not PROGRESS_PATTERN.search(line):
+            self.emit(line)
+            return
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            self._pending = line
+            self._skipped += 1
+            return
+        self._last = now
+        self._emit_progress(line)
+
+    def close(self):
+        if self._pending is not None:
+            self._emit_progress(self._pending)
+
+    def _emit_progress(self, line: str):
+        # 刚输出的这一行不算省略
+        skipped = self._skipped - (1 if line is self._pending else 0)
+        self.emit(f"{line}（省略{skipped}行进度）" if skipped > 0 else line)
+        self._pending = None
+        self._skipped = 0
+
+
+def progress_interval() -> float:
+    """configs.json 中 Logging.progressInterval（秒）"""
+    from src.config_service import config_service
+    return float(config_service.current().Logging.get("progressInterval", 2))
@@ -0,0 +1,205 @@
+# doc: 下载后的媒体文件处理：ts转mp4，以及mp4完整性校验（时长、moov、抽样解码）
+# 校验函数会在进程池里执行，只依赖标准库，不打日志，结果通过返回值带回
+import bisect
+import json
+import os
+import struct
+import subprocess
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from src.util.cancel import CancelToken
+
+
+@dataclass
+class SegmentInfo:
+    """分片在合并后的ts中的位置；offset为None表示下载工具合并的ts，不知道分片位置"""
+    duration: float
+    offset: Optional[int] = None
+    size: Optional[int] = None
+
+
+@dataclass
+class SegmentManifest:
+    """
+    {ts_path}.manifest.json，记录ts由哪些分片组成，以及下载地址，校验失败时用于只重新下载坏掉的分片。
+    校验通过后和ts一起删除
+    """
+    url: str
+    headers: dict = field(default_factory=dict)
+    name: str = ""
+    segments: List[SegmentInfo] = field(default_factory=list)
+
+    @property
+    def total_duration(self) -> float:
+        return sum(seg.duration for seg in self.segments)
+
+    @property
+    def has_offsets(self) -> bool:
+        return bool(self.segments) and all(seg.offset is not None for seg in self.segments)
+
+    def segment_at(self, position: float) -> int:
+        """播放位置（秒）所在的分片序号"""
+        starts = []
+        elapsed = 0.0
+        for seg in self.segments:
+            starts.append(elapsed)
+            elapsed += seg.duration
+        return max(bisect.bisect_right(starts, position) - 1, 0)
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "url": self.url,
+                "headers": self.headers,
+                "name": self.name,
+                "segments": [[seg.duration, seg.offset, seg.size] for seg in self.segments],
+            }, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SegmentManifest"]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(
+                url=data["url"],
+                headers=data.get("headers", {}),
+                name=data.get("name", ""),
+                segments=[SegmentInfo(*seg) for seg in data["segments"]],
+            )
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+
+def manifest_path(ts_path: str) -> str:
+    return ts_path + ".manifest.json"
+
+
+@dataclass
+class VerifyResult:
+    ok: bool
+    reason: str = ""
+    duration: Optional[float] = None     # ffprobe读到的时长，读不到为None
+    expected: float = 0.0                # 播放列表EXTINF总时长
+    remux: bool = False                  # ts没问题，只需要重新转码
+    bad_segments: List[int] = field(default_factory=list)
+
+
+def remux(ffmpeg_tool: str, ts_path: str, mp4_path: str, on_output=None,
+          cancel: Optional[CancelToken] = None) -> bool:
+    """
+    ffmpeg -c copy 转mp4，先写临时文件再改名，中断时不会留下不完整的mp4
+    :on_output: 每行ffmpeg输出的回调
+    :cancel: 停止任务时结束ffmpeg
+    """
+    tmp_path = mp4_path + ".tmp"
+    command = f'{ffmpeg_tool} -y -i "{ts_path}" -c copy -f mp4 "{tmp_path}"'
+    with (cancel or CancelToken()).process(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1
+    ) as process:
+        for line in iter(process.stdout.readline, ''):
+            if line.strip() and on_output is not None:
+                on_output(line.strip())
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0 or not os.path.exists(tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    os.replace(tmp_path, mp4_path)
+    return True
+
+
+def has_moov_atom(mp4_path: str) -> bool:
+    """遍历mp4顶层box，有moov且各box长度与文件大小吻合"""
+    try:
+        file_size = os.path.getsize(mp4_path)
+        with open(mp4_path, "rb") as f:
+            position = 0
+            found = False
+            while position + 8 <= file_size:
+                f.seek(position)
+                size, box_type = struct.unpack(">I4s", f.read(8))
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                elif size == 0:
+                    size = file_size - position
+                if size < 8 or position + size > file_size:
+                    return False
+                found = found or box_type == b"moov"
+                position += size
+            return found and position == file_size
+    except (OSError, struct.error):
+        return False
+
+
+def probe_duration(ffprobe_tool: str, path: str, timeout: float = 60) -> Optional[float]:
+    command = f'{ffprobe_tool} -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{path}"'
+    try:
+        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
+        return float(result.stdout.strip())
+    except (subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+def decode_ok(ffmpeg_tool: str, path: str, position: float, seconds: float = 2, timeout: float = 60) -> bool:
+    """从position开始解码几秒，有错误输出或返回码不为0都算失败"""
+    command = f'{ffmpeg_tool} -v error -xerror -ss {position:.3f} -i "{path}" -t {seconds} -f null -'
+    try:
+        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False
+    return result.returncode == 0 and not result.stderr.strip()
+
+
+def verify_mp4(ffmpeg_tool: str, ffprobe_tool: str, mp4_path: str, manifest: Optional[SegmentManifest],
+               sample_points: int = 3, tolerance: float = 2.0) -> VerifyResult:
+    """
+    校验转出的mp4：
+    1. moov box存在且文件结构完整，否则只需重新转码
+    2. ffprobe时长与播放列表EXTINF总时长相差不超过tolerance秒，短了则认为末尾的分片有问题
+    3. 在均匀分布的几个位置抽样解码，解码失败的位置对应的分片需要重新下载
+    """
+    if not os.path.exists(mp4_path) or os.path.getsize(mp4_path) == 0:
+        return VerifyResult(ok=False, reason="mp4不存在或为空", remux=True)
+    if not has_moov_atom(mp4_path):
+        return VerifyResult(ok=False, reason="mp4缺少moov或文件结构不完整", remux=True)
+
+    expected = manifest.total_duration if manifest else 0.0
+    duration = probe_duration(ffprobe_tool, mp4_path)
+    result = VerifyResult(ok=True, duration=duration, expected=expected)
+    if duration is None:
+        result.reason = "无法读取时长，跳过时长校验"
+        # 读不到时长时按EXTINF时长抽样
+        duration = expected
+
+    bad = set()
+    if manifest and expected and result.duration is not None and result.duration < expected - tolerance:
+        first_missing = manifest.segment_at(result.duration)
+        bad.update(range(first_missing, len(manifest.segments)))
+        result.reason = f"时长不足 {result.duration:.1f}s / {expected:.1f}s"
+
+    if duration and sample_points > 0:
+        for i in range(1, sample_points + 1):
+            position = duration * i / (sample_points + 1)
+            if decode_ok(ffmpeg_tool, mp4_path, position):
+                continue
+            if not manifest:
+                bad.add(-1)
+            else:
+                bad.add(manifest.segment_at(position))
+            result.reason = (result.reason + "; " if result.reason else "") + f"{position:.0f}s处解码失败"
+
+    if bad:
+        result.ok = False
+        result.bad_segments = sorted(i for i in bad if i >= 0)
+    return result
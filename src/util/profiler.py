@@ -0,0 +1,109 @@
+# doc: 可选的性能分析。分阶段统计耗时（墙钟时间和CPU时间），以及限时的采样分析（输出火焰图用的折叠栈格式）
+# 阶段统计需要在配置中开启 "Profiling": {"enable": true}，关闭时 stage() 几乎没有开销
+import contextlib
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+
+class StageStats:
+    __slots__ = ("count", "wall", "cpu", "max_wall")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "wall_total_s": round(self.wall, 4),
+            "cpu_total_s": round(self.cpu, 4),
+            "wall_avg_s": round(self.wall / self.count, 4) if self.count else 0,
+            "wall_max_s": round(self.max_wall, 4),
+        }
+
+
+_stats: Dict[str, StageStats] = {}
+_stats_lock = threading.Lock()
+_sampling_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    from src.config_service import config_service
+    return bool(config_service.latest().Profiling.get("enable", False))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    统计一个阶段的耗时：
+    with stage("downloadDirect.getHTML"): ...
+    CPU时间用的是当前线程的CPU时间，不包含子进程（下载工具、ffmpeg）
+    """
+    if not is_enabled():
+        yield
+        return
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+
+def record(name: str, wall: float, cpu: float):
+    """记录一次阶段耗时，用于不方便用 with stage() 包住的地方"""
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = StageStats()
+        stats.count += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.max_wall = max(stats.max_wall, wall)
+
+
+def get_stage_stats() -> Dict[str, Dict]:
+    with _stats_lock:
+        return {name: stats.to_dict() for name, stats in sorted(_stats.items())}
+
+
+def reset_stage_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def sample(seconds: float = 10, interval: float = 0.005, thread_name: Optional[str] = None) -> str:
+    """
+    限时采样分析：每隔interval秒记录一次所有线程的调用栈，返回折叠栈格式
+    （每行 "线程名;函数 (文件:行号);... 次数"），可直接交给 flamegraph.pl / speedscope
+    :thread_name: 只采样名字包含该字符串的线程
+    """
+    if not _sampling_lock.acquire(blocking=False):
+        raise RuntimeError("已有采样分析在运行")
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                name = names.get(ident, str(ident))
+                if thread_name and thread_name not in name:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[";".join([name] + frames[::-1])] += 1
+            time.sleep(interval)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    finally:
+        _sampling_lock.release()
@@ -0,0 +1,252 @@
+# doc: 代理池，定期探测各代理（以及直连）的可用性和延迟，按域名和请求类型选择线路
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from curl_cffi import requests
+from curl_cffi.requests.exceptions import ConnectionError as CurlConnectionError, ProxyError, Timeout
+from loguru import logger
+
+# 请求类型
+PAGE = "page"
+PLAYLIST = "playlist"
+SEGMENT = "segment"
+
+# 线路
+ROUTE_DIRECT = "direct"  # 只直连
+ROUTE_PROXY = "proxy"    # 只走代理，选延迟最低的
+ROUTE_POOL = "pool"      # 代理和直连都可以，按延迟加权分散，提高总吞吐
+
+
+@dataclass
+class ProxyState:
+    proxy: Optional[str]  # None表示直连
+    healthy: bool = True
+    latency: float = 1.0  # 秒，未探测前给个默认值
+    failures: int = 0
+    disabled_at: float = 0.0  # 停用的时间，冷却后重新试用
+
+    @property
+    def name(self) -> str:
+        return self.proxy or "直连"
+
+
+class ProxyPool:
+    """
+    使用方式：
+    pool = get_proxy_pool()
+    for proxy in pool.candidates(url, SEGMENT): ...  # 第一个是按规则选出的线路，后面是备用
+    pool.report_status(proxy, response.status_code) # 拿到响应后按状态码反馈
+    pool.report_error(proxy, e)                     # 请求异常时反馈，只有连接阶段的错误算线路失败
+    连续失败的线路暂时摘除，冷却retry_after秒后重新试用，再失败一次就继续停用
+    """
+    MAX_FAILURES = 3
+
+    def __init__(self, proxies: List[str], include_direct: bool = True, probe_url: str = "",
+                 probe_interval: float = 300, probe_timeout: float = 5, retry_after: float = 60,
+                 default_route: Optional[Dict[str, str]] = None, rules: Optional[List[dict]] = None):
+        self.states: List[ProxyState] = [ProxyState(p) for p in proxies if p]
+        if include_direct or not self.states:
+            self.states.append(ProxyState(None))
+        self.probe_url = probe_url
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.retry_after = retry_after
+        self.default_route = {PAGE: ROUTE_DIRECT, PLAYLIST: ROUTE_DIRECT, SEGMENT: ROUTE_PROXY}
+        self.default_route.update(default_route or {})
+        self.rules = rules or []
+        self._lock = threading.Lock()
+        self._prober: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    @classmethod
+    def from_config(cls, configs: dict) -> "ProxyPool":
+        """没有配置ProxyPool时，按旧的Proxy/IsNeedVideoProxy行为构造"""
+        cfg = configs.get("ProxyPool")
+        if cfg is None:
+            proxy = configs.get("Proxy") or None
+            return cls(
+                proxies=[proxy] if proxy else [],
+                default_route={SEGMENT: ROUTE_PROXY if configs.get("IsNeedVideoProxy") else ROUTE_DIRECT},
+            )
+        return cls(
+            proxies=cfg.get("proxies", []),
+            include_direct=cfg.get("includeDirect", True),
+            probe_url=cfg.get("probeUrl", ""),
+            probe_interval=cfg.get("probeInterval", 300),
+            probe_timeout=cfg.get("probeTimeout", 5),
+            retry_after=cfg.get("retryAfter", 60),
+            default_route=cfg.get("defaultRoute"),
+            rules=cfg.get("rules"),
+        )
+
+    def candidates(self, url: str, kind: str = PAGE) -> List[Optional[str]]:
+        """返回按优先级排列的线路，重试时依次使用"""
+        self._ensure_prober()
+        route = self._match_route(url, kind)
+        with self._lock:
+            self._readmit()
+            healthy = [s for s in self.states if s.healthy] or list(self.states)
+            by_latency = sorted(healthy, key=lambda s: s.latency)
+
+        if route == ROUTE_DIRECT:
+            preferred = [s for s in by_latency if s.proxy is None]
+        elif route == ROUTE_PROXY:
+            preferred = [s for s in by_latency if s.proxy is not None]
+        elif route == ROUTE_POOL:
+            preferred = self._spread(by_latency)
+        else:
+            # 规则里直接写了代理地址
+            preferred = [s for s in self.states if s.proxy == route] or [ProxyState(route)]
+
+        # 其他健康线路作为备用，相当于以前的"代理失败换直连，直连失败换代理"
+        ordered = preferred + [s for s in by_latency if s not in preferred]
+        return [s.proxy for s in ordered]
+
+    def report(self, proxy: Optional[str], ok: bool):
+        """ok只表示这条线路能不能把请求送到并拿回响应，与源站返回什么无关"""
+        with self._lock:
+            for state in self.states:
+                if state.proxy == proxy:
+                    if ok:
+                        state.failures = 0
+                        state.healthy = True
+                    else:
+                        state.failures += 1
+                        if state.failures >= self.MAX_FAILURES and state.healthy:
+                            state.healthy = False
+                            state.disabled_at = time.monotonic()
+                            logger.warning(f"线路 {state.name} 连续失败，暂时停用")
+                    return
+
+    def report_status(self, proxy: Optional[str], status: int):
+        """
+        按响应状态码反馈：407是代理本身拒绝了请求，算线路失败；
+        其他4xx/5xx是源站返回的，换线路也一样，不影响线路状态
+        """
+        if status == 407:
+            self.report(proxy, False)
+        elif status < 400:
+            self.report(proxy, True)
+
+    def report_error(self, proxy: Optional[str], error: Exception):
+        """请求没有拿到响应时反馈，只有连接阶段的错误算线路失败，见 is_route_error"""
+        if is_route_error(error):
+            self.report(proxy, False)
+
+    def _readmit(self):
+        """停用超过retry_after秒的线路重新试用，没有配置probeUrl时也能恢复；再失败一次就继续停用"""
+        now = time.monotonic()
+        for state in self.states:
+            if not state.healthy and self.retry_after > 0 and now - state.disabled_at >= self.retry_after:
+                state.healthy = True
+                state.failures = self.MAX_FAILURES - 1
+                logger.info(f"线路 {state.name} 停用已超过 {self.retry_after:g} 秒，重新试用")
+
+    def probe_all(self):
+        """探测所有线路的可用性和延迟"""
+        if not self.probe_url:
+            return
+        for state in list(self.states):
+            start = time.monotonic()
+            try:
+                response = requests.get(
+                    url=self.probe_url,
+                    proxies={"http": state.proxy, "https": state.proxy} if state.proxy else None,
+                    timeout=self.probe_timeout,
+                    verify=False,
+                )
+                ok = response.status_code < 500
+            except Exception as e:
+                logger.debug(f"线路 {state.name} 探测失败: {e}")
+                ok = False
+            with self._lock:
+                if state.healthy and not ok:
+                    state.disabled_at = time.monotonic()
+                state.healthy = ok
+                state.failures = 0 if ok else self.MAX_FAILURES
+                if ok:
+                    state.latency = time.monotonic() - start
+        logger.debug(f"线路状态: {[(s.name, s.healthy, round(s.latency, 3)) for s in self.states]}")
+
+    def _match_route(self, url: str, kind: str) -> str:
+        host = urlparse(url).hostname or ""
+        for rule in self.rules:
+            domain = rule.get("domain", "")
+            if domain and host != domain and not host.endswith("." + domain):
+                continue
+            if rule.get("type", "*") not in ("*", kind):
+                continue
+            return rule.get("route", ROUTE_POOL)
+        return self.default_route.get(kind, ROUTE_DIRECT)
+
+    @staticmethod
+    def _spread(states: List[ProxyState]) -> List[ProxyState]:
+        """按延迟倒数加权随机排序，分片请求分散到各线路上"""
+        remaining = list(states)
+        ordered = []
+        while remaining:
+            weights = [1 / max(s.latency, 0.01) for s in remaining]
+            chosen = random.choices(remaining, weights=weights)[0]
+            ordered.append(chosen)
+            remaining.remove(chosen)
+        return ordered
+
+    def _ensure_prober(self):
+        """第一次使用时才启动探测线程，不拖慢启动"""
+        if self._prober is not None or not self.probe_url or self.probe_interval <= 0:
+            return
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(target=self._probe_loop, daemon=True)
+            self._prober.start()
+
+    def close(self):
+        """停止探测线程"""
+        self._closed.set()
+
+    def _probe_loop(self):
+        while not self._closed.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f"线路探测异常: {e}")
+            self._closed.wait(self.probe_interval)
+
+
+def is_route_error(error: Exception) -> bool:
+    """
+    连接阶段的错误（连不上代理或目标、DNS解析、TLS握手失败、超时没拿到响应）才是线路的问题。
+    只对请求还没拿到响应时的异常调用；拿到响应之后的停滞、断开、内容不完整不算线路失败
+    """
+    return isinstance(error, (CurlConnectionError, ProxyError, Timeout))
+
+
+_pool: Optional[ProxyPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_proxy_pool() -> ProxyPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from src.config_service import config_service
+                _pool = ProxyPool.from_config(config_service.latest().model_dump())
+                config_service.on_change(_on_config_change)
+    return _pool
+
+
+def _on_config_change(old, new):
+    """代理配置变化时重建代理池，已经拿到旧代理池的任务继续用旧的"""
+    global _pool
+    keys = ("ProxyPool", "Proxy", "IsNeedVideoProxy")
+    if any(getattr(old, key) != getattr(new, key) for key in keys):
+        with _pool_lock:
+            old_pool, _pool = _pool, ProxyPool.from_config(new.model_dump())
+        old_pool.close()
+        logger.info("代理配置已更新")
@@ -0,0 +1,36 @@
+# doc: 按域名限速。同一个站点的页面请求之间至少间隔 RateLimit.pageInterval 秒，
+# 下载任务、元数据刮削、订阅轮询共用一个限速器，并发时也不会一起打到同一个站点
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class RateLimiter:
+    """
+    使用方式：
+    rate_limiter.wait(url, interval)   # 返回时就可以发请求了
+    每个域名记录下一个可用的时间点，多个线程按到达顺序依次排开
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next: Dict[str, float] = {}
+
+    def wait(self, url: str, interval: float):
+        if interval <= 0:
+            return
+        host = urlparse(url).hostname or ""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, 0.0))
+            self._next[host] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def page_interval() -> float:
+    from src.config_service import config_service
+    return float(config_service.current().RateLimit.get("pageInterval", 0))
+
+
+rate_limiter = RateLimiter()
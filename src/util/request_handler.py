@@ -1,12 +1,47 @@
+import re
 import time
-from typing import Optional
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
 
 from curl_cffi import requests
 from loguru import logger
 
-from src.util.browser_func import ensure_patchright_chromium_installed, scrape_website_sync
+from src.util.browser_func import BrowserPage, capture_streams, scrape_website_sync
+from src.util.fetch_cache import response_cache, singleflight
+from src.util.profiler import stage
+from src.util.proxy_pool import PAGE, get_proxy_pool
+from src.util.rate_limit import page_interval, rate_limiter
 
-ensure_patchright_chromium_installed()
+# 请求前改写url，默认不改写。基准测试用它把线上域名指向本地的模拟站点，见 bench/
+url_rewriter: Optional[Callable[[str], str]] = None
+
+def rewrite_url(url: str) -> str:
+    return url_rewriter(url) if url_rewriter else url
+
+class StreamMatcher:
+    """
+    流式匹配：每收到一块数据调用feed，匹配到返回True。
+    保留上一块末尾overlap个字节一起匹配，防止要找的内容被切在两块之间
+    """
+    def __init__(self, pattern: "re.Pattern[bytes]", overlap: int = 512):
+        self.pattern = pattern
+        self.overlap = overlap
+        self.match: Optional["re.Match[bytes]"] = None
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> bool:
+        window = self._tail + chunk
+        self.match = self.pattern.search(window)
+        self._tail = window[-self.overlap:]
+        return self.match is not None
+
+@dataclass
+class ConditionalResponse:
+    """条件请求的结果，status为304时content为空，表示内容没有变化"""
+    status: int
+    content: bytes = b""
+    etag: str = ""
+    last_modified: str = ""
 
 class CFHandler:
     def __init__(self):
@@ -14,23 +49,42 @@ class CFHandler:
         self.DELAY = 2
         self.TIMEOUT = 10
 
-    def get(self, url: str) -> Optional[bytes]:
+    def get(self, url: str, cache_ttl: float = 0) -> Optional[bytes]:
+        """
+        :cache_ttl: 大于0时缓存结果（秒）。同一个url正在用浏览器获取时，其他线程等待并共享结果
+        """
+        page = self.get_page(url, cache_ttl)
+        return page.content.encode("utf-8") if page else None
+
+    def get_page(self, url: str, cache_ttl: float = 0) -> Optional[BrowserPage]:
+        """同get，另外返回加载页面时捕获到的播放列表请求（BrowserPage.streams）"""
+        key = ("browser", url)
+        if cache_ttl > 0 and (cached := response_cache.get(key)) is not None:
+            return cached
+        with stage("CFHandler.get"):
+            page = singleflight.do(key, lambda: self._get(url))
+        if page:
+            response_cache.put(key, page, cache_ttl)
+        return page
+
+    def _get(self, url: str) -> Optional[BrowserPage]:
         for attempt in range(self.RETRY):
+            rate_limiter.wait(url, page_interval())
             try:
-                response = scrape_website_sync(url)
-                if response is None:
+                page = scrape_website_sync(rewrite_url(url), capture=capture_streams())
+                if page is None:
                     logger.error(f"scrape_website_sync returned None (attempt {attempt + 1}/{self.RETRY})")
                     time.sleep(self.DELAY)
                     continue
 
-                if "Just a moment..." in response:
+                if "Just a moment..." in page.content and not page.streams:
                     logger.error(
                         f"Cloudflare challenge detected (attempt {attempt + 1}/{self.RETRY}). Waiting and retrying...")
                     time.sleep(self.DELAY)
                     continue
 
                     # 成功获取内容
-                return response.encode("utf-8") if isinstance(response, str) else response
+                return page
 
             except Exception as e:
                 logger.error( f"Failed to fetch data (attempt {attempt + 1}/{self.RETRY}): {e} url is: {url}")
@@ -46,17 +100,135 @@ class RequestHandler:
         self.TIMEOUT = 10
         self.HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"}
 
-    def get(self, url: str) -> Optional[bytes]:
+    def get(self, url: str, kind: str = PAGE, cache_ttl: float = 0,
+            headers: Optional[Dict[str, str]] = None) -> Optional[bytes]:
+        """
+        :kind: 请求类型(page/playlist/segment)，由代理池按规则选择线路，重试时换下一条线路
+        :headers: 额外的请求头，覆盖默认的同名请求头，例如播放列表要带上站点的Referer
+        :cache_ttl: 大于0时缓存状态码为200的结果（秒），用于搜索页等短时间内会重复请求的页面。
+        同一个请求正在进行时，其他线程等待并共享结果，不论是否缓存
+        """
+        key = ("get", kind, url, tuple(sorted((headers or {}).items())))
+        if cache_ttl > 0 and (cached := response_cache.get(key)) is not None:
+            return cached
+        content, ok = singleflight.do(key, lambda: self._get(url, kind, headers))
+        if ok:
+            response_cache.put(key, content, cache_ttl)
+        return content
+
+    def _get(self, url: str, kind: str, headers: Optional[Dict[str, str]] = None) -> Tuple[Optional[bytes], bool]:
+        pool = get_proxy_pool()
+        candidates = pool.candidates(url, kind)
         for attempt in range(self.RETRY):
+            proxy = candidates[attempt % len(candidates)]
+            if kind == PAGE:
+                rate_limiter.wait(url, page_interval())
             try:
                 response = requests.get(
-                    url=url,
+                    url=rewrite_url(url),
+                    headers={**self.HEADERS, **(headers or {})},
+                    proxies={"http": proxy, "https": proxy} if proxy else None,
+                    timeout=self.TIMEOUT,
+                    verify=False,
+                )
+                pool.report_status(proxy, response.status_code)
+                return response.content, response.status_code == 200
+            except Exception as e:
+                pool.report_error(proxy, e)
+                logger.error(f"Failed to fetch data (attempt {attempt + 1}/{self.RETRY}): {e} url is: {url}")
+                time.sleep(self.DELAY)
+        logger.error(f"Max retries reached. Failed to fetch data. url is: {url}")
+        return None, False
+
+    def get_until(self, url: str, matcher: StreamMatcher, kind: str = PAGE) -> Optional[bytes]:
+        """
+        流式获取：边下载边交给matcher匹配，匹配到就断开连接，返回已收到的内容；
+        一直没匹配到则返回完整内容，和get一样。
+        同一个url和规则正在请求时共享结果，此时把结果交给matcher匹配一次，保证matcher.match可用
+        """
+        key = ("get_until", kind, url, matcher.pattern.pattern)
+        shared = []
+
+        def fetch():
+            shared.append(True)
+            return self._get_until(url, matcher, kind)
+
+        content = singleflight.do(key, fetch)
+        if not shared and content:
+            matcher.feed(content)
+        return content
+
+    def _get_until(self, url: str, matcher: StreamMatcher, kind: str) -> Optional[bytes]:
+        pool = get_proxy_pool()
+        candidates = pool.candidates(url, kind)
+        for attempt in range(self.RETRY):
+            proxy = candidates[attempt % len(candidates)]
+            if kind == PAGE:
+                rate_limiter.wait(url, page_interval())
+            response_received = False
+            try:
+                response = requests.get(
+                    url=rewrite_url(url),
                     headers=self.HEADERS,
+                    proxies={"http": proxy, "https": proxy} if proxy else None,
+                    timeout=(self.TIMEOUT, self.TIMEOUT),
+                    verify=False,
+                    stream=True,
+                )
+                # 拿到响应头之后的断开、超时是源站的问题，不算线路失败
+                pool.report_status(proxy, response.status_code)
+                response_received = True
+                chunks = []
+                try:
+                    for chunk in response.iter_content():
+                        chunks.append(chunk)
+                        if matcher.feed(chunk):
+                            logger.debug(f"已匹配到目标内容，提前结束请求，已接收 {sum(map(len, chunks))} 字节")
+                            break
+                finally:
+                    response.close()
+                return b"".join(chunks)
+            except Exception as e:
+                if not response_received:
+                    pool.report_error(proxy, e)
+                logger.error(f"Failed to fetch data (attempt {attempt + 1}/{self.RETRY}): {e} url is: {url}")
+                time.sleep(self.DELAY)
+        logger.error(f"Max retries reached. Failed to fetch data. url is: {url}")
+        return None
+
+    def get_conditional(self, url: str, etag: str = "", last_modified: str = "",
+                        kind: str = PAGE) -> Optional[ConditionalResponse]:
+        """
+        带 If-None-Match / If-Modified-Since 的请求，用于轮询列表页，页面没变化时服务器返回304，不用下载和解析
+        """
+        headers = dict(self.HEADERS)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        pool = get_proxy_pool()
+        candidates = pool.candidates(url, kind)
+        for attempt in range(self.RETRY):
+            proxy = candidates[attempt % len(candidates)]
+            if kind == PAGE:
+                rate_limiter.wait(url, page_interval())
+            try:
+                response = requests.get(
+                    url=rewrite_url(url),
+                    headers=headers,
+                    proxies={"http": proxy, "https": proxy} if proxy else None,
                     timeout=self.TIMEOUT,
                     verify=False,
                 )
-                return response.content
+                pool.report_status(proxy, response.status_code)
+                return ConditionalResponse(
+                    status=response.status_code,
+                    content=response.content if response.status_code != 304 else b"",
+                    etag=response.headers.get("ETag", ""),
+                    last_modified=response.headers.get("Last-Modified", ""),
+                )
             except Exception as e:
+                pool.report_error(proxy, e)
                 logger.error(f"Failed to fetch data (attempt {attempt + 1}/{self.RETRY}): {e} url is: {url}")
                 time.sleep(self.DELAY)
         logger.error(f"Max retries reached. Failed to fetch data. url is: {url}")
@@ -66,7 +238,7 @@ class RequestHandler:
         for attempt in range(self.RETRY):
             try:
                 response = requests.post(
-                    url=url,
+                    url=rewrite_url(url),
                     data=data,
                     headers=self.HEADERS,
                     timeout=self.TIMEOUT,
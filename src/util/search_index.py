@@ -0,0 +1,132 @@
+# doc: 番号到站内视频地址的本地索引（HohoJ、KanAV这类需要先搜索的站点）
+# 每次解析搜索页、列表页时，把页面上所有结果都记下来，之后查同一番号就不用再搜索
+import re
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+# 番号，如 ABC-123、FC2-PPV-123456
+AVID_PATTERN = re.compile(r'\b([A-Za-z]+(?:-[A-Za-z]+)*-\d+)\b')
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+# 列表页里的链接；列表页上的番号要求字母和数字都至少两位，避免把 page-2 之类的导航链接当成番号
+_ANCHOR_PATTERN = re.compile(r'<a\s[^>]*href="([^"]+)"[^>]*>(.*?)</a>', re.DOTALL | re.IGNORECASE)
+_LISTING_AVID_PATTERN = re.compile(r'\b([A-Za-z]{2,}(?:-[A-Za-z]+)*-\d{2,})\b')
+
+
+def extract_links(html: str, link_pattern: "re.Pattern[str]") -> Dict[str, str]:
+    """
+    从搜索页、列表页提取 {番号: 站内地址}
+    :link_pattern: 匹配<a>标签，group(1)是站内地址（或视频id），group(2)是<a>的属性和内容，番号从中查找
+    同一个番号出现多次时保留第一个
+    """
+    links = {}
+    for match in link_pattern.finditer(html):
+        text = _TAG_PATTERN.sub(" ", match.group(2))
+        if avid := AVID_PATTERN.search(text):
+            links.setdefault(avid.group(1).upper(), match.group(1))
+    return links
+
+
+def extract_avids(html: str) -> List[str]:
+    """按页面顺序提取列表页上的番号（从链接文字和地址中查找），去重"""
+    avids = []
+    seen = set()
+    for href, text in _ANCHOR_PATTERN.findall(html):
+        match = _LISTING_AVID_PATTERN.search(_TAG_PATTERN.sub(" ", text)) \
+            or _LISTING_AVID_PATTERN.search(href.rstrip("/").rsplit("/", 1)[-1])
+        if match and (avid := match.group(1).upper()) not in seen:
+            seen.add(avid)
+            avids.append(avid)
+    return avids
+
+
+class SearchIndex:
+    """
+    使用方式：
+    index = SearchIndex(db_path)
+    index.add_many("HohoJ", {"ABC-123": "1000"})
+    index.lookup("HohoJ", "ABC-123")    # 没有或已过期返回None
+    index.remove("HohoJ", "ABC-123")    # 地址失效时删除
+    """
+    def __init__(self, db_path: str, ttl_days: float = 30):
+        self.db_path = db_path
+        self.ttl = ttl_days * 86400
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        if not self._initialized:
+            conn.execute('''CREATE TABLE IF NOT EXISTS SearchIndex (
+                site TEXT NOT NULL, avid TEXT NOT NULL, target TEXT NOT NULL, updated REAL NOT NULL,
+                PRIMARY KEY (site, avid))''')
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def lookup(self, site: str, avid: str) -> Optional[str]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT target, updated FROM SearchIndex WHERE site = ? AND avid = ?',
+                               (site, avid.upper())).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"查询搜索索引出错: {e}")
+            return None
+        finally:
+            conn.close()
+        if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+            return None
+        return row[0]
+
+    def add_many(self, site: str, links: Dict[str, str]) -> int:
+        if not links:
+            return 0
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.executemany('INSERT OR REPLACE INTO SearchIndex (site, avid, target, updated) VALUES (?, ?, ?, ?)',
+                             [(site, avid.upper(), target, now) for avid, target in links.items()])
+            conn.commit()
+            return len(links)
+        except sqlite3.Error as e:
+            logger.error(f"写入搜索索引出错: {e}")
+            return 0
+        finally:
+            conn.close()
+
+    def remove(self, site: str, avid: str):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM SearchIndex WHERE site = ? AND avid = ?', (site, avid.upper()))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"删除搜索索引出错: {e}")
+        finally:
+            conn.close()
+
+    def count(self, sites: Iterable[str] = ()) -> Dict[str, int]:
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT site, COUNT(*) FROM SearchIndex GROUP BY site').fetchall()
+        finally:
+            conn.close()
+        counts = {site: 0 for site in sites}
+        counts.update(dict(rows))
+        return counts
+
+
+_indexes: Dict[Tuple[str, float], SearchIndex] = {}
+
+
+def get_search_index() -> Optional[SearchIndex]:
+    """按当前配置的数据库路径返回索引，配置修改DBPath后自动换到新的数据库；未开启时返回None"""
+    from src.config_service import config_service
+    cfg = config_service.current()
+    if not cfg.SearchIndex.get("enable", False):
+        return None
+    key = (cfg.DBPath, float(cfg.SearchIndex.get("ttlDays", 30)))
+    index = _indexes.get(key)
+    if index is None:
+        index = _indexes[key] = SearchIndex(*key)
+    return index
@@ -0,0 +1,815 @@
+# doc: 进程内的HLS分片下载，分片级重试、传输停滞检测、失败时切换到其他下载器的同一视频
+import errno
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from curl_cffi import requests
+from curl_cffi.requests.streams import STREAM_END
+from loguru import logger
+
+from src.util import decrypt
+from src.util.cancel import CancelToken, TaskCancelled
+from src.util.decrypt import decryptor, key_cache
+from src.util.hls import MediaPlaylist, MediaSegment, SegmentKey, is_master_playlist, parse_media_playlist, playlist_cache
+from src.util.media import SegmentInfo, SegmentManifest, manifest_path
+from src.util.proxy_pool import PLAYLIST, SEGMENT, ProxyPool, get_proxy_pool
+from src.util.request_handler import rewrite_url
+
+
+# 进行中的下载 {ts路径: SegmentDownloader}，命令行按ts路径查询进度
+_active: Dict[str, "SegmentDownloader"] = {}
+_active_lock = threading.Lock()
+
+
+def download_progress(output_path: str) -> Optional[Tuple[int, int, int]]:
+    """正在下载output_path时返回 (已完成分片数, 分片总数, 本次下载的字节数)，否则返回None"""
+    with _active_lock:
+        downloader = _active.get(output_path)
+    if downloader is None:
+        return None
+    with downloader._lock:
+        return downloader._done, downloader._total, downloader._bytes
+
+
+@dataclass
+class SegmentSource:
+    """一个可下载的media playlist，以及请求它需要的header"""
+    url: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    name: str = ""
+
+
+class SegmentAssembler:
+    """
+    把分片放进ts。分片在ts中的位置是前面所有分片大小之和，前面的分片大小都确定后这个分片的位置才确定：
+    响应带Content-Length的分片下载前调用 reserve 预留位置，下载线程边收边写到ts里，不经过分片文件；
+    大小未知（没有Content-Length、压缩传输、前面有分片大小未知）的分片先写到 {ts_path}.parts，
+    位置确定后后台线程用 copy_file_range（内核内复制）复制进ts，不支持时用复用的缓冲区 pwrite 到对应位置
+    从头开始连续写完的分片数达到几个后按估算的总大小预分配ts，减少碎片；每写完 SYNC_BYTES 字节 fsync 一次并记录进度，
+    中断后从 {ts_path}.parts/assembled.json 记录的位置继续，之后已经直接写进ts的分片会重新下载。
+    已经确定位置的分片重试时大小变了（切换到重新封装过的备用源），等正在写ts的线程写完后，
+    把连续写完的部分之后已经写好的分片拆回分片文件，从那里重新确定位置
+    使用方式：
+    assembler = SegmentAssembler(ts_path, parts_dir, durations, part_path)
+    assembler.start()                        # 返回从头开始已经写好的分片数
+    offset = assembler.reserve(index, size)  # 返回分片在ts中的位置，None表示改写分片文件
+    assembler.write(offset, data)            # 写到预留的位置
+    assembler.written(index)                 # 预留的位置写完后调用
+    assembler.add(index)                     # 分片文件写好后调用
+    assembler.fallback(index)                # 这次没下载成功，排在后面的分片不再等它的大小
+    segments = assembler.close()             # 等待复制完成，有分片缺失时返回None
+    """
+    SYNC_BYTES = 64 * 1024 * 1024
+    BUFFER_SIZE = 1024 * 1024
+    PREALLOCATE_AFTER = 8
+
+    def __init__(self, output_path: str, parts_dir: str, durations: List[float], part_path: Callable[[int], str]):
+        self.output_path = output_path
+        self.progress_path = os.path.join(parts_dir, "assembled.json")
+        self.durations = durations
+        self.part_path = part_path
+        self.segments: List[SegmentInfo] = []
+        self._cond = threading.Condition()
+        self._ready: set = set()                       # 位置还没确定的分片文件
+        self._reserved: Dict[int, int] = {}            # 大小已知、位置还没确定的分片 {index: size}
+        self._layout: Dict[int, Tuple[int, int]] = {}  # 位置已经确定、还没写完的分片 {index: (offset, size)}
+        self._fallback: set = set()                    # 只能写分片文件的分片
+        self._copies: set = set()                      # 位置确定、等待复制进ts的分片文件
+        self._done: Dict[int, SegmentInfo] = {}        # 已经写完、前面还有分片没写完的分片
+        self._writing: set = set()                     # 正在写进ts的分片（下载线程直接写，或合并线程复制）
+        self._relayout = False                         # 等待正在写ts的线程写完后重新确定位置
+        self._frontier = 0                             # 位置已经确定的分片数
+        self._frontier_end = 0
+        self._unsynced = 0
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._fd = -1
+        self._buffer: Optional[memoryview] = None
+        self._preallocated = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> int:
+        try:
+            with open(self.progress_path, "r", encoding="utf-8") as f:
+                self.segments = [SegmentInfo(*seg) for seg in json.load(f)]
+        except (IOError, ValueError, TypeError):
+            self.segments = []
+        self._fd = os.open(self.output_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        if os.fstat(self._fd).st_size < self._end():
+            logger.warning("ts比记录的合并进度短，重新合并")
+            self.segments = []
+        # 预分配、直接写入或中断时ts可能比已合并的部分长，截掉没有记录的部分
+        os.ftruncate(self._fd, self._end())
+        if self.segments:
+            logger.info(f"继续合并，已合并 {len(self.segments)} 个分片")
+        with self._cond:
+            self._frontier, self._frontier_end = len(self.segments), self._end()
+            self._ready = {i for i in range(len(self.segments), len(self.durations)) if os.path.exists(self.part_path(i))}
+            self._advance()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="segment-assembler")
+        self._thread.start()
+        return len(self.segments)
+
+    def reserve(self, index: int, size: int, wait: bool = True) -> Optional[int]:
+        """
+        分片大小已知时预留位置，返回分片在ts中的偏移；返回None时改写分片文件
+        :wait: 前面分片的响应头还没到时等待它们的大小，前面有分片改写分片文件后不再等待
+        """
+        with self._cond:
+            self._wait_relayout()
+            if index in self._layout:
+                # 重试时位置已经确定；大小变了就重新确定位置
+                offset, reserved = self._layout[index]
+                if size == reserved:
+                    self._writing.add(index)
+                    return offset
+                logger.warning(f"分片 {index} 的大小 {size} 与预留的 {reserved} 不一致，重新确定之后分片的位置")
+                self._relayout_from_done()
+            if not _POSITIONAL_WRITE or index in self._fallback:
+                return None
+            self._reserved[index] = size
+            self._advance()
+            while wait and index not in self._layout \
+                    and not any(i in self._fallback for i in range(self._frontier, index)):
+                self._cond.wait()
+            if index in self._layout:
+                self._writing.add(index)
+                return self._layout[index][0]
+            self._reserved.pop(index, None)
+            self._fallback.add(index)
+            self._cond.notify_all()
+            return None
+
+    def write(self, offset: int, data: memoryview):
+        _write_at(self._fd, data, offset)
+
+    def written(self, index: int):
+        with self._cond:
+            self._writing.discard(index)
+            self._complete(index)
+
+    def add(self, index: int):
+        with self._cond:
+            self._wait_relayout()
+            if index in self._layout:
+                # 之前预留过位置，这次改写了分片文件
+                if os.path.getsize(self.part_path(index)) == self._layout[index][1]:
+                    self._copies.add(index)
+                    self._cond.notify_all()
+                    return
+                logger.warning(f"分片 {index} 的大小与预留的不一致，重新确定之后分片的位置")
+                self._relayout_from_done()
+            self._ready.add(index)
+            self._advance()
+
+    def fallback(self, index: int):
+        with self._cond:
+            self._writing.discard(index)
+            if index not in self._layout:
+                self._fallback.add(index)
+            self._cond.notify_all()
+
+    def close(self) -> Optional[List[SegmentInfo]]:
+        """等待已下载的分片复制完，全部分片都在ts里时返回分片位置"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        try:
+            if self._error is not None:
+                logger.error(f"合并分片失败: {self._error}")
+                return None
+            # 去掉预分配多出来的部分，以及之后直接写入但前面还有分片没完成的部分
+            os.ftruncate(self._fd, self._end())
+            os.fsync(self._fd)
+            self._save_progress(len(self.segments))
+            return self.segments if len(self.segments) == len(self.durations) else None
+        finally:
+            os.close(self._fd)
+
+    def _end(self) -> int:
+        return self.segments[-1].offset + self.segments[-1].size if self.segments else 0
+
+    def _advance(self):
+        """调用方需持有锁。从第一个位置未确定的分片开始，依次确定大小已知的分片的位置"""
+        while self._frontier < len(self.durations):
+            index = self._frontier
+            if index in self._reserved:
+                size = self._reserved.pop(index)
+            elif index in self._ready:
+                self._ready.discard(index)
+                size = os.path.getsize(self.part_path(index))
+                self._copies.add(index)
+            else:
+                break
+            self._layout[index] = (self._frontier_end, size)
+            self._frontier_end += size
+            self._frontier += 1
+        self._cond.notify_all()
+
+    def _wait_relayout(self):
+        """调用方需持有锁。其他线程正在重新确定位置时等它完成"""
+        while self._relayout:
+            self._cond.wait()
+
+    def _relayout_from_done(self):
+        """
+        调用方需持有锁。等正在写ts的线程都写完，把连续写完的部分之后已经写好的分片拆回分片文件，
+        丢掉其他已确定的位置，从连续写完的部分末尾重新确定位置
+        """
+        self._relayout = True
+        try:
+            while self._writing:
+                self._cond.wait()
+            for index, info in sorted(self._done.items()):
+                self._split_out(index, info.offset, info.size)
+                self._ready.add(index)
+            self._done.clear()
+            # 等待复制的分片文件还在，重新排位置；直接写ts还没写完的分片由下载线程重试
+            self._ready.update(self._copies)
+            self._copies.clear()
+            self._layout.clear()
+            self._frontier, self._frontier_end = len(self.segments), self._end()
+        finally:
+            self._relayout = False
+        self._advance()
+
+    def _split_out(self, index: int, offset: int, size: int):
+        """把已经写进ts的分片复制回分片文件"""
+        buffer = memoryview(bytearray(min(size, self.BUFFER_SIZE)))
+        with open(self.part_path(index), "wb", buffering=0) as part:
+            copied = 0
+            while copied < size:
+                n = _read_at(self._fd, buffer[:size - copied], offset + copied)
+                if n == 0:
+                    raise IOError("ts被截断")
+                _write_all(part, buffer[:n])
+                copied += n
+
+    def _complete(self, index: int):
+        """调用方需持有锁"""
+        offset, size = self._layout.pop(index)
+        self._done[index] = SegmentInfo(self.durations[index], offset, size)
+        while len(self.segments) in self._done:
+            self.segments.append(self._done.pop(len(self.segments)))
+        self._unsynced += size
+        self._cond.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while (not self._copies or self._relayout) and not self._closed \
+                            and self._unsynced < self.SYNC_BYTES:
+                        self._cond.wait()
+                    self._wait_relayout()
+                    if not self._copies and self._unsynced < self.SYNC_BYTES:
+                        return
+                    index = min(self._copies) if self._copies else None
+                    if index is not None:
+                        self._copies.discard(index)
+                        self._writing.add(index)
+                        offset, size = self._layout[index]
+                if index is not None:
+                    try:
+                        self._copy_part(index, offset, size)
+                    except BaseException:
+                        with self._cond:
+                            self._writing.discard(index)
+                            self._cond.notify_all()
+                        raise
+                    with self._cond:
+                        self._writing.discard(index)
+                        self._complete(index)
+                if not self._preallocated and len(self.segments) >= self.PREALLOCATE_AFTER:
+                    self._preallocate()
+                with self._cond:
+                    if self._unsynced < self.SYNC_BYTES:
+                        continue
+                    self._unsynced = 0
+                    synced = len(self.segments)
+                # 先让数据落盘再记录进度，进度文件里的分片一定完整
+                os.fsync(self._fd)
+                self._save_progress(synced)
+        except BaseException as e:
+            self._error = e
+
+    def _copy_part(self, index: int, offset: int, size: int):
+        part_path = self.part_path(index)
+        with open(part_path, "rb") as part:
+            if os.fstat(part.fileno()).st_size != size:
+                raise IOError(f"分片文件 {part_path} 被修改")
+            self._copy(part.fileno(), size, offset)
+        os.remove(part_path)
+
+    def _copy(self, src: int, size: int, offset: int):
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src, self._fd, size - copied, copied, offset + copied)
+                    if n == 0:
+                        raise IOError("分片文件被截断")
+                    copied += n
+                return
+            except OSError as e:
+                # 跨文件系统或文件系统不支持时退回到普通读写
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        while copied < size:
+            n = _read_at(src, self._buffer, copied)
+            if n == 0:
+                raise IOError("分片文件被截断")
+            _write_at(self._fd, self._buffer[:n], offset + copied)
+            copied += n
+
+    def _preallocate(self):
+        """按已合并分片的平均大小估算总大小"""
+        self._preallocated = True
+        if not hasattr(os, "posix_fallocate"):
+            return
+        estimate = int(self._end() / len(self.segments) * len(self.durations) * 1.05)
+        try:
+            os.posix_fallocate(self._fd, 0, estimate)
+        except OSError as e:
+            logger.debug(f"预分配失败，跳过: {e}")
+
+    def _save_progress(self, count: int):
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([[seg.duration, seg.offset, seg.size] for seg in self.segments[:count]], f)
+        os.replace(tmp_path, self.progress_path)
+
+
+class _SegmentWriter:
+    """一次下载尝试的写入目标：ts中预留的位置，或者分片的临时文件"""
+    def __init__(self, assembler: SegmentAssembler, index: int, tmp_path: str):
+        self.assembler = assembler
+        self.index = index
+        self.tmp_path = tmp_path
+        self.offset: Optional[int] = None
+        self.size = 0
+        self.written = 0
+        self._file = None
+
+    def open(self, size: Optional[int], wait: bool = True):
+        """size为None表示大小未知，写分片文件"""
+        self.offset = self.assembler.reserve(self.index, size, wait) if size else None
+        self.size = size or 0
+        if self.offset is None:
+            # 不经过Python的写缓冲，每块数据直接写入文件
+            self._file = open(self.tmp_path, "wb", buffering=0)
+
+    def write(self, data: memoryview):
+        if self._file is not None:
+            _write_all(self._file, data)
+        else:
+            if self.written + len(data) > self.size:
+                raise IOError(f"分片超出预留的大小 {self.size}")
+            self.assembler.write(self.offset + self.written, data)
+        self.written += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def commit(self, part_path: str) -> int:
+        """数据完整后调用，返回分片大小"""
+        if self._file is not None:
+            os.replace(self.tmp_path, part_path)
+            self.assembler.add(self.index)
+        else:
+            if self.written != self.size:
+                raise IOError(f"分片不完整 {self.written}/{self.size}")
+            self.assembler.written(self.index)
+        return self.written
+
+
+def _close_response(response):
+    """
+    关闭流式响应。停滞时curl线程还卡在读socket上，要等curl自己的低速超时才结束，
+    这时不等它，curl线程结束后自行退出
+    """
+    quit_now = getattr(response, "quit_now", None)
+    if quit_now is not None and quit_now.is_set() and not response.stream_task.done():
+        return
+    response.close()
+
+
+def _read_at(fd: int, buffer: memoryview, offset: int) -> int:
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [buffer], offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    data = os.read(fd, len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def _write_all(f, data: memoryview):
+    while data:
+        data = data[f.write(data):]
+
+
+# Windows没有pwrite，lseek+write不能多个线程同时写，只用分片文件
+_POSITIONAL_WRITE = hasattr(os, "pwrite")
+
+
+def _write_at(fd: int, data: memoryview, offset: int):
+    """没有pwrite时只有合并线程写ts，用lseek+write"""
+    while data:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, data)
+        data, offset = data[n:], offset + n
+
+
+class SegmentDownloader:
+    """
+    使用方式：
+    downloader = SegmentDownloader()
+    downloader.download(source, ts_path, mirrors)
+    大小已知的分片直接写到ts中的位置，大小未知的先写到 {ts_path}.parts 目录再复制进ts（见SegmentAssembler）。
+    中断后再次下载会跳过已合并和 .parts 中已完成的分片
+    合并时在 {ts_path}.manifest.json 记录每个分片在ts中的位置，校验发现坏分片时只需重新下载这些分片
+    """
+    def __init__(self, proxy_pool: Optional[ProxyPool] = None, workers: int = 8, retries: int = 5,
+                 backoff: float = 1.0, max_backoff: float = 30.0, stall_timeout: float = 30.0,
+                 connect_timeout: float = 10.0):
+        """
+        :proxy_pool: 每个分片按规则从代理池选线路，分散到多个代理上；重试时换下一条线路
+        :stall_timeout: 超过这么多秒没有收到数据就认为传输停滞，放弃本次请求
+        """
+        self.proxy_pool = proxy_pool or get_proxy_pool()
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stall_timeout = stall_timeout
+        self.connect_timeout = connect_timeout
+        self.HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"}
+
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程去解析备用源，解析要联网，不能占着 _lock 挡住其他下载线程
+        self._failover_lock = threading.Lock()
+        self._source: Optional[SegmentSource] = None
+        self._playlist: Optional[MediaPlaylist] = None
+        self._mirrors: Optional[Iterator[SegmentSource]] = None
+        self._cancel = CancelToken()
+        self._done = self._total = self._bytes = 0
+
+    @classmethod
+    def from_config(cls, cfg: Optional[dict]) -> "SegmentDownloader":
+        """configs.json 中的 SegmentDownloader 配置"""
+        cfg = cfg or {}
+        return cls(
+            workers=cfg.get("workers", 8),
+            retries=cfg.get("retries", 5),
+            backoff=cfg.get("backoff", 1),
+            max_backoff=cfg.get("maxBackoff", 30),
+            stall_timeout=cfg.get("stallTimeout", 30),
+        )
+
+    def download(self, source: SegmentSource, output_path: str,
+                 mirrors: Optional[Iterator[SegmentSource]] = None, cancel: Optional[CancelToken] = None) -> bool:
+        """
+        下载source的全部分片并合并到output_path
+        :mirrors: 备用源，某个分片在当前源上多次失败时，剩余分片改从下一个等价的备用源下载
+        :cancel: 停止任务时正在下载的分片立即断开，没开始的不再下载，抛出TaskCancelled
+        """
+        self._cancel = cancel or CancelToken()
+        playlist = self._load_playlist(source)
+        if playlist is None or not playlist.segments:
+            logger.error(f"获取分片列表失败: {source.url}")
+            return False
+
+        self._source, self._playlist, self._mirrors = source, playlist, mirrors
+        parts_dir = output_path + ".parts"
+        self._prepare_parts_dir(parts_dir, playlist)
+
+        total = len(playlist.segments)
+        assembler = SegmentAssembler(output_path, parts_dir, [seg.duration for seg in playlist.segments],
+                                     lambda i: self._part_path(parts_dir, i))
+        assembled = assembler.start()
+        pending = [i for i in range(assembled, total) if not os.path.exists(self._part_path(parts_dir, i))]
+        logger.info(f"共 {total} 个分片，待下载 {len(pending)} 个，来源: {source.name or source.url}")
+
+        self._done = total - len(pending)
+        self._total = total
+        self._bytes = 0
+        with _active_lock:
+            _active[output_path] = self
+        try:
+            from src.config_service import config_service
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # 下载线程里读到的也是任务的配置快照（代理线路、解密、日志间隔等）
+                futures = [config_service.submit(executor, self._fetch_with_failover, parts_dir, i, assembler)
+                           for i in pending]
+                results = [future.result() for future in futures]
+        finally:
+            segments = assembler.close()
+            with _active_lock:
+                _active.pop(output_path, None)
+
+        if self._cancel.cancelled:
+            logger.info(f"分片下载已停止，已完成的分片保留在 {parts_dir}")
+            self._cancel.check()
+        if not all(results):
+            logger.error(f"有 {results.count(False)} 个分片下载失败，已完成的分片保留在 {parts_dir}")
+            return False
+        if segments is None:
+            return False
+
+        SegmentManifest(
+            url=self._source.url, headers=self._source.headers, name=self._source.name, segments=segments
+        ).save(manifest_path(output_path))
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        return True
+
+    def _fetch_with_failover(self, parts_dir: str, index: int, assembler: SegmentAssembler) -> bool:
+        while not self._cancel.cancelled:
+            with self._lock:
+                source, playlist = self._source, self._playlist
+            part_path = self._part_path(parts_dir, index)
+            size = self._fetch_segment(source, playlist.segments[index], index, part_path, assembler)
+            if size:
+                with self._lock:
+                    self._done += 1
+                    self._bytes += size
+                    if self._done % 50 == 0 or self._done == self._total:
+                        logger.info(f"分片进度: {self._done}/{self._total}")
+                return True
+            if self._cancel.cancelled:
+                break
+            logger.warning(f"分片 {index} 在 {source.name or source.url} 上多次失败")
+            if not self._failover(source):
+                break
+        # 排在后面、等待预留位置的分片不再等这个分片
+        assembler.fallback(index)
+        return False
+
+    def _failover(self, failed: SegmentSource) -> bool:
+        """切换到下一个等价的备用源，其他线程已经切换过则直接返回"""
+        with self._failover_lock:
+            with self._lock:
+                if self._source is not failed:
+                    return True
+                mirrors, current = self._mirrors, self._playlist
+            if mirrors is None:
+                return False
+            for mirror in mirrors:
+                if self._cancel.cancelled:
+                    return False
+                playlist = self._load_playlist(mirror)
+                if playlist is None:
+                    continue
+                if not self._is_equivalent(current, playlist):
+                    logger.warning(f"备用源 {mirror.name or mirror.url} 的分片与当前不一致，跳过")
+                    continue
+                logger.info(f"剩余分片切换到备用源: {mirror.name or mirror.url}")
+                with self._lock:
+                    self._source, self._playlist = mirror, playlist
+                return True
+            logger.error("没有可用的备用源")
+            with self._lock:
+                self._mirrors = None
+            return False
+
+    def _fetch_segment(self, source: SegmentSource, segment: MediaSegment, index: int, part_path: str,
+                       assembler: SegmentAssembler) -> int:
+        """
+        指数退避重试下载单个分片，返回分片大小，失败返回0。响应带Content-Length时边收边写到ts中预留的位置；
+        大小未知时先写临时文件再改名，保证分片文件完整。加密的分片解密后再写入
+        """
+        if segment.key is not None and not self._can_decrypt(segment.key):
+            return 0
+        tmp_path = part_path + ".tmp"
+        headers = {**self.HEADERS, **source.headers}
+        candidates = self.proxy_pool.candidates(segment.url, SEGMENT)
+        for attempt in range(self.retries):
+            if self._cancel.cancelled:
+                break
+            proxy = candidates[attempt % len(candidates)]
+            writer = _SegmentWriter(assembler, index, tmp_path)
+            response = None
+            try:
+                key = None
+                if segment.key is not None:
+                    key = self._load_key(source, segment.key)
+                    if key is None:
+                        raise IOError(f"获取密钥失败: {segment.key.uri}")
+                # 流式请求里timeout的第二个值只是curl兜底的低速阈值（连接+读取的秒数内平均不到1字节/秒），
+                # 传输停滞由 _iter_chunks 按最后一次收到数据的时间判断
+                response = requests.get(
+                    url=rewrite_url(segment.url),
+                    headers=headers,
+                    proxies={"http": proxy, "https": proxy} if proxy else None,
+                    timeout=(self.connect_timeout, self.stall_timeout),
+                    verify=False,
+                    stream=True,
+                )
+                # 线路只管把请求送到；源站的错误状态码、停滞、分片不完整换线路也一样，不计入线路状态
+                self.proxy_pool.report_status(proxy, response.status_code)
+                try:
+                    if response.status_code != 200:
+                        raise IOError(f"http status {response.status_code}")
+                    length = response.headers.get("Content-Length")
+                    expected = int(length) if length and not response.headers.get("Content-Encoding") else None
+                    received = 0
+                    if key is None:
+                        writer.open(expected)
+                        for chunk in self._iter_chunks(response):
+                            writer.write(memoryview(chunk))
+                            received += len(chunk)
+                    else:
+                        received = self._receive_encrypted(response, writer, key, segment.iv)
+                finally:
+                    _close_response(response)
+                    writer.close()
+
+                if expected is not None and expected != received:
+                    raise IOError(f"分片不完整 {received}/{expected}")
+                if received == 0:
+                    raise IOError("分片为空")
+                return writer.commit(part_path)
+            except TaskCancelled:
+                break
+            except Exception as e:
+                if response is None:
+                    self.proxy_pool.report_error(proxy, e)
+                assembler.fallback(index)
+                logger.warning(f"分片下载失败 (attempt {attempt + 1}/{self.retries}): {e} url is: {segment.url}")
+                # 带抖动的指数退避，避免所有线程同时重试；停止任务时立即结束等待
+                if attempt + 1 < self.retries and self._cancel.wait(
+                        min(self.backoff * 2 ** attempt, self.max_backoff) * (0.5 + random.random() / 2)):
+                    break
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return 0
+
+    def _receive_encrypted(self, response, writer: _SegmentWriter, key: bytes, iv: bytes) -> int:
+        """
+        密文收进缓冲区，整个分片收完后解密再写入，返回收到的密文字节数
+        解密后才知道明文大小，这时不再等待前面的分片，位置定不下来就写分片文件
+        """
+        buffer = decryptor.acquire()
+        try:
+            for chunk in self._iter_chunks(response):
+                buffer.write(chunk)
+            length = decryptor.decrypt(buffer, key, iv)
+            writer.open(length, wait=False)
+            writer.write(buffer.buf[:length])
+            return buffer.length
+        finally:
+            decryptor.release(buffer)
+
+    def _iter_chunks(self, response) -> Iterator[bytes]:
+        """
+        逐块读取流式响应，超过 stall_timeout 秒没有收到新数据就抛出IOError，停止任务时抛出TaskCancelled。
+        iter_content 会一直阻塞在curl_cffi的数据队列上，这里按超时从队列取数据
+        """
+        last = time.monotonic()
+        while True:
+            self._cancel.check()
+            try:
+                chunk = response.queue.get(timeout=min(self.stall_timeout, 1.0))
+            except queue.Empty:
+                if time.monotonic() - last > self.stall_timeout:
+                    # curl的写回调看到quit_now后中断传输
+                    response.quit_now.set()
+                    raise IOError(f"传输停滞，{self.stall_timeout:g}秒没有收到数据")
+                continue
+            if chunk is STREAM_END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            last = time.monotonic()
+            yield chunk
+
+    @staticmethod
+    def _can_decrypt(key: SegmentKey) -> bool:
+        if key.method != "AES-128":
+            logger.error(f"不支持的加密方式 {key.method}，无法下载")
+            return False
+        if not decrypt.available():
+            logger.error("分片是加密的，需要安装cryptography才能解密: pip install cryptography")
+            return False
+        return True
+
+    def _load_key(self, source: SegmentSource, key: SegmentKey) -> Optional[bytes]:
+        def loader(uri: str) -> Optional[bytes]:
+            candidates = self.proxy_pool.candidates(uri, PLAYLIST)
+            for attempt in range(self.retries):
+                proxy = candidates[attempt % len(candidates)]
+                try:
+                    response = requests.get(
+                        url=rewrite_url(uri),
+                        headers={**self.HEADERS, **source.headers},
+                        proxies={"http": proxy, "https": proxy} if proxy else None,
+                        timeout=self.connect_timeout + self.stall_timeout,
+                        verify=False,
+                    )
+                    if response.status_code == 200:
+                        return response.content
+                    logger.error(f"获取密钥失败 (attempt {attempt + 1}/{self.retries}): http status {response.status_code} url is: {uri}")
+                except Exception as e:
+                    logger.error(f"获取密钥失败 (attempt {attempt + 1}/{self.retries}): {e} url is: {uri}")
+                time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            return None
+
+        return key_cache.get_or_load(key.uri, loader)
+
+    def _load_playlist(self, source: SegmentSource) -> Optional[MediaPlaylist]:
+        def loader(url: str) -> Optional[MediaPlaylist]:
+            candidates = self.proxy_pool.candidates(url, PLAYLIST)
+            for attempt in range(self.retries):
+                proxy = candidates[attempt % len(candidates)]
+                try:
+                    response = requests.get(
+                        url=rewrite_url(url),
+                        headers={**self.HEADERS, **source.headers},
+                        proxies={"http": proxy, "https": proxy} if proxy else None,
+                        timeout=self.connect_timeout + self.stall_timeout,
+                        verify=False,
+                    )
+                    text = response.content.decode("utf-8", errors="ignore")
+                    if "#EXTM3U" not in text or is_master_playlist(text):
+                        logger.error(f"不是有效的media playlist: {url}")
+                        return None
+                    return parse_media_playlist(text, url)
+                except Exception as e:
+                    logger.error(f"Failed to fetch playlist (attempt {attempt + 1}/{self.retries}): {e} url is: {url}")
+                    time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            return None
+
+        playlist = playlist_cache.get_or_load(source.url, loader)
+        return playlist if isinstance(playlist, MediaPlaylist) else None
+
+    @staticmethod
+    def _is_equivalent(a: MediaPlaylist, b: MediaPlaylist) -> bool:
+        """分片数量和每个分片时长一致，才能把剩余分片换到另一个源下载"""
+        if len(a.segments) != len(b.segments):
+            return False
+        return all(abs(x.duration - y.duration) < 0.5 for x, y in zip(a.segments, b.segments))
+
+    def _prepare_parts_dir(self, parts_dir: str, playlist: MediaPlaylist):
+        """记录分片时长，续传时分片划分不一致就丢弃旧分片"""
+        manifest_path = os.path.join(parts_dir, "manifest.json")
+        durations = [seg.duration for seg in playlist.segments]
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    old = json.load(f)
+                if len(old) == len(durations) and all(abs(x - y) < 0.5 for x, y in zip(old, durations)):
+                    return
+            except (IOError, ValueError):
+                pass
+            logger.info("已有分片与当前播放列表不一致，重新下载")
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(durations, f)
+
+    @staticmethod
+    def _part_path(parts_dir: str, index: int) -> str:
+        return os.path.join(parts_dir, f"{index:05d}.ts")
+
+    @classmethod
+    def split_parts(cls, ts_path: str, manifest: SegmentManifest, skip: Iterable[int]) -> bool:
+        """
+        按manifest把合并好的ts拆回 {ts_path}.parts，跳过skip中的分片，
+        之后再调用download就只会重新下载这些分片
+        """
+        if not manifest.has_offsets:
+            return False
+        skip = set(skip)
+        parts_dir = ts_path + ".parts"
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir, exist_ok=True)
+        with open(os.path.join(parts_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump([seg.duration for seg in manifest.segments], f)
+        with open(ts_path, "rb") as src:
+            for i, seg in enumerate(manifest.segments):
+                if i in skip:
+                    continue
+                src.seek(seg.offset)
+                data = src.read(seg.size)
+                if len(data) != seg.size:
+                    logger.warning(f"ts中分片 {i} 不完整，需要重新下载")
+                    continue
+                with open(cls._part_path(parts_dir, i), "wb") as f:
+                    f.write(data)
+        return True
@@ -0,0 +1,25 @@
+# doc: 后台服务的任务状态表。长时间运行时每个番号都会留下一条，只保留最近的若干条已结束的状态
+from collections import OrderedDict
+from typing import Iterable
+
+
+class StatusMap(OrderedDict):
+    """
+    使用方式（与dict相同，调用方负责加锁）：
+    status = StatusMap(active=(QUEUED, REMUXING), keep=200)
+    status[avid] = DONE
+    进行中的状态不会被淘汰；已结束的超过keep条时淘汰最早的
+    """
+    def __init__(self, active: Iterable[str] = (), keep: int = 200):
+        super().__init__()
+        self.active = frozenset(active)
+        self.keep = keep
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        finished = len(self) - sum(1 for status in self.values() if status in self.active)
+        if finished <= self.keep:
+            return
+        for old in [k for k, status in self.items() if status not in self.active][:finished - self.keep]:
+            del self[old]
@@ -0,0 +1,137 @@
+# doc: 下载后的完整性校验。校验在进程池里执行，不占用下载线程；
+# 通过后才写入downloaded.db，失败时只重新下载坏掉的分片并重新转码
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from .comm import *
+from .config_service import AppConfig, config_service
+from .task_store import fail_and_requeue, record_downloaded
+from .util.media import SegmentManifest, manifest_path, remux, verify_mp4
+from .util.segment_downloader import SegmentDownloader, SegmentSource
+from .util.status_map import StatusMap
+
+VERIFYING = "verifying"
+REPAIRING = "repairing"
+VERIFIED = "verified"
+FAILED = "failed"
+
+
+class VerifyService:
+    """
+    使用方式：
+    verify_service.submit(avid)   # 在任务的配置快照内调用，立即返回
+    verify_service.status()       # {avid: verifying/repairing/verified/failed}
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = StatusMap(active=(VERIFYING, REPAIRING))
+        self._workers = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def submit(self, avid: str):
+        cfg = config_service.current()
+        with self._lock:
+            if self._status.get(avid) in (VERIFYING, REPAIRING):
+                return
+            self._status[avid] = VERIFYING
+            executor = self._get_executor(int(cfg.Verification.get("workers", 1)))
+        logger.info(f"{avid} 已提交校验")
+        config_service.submit(executor, self._run, avid, cfg)
+
+    def status(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._status)
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        """调用方需持有锁。线程负责调度和修复，进程池负责校验"""
+        workers = max(workers, 1)
+        if self._executor is None or workers != self._workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._pool.shutdown(wait=False)
+            self._workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+            # 主进程里有多个线程，fork出来的子进程可能卡在别的线程持有的锁上，使用spawn
+            self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _set_status(self, avid: str, status: str):
+        with self._lock:
+            self._status[avid] = status
+
+    def _run(self, avid: str, cfg: AppConfig):
+        try:
+            self._verify(avid, cfg)
+        except Exception as e:
+            logger.error(f"{avid} 校验异常: {e}")
+            self._set_status(avid, FAILED)
+            fail_and_requeue(avid, f"校验异常: {e}")
+
+    def _verify(self, avid: str, cfg: AppConfig):
+        verification = cfg.Verification
+        ts_path = os.path.join(cfg.SavePath, avid, f"{avid}.ts")
+        mp4_path = os.path.join(cfg.SavePath, avid, f"{avid}.mp4")
+        max_repairs = int(verification.get("maxRepairs", 2))
+
+        reason = ""
+        for attempt in range(max_repairs + 1):
+            manifest = SegmentManifest.load(manifest_path(ts_path))
+            result = self._pool.submit(
+                verify_mp4, ffmpeg_tool, ffprobe_tool, mp4_path, manifest,
+                int(verification.get("samplePoints", 3)), float(verification.get("durationTolerance", 2)),
+            ).result()
+
+            if result.ok:
+                logger.info(f"{avid} 校验通过 {result.reason}".rstrip())
+                record_downloaded(avid, cfg)
+                for path in (ts_path, manifest_path(ts_path)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._set_status(avid, VERIFIED)
+                return
+
+            reason = result.reason
+            logger.warning(f"{avid} 校验失败: {reason}")
+            if attempt == max_repairs:
+                break
+            self._set_status(avid, REPAIRING)
+            if result.remux:
+                repaired = os.path.exists(ts_path)
+            else:
+                repaired = self._redownload(ts_path, manifest, result.bad_segments)
+            if not repaired:
+                break
+            logger.info(f"{avid} 重新转码")
+            if not remux(ffmpeg_tool, ts_path, mp4_path):
+                logger.error(f"{avid} 重新转码失败")
+                reason = "重新转码失败"
+                break
+
+        # 删掉坏的mp4和分片清单，避免下次按“mp4已存在”或“ts已下载完成”直接跳过下载；
+        # 修复时拆出的分片保留在 {ts}.parts，重新下载时可以续传
+        logger.error(f"{avid} 校验未通过，需要重新下载")
+        for path in (mp4_path, manifest_path(ts_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        self._set_status(avid, FAILED)
+        fail_and_requeue(avid, f"校验未通过: {reason}".rstrip(": "))
+
+    @staticmethod
+    def _redownload(ts_path: str, manifest: Optional[SegmentManifest], bad_segments) -> bool:
+        """把ts拆回分片，只重新下载坏掉的分片再合并"""
+        if manifest is None or not bad_segments or not manifest.has_offsets:
+            logger.warning("无法定位坏分片，不能只下载部分内容")
+            return False
+        logger.info(f"重新下载 {len(bad_segments)} 个分片: {bad_segments[:20]}")
+        if not SegmentDownloader.split_parts(ts_path, manifest, bad_segments):
+            return False
+        downloader = SegmentDownloader.from_config(config_service.current().SegmentDownloader)
+        source = SegmentSource(url=manifest.url, headers=manifest.headers, name=manifest.name)
+        return downloader.download(source, ts_path)
+
+
+verify_service = VerifyService()